@@ -14,6 +14,7 @@ Prerequisites: pip install joblib
 Adapted from https://github.com/explosion/spaCy/blob/master/examples/pipeline/multi_processing.py
 """
 
+import functools
 import plac
 import sys
 import spacy
@@ -32,8 +33,9 @@ from pycomposer import *
     limit=("Limit of entries from the dataset", "option", "l", int),
 )
 def main(model="en_core_web_sm", n_jobs=4, batch_size=1000, limit=10000):
-    nlp = spacy.load(model)  # load spaCy model
-    print("Loaded model '%s'" % model)
+    # Each worker loads the spaCy model once, instead of touching the pages
+    # of a model loaded here.
+    worker_initializer("nlp", functools.partial(spacy.load, model))
 
     # load and pre-process the IMDB dataset
     sys.stdout.write("Loading IMDB data...")
@@ -42,8 +44,8 @@ def main(model="en_core_web_sm", n_jobs=4, batch_size=1000, limit=10000):
     texts, _ = zip(*data[-limit:])
 
     start = time.time()
-    process(nlp, texts)
-    evaluate(workers=n_jobs, batch_size=batch_size)
+    process(worker_object("nlp"), texts)
+    evaluate(workers=n_jobs, batch_size=batch_size, persistent=True)
     end = time.time()
     print("Total:", end - start)
 
@@ -1,7 +1,6 @@
 from pycomposer import *
 import time
 
-import sharedmem
 import numpy as np
 import scipy.special as ss
 
@@ -15,7 +14,21 @@ class NdArraySplit(SplitType):
 
     def combine(self, values):
         if self.merge:
-            return np.concatenate(values)
+            if not any(spilled(value) for value in values):
+                return np.concatenate(values)
+            # Copy one piece at a time into a result on disk.
+            shape = (sum(len(value) for value in values),) + values[0].shape[1:]
+            result = spill_empty(shape, np.result_type(*values))
+            start = 0
+            for value in values:
+                result[start:start + len(value)] = value
+                start += len(value)
+            result.flush()
+            return result
+
+    def spill(self, value):
+        if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+            return spill_array(value)
 
     def split(self, start, end, value):
         if isinstance(value, np.ndarray):
@@ -44,6 +57,40 @@ class NdArraySplit(SplitType):
                 return value.shape[0]
             return value.shape[-1]
 
+    def bytes_per_element(self, value):
+        if isinstance(value, np.ndarray):
+            ndims = len(value.shape)
+            if ndims == 1:
+                return value.itemsize
+            elif ndims == 2:
+                if value.shape[1] == 1:
+                    # Not split.
+                    return None
+                # Bytes in one row (or column) of the piece.
+                width = value.shape[0] if self.slice_col else value.shape[1]
+                return value.itemsize * width
+
+    def combines_pieces(self):
+        return self.merge
+
+    def allocate(self, piece, elements):
+        # Merged 2-d values count their elements along the other axis.
+        if self.merge and isinstance(piece, np.ndarray) and piece.ndim == 1 and\
+                not piece.dtype.hasobject:
+            return [shared_empty(elements, piece.dtype)]
+
+    def write(self, arrays, start, end, piece):
+        view = arrays[0][start:end]
+        # Calls passed the output as `out` have already written their piece.
+        if not np.may_share_memory(view, piece):
+            view[...] = piece
+
+    def assemble(self, arrays, piece):
+        return arrays[0]
+
+    def prefetchable(self):
+        return True
+
     def __str__(self):
         return "NdArraySplit"
 
@@ -79,11 +126,11 @@ _kwargs = { 'axis': Broadcast() }
 # roll = sa(dc(_args), dc(_kwargs), dc(NdArraySplit()))(np.roll)
 
 def ones(shape, dtype=None, order='C'):
-    result = sharedmem.empty(shape)
+    result = shared_empty(shape)
     result[:] = np.ones(shape, dtype, order)[:]
     return result
 
 def zeros(shape, dtype=None, order='C'):
-    result = sharedmem.empty(shape)
-    result[:] = np.zeros(shape, dtype, order)[:]
-    return result
+    # Shared memory is zero-filled when its pages are first touched, so each
+    # page is placed by the worker that first writes to it.
+    return shared_empty(shape, dtype if dtype is not None else float)
@@ -33,8 +33,62 @@ class DataFrameSplit(SplitType):
                 do_combine = True
 
         if do_combine and len(values) > 0:
+            if any(spilled(value) for value in values if value is not None):
+                return self._combine_spilled([value for value in values if value is not None])
             return pd.concat(values)
 
+    def _combine_spilled(self, values):
+        """ Concatenates values with spilled columns one value at a time into
+        columns on disk. Falls back to `pd.concat` if their columns differ. """
+        first = values[0]
+        names = None if first.ndim == 1 else first.columns
+        if any(value.ndim != first.ndim or (names is not None and not value.columns.equals(names))\
+                for value in values):
+            return pd.concat(values)
+        pieces = [self._columns(value) for value in values]
+        columns = []
+        for i in range(len(pieces[0])):
+            dtype = np.result_type(*[piece[i] for piece in pieces])
+            if dtype.hasobject:
+                columns.append(np.concatenate([piece[i] for piece in pieces]))
+                continue
+            column = spill_empty(sum(len(piece[i]) for piece in pieces), dtype)
+            start = 0
+            for piece in pieces:
+                column[start:start + len(piece[i])] = piece[i]
+                start += len(piece[i])
+            column.flush()
+            columns.append(column)
+        index = first.index.append([value.index for value in values[1:]])
+        if first.ndim == 1:
+            return pd.Series(columns[0], index=index, name=first.name, copy=False)
+        frame = pd.DataFrame(dict(enumerate(columns)), index=index, copy=False)
+        frame.columns = names
+        return frame
+
+    def _columns(self, value):
+        if isinstance(value, pd.Series):
+            return [value.to_numpy()]
+        return [value.iloc[:, i].to_numpy() for i in range(value.shape[1])]
+
+    def spill(self, value):
+        # Each column with a NumPy dtype is stored in its own file, so the
+        # value is stored by column. The index and other columns stay in
+        # memory.
+        if not isinstance(value, (pd.DataFrame, pd.Series)):
+            return None
+        dtypes = [value.dtype] if isinstance(value, pd.Series) else list(value.dtypes)
+        if any(not isinstance(dtype, np.dtype) for dtype in dtypes):
+            # Extension dtypes keep their data in other structures.
+            return None
+        columns = [column if column.dtype.hasobject else spill_array(column)\
+                for column in self._columns(value)]
+        if isinstance(value, pd.Series):
+            return pd.Series(columns[0], index=value.index, name=value.name, copy=False)
+        frame = pd.DataFrame(dict(enumerate(columns)), index=value.index, copy=False)
+        frame.columns = value.columns
+        return frame
+
     def split(self, start, end, value):
         if not isinstance(value, pd.DataFrame) and not isinstance(value, pd.Series):
             # Assume this is a constant (str, int, etc.).
@@ -46,6 +100,42 @@ class DataFrameSplit(SplitType):
             return None
         return len(value)
 
+    def bytes_per_element(self, value):
+        # Extension dtypes without a fixed width are counted as one pointer.
+        itemsize = lambda dtype: getattr(dtype, "itemsize", np.dtype(object).itemsize)
+        if isinstance(value, pd.DataFrame):
+            return sum(itemsize(dtype) for dtype in value.dtypes)
+        elif isinstance(value, pd.Series):
+            return itemsize(value.dtype)
+
+    def prefetchable(self):
+        return True
+
+    def allocate(self, piece, elements):
+        # Pieces are placed by position, so they must have a default index.
+        if not isinstance(piece, (pd.DataFrame, pd.Series)) or\
+                not piece.index.equals(pd.RangeIndex(len(piece))):
+            return None
+        dtypes = [piece.dtype] if isinstance(piece, pd.Series) else list(piece.dtypes)
+        if any(not isinstance(dtype, np.dtype) or dtype.hasobject for dtype in dtypes):
+            return None
+        return [shared_empty(elements, dtype) for dtype in dtypes]
+
+    def write(self, arrays, start, end, piece):
+        if isinstance(piece, pd.Series):
+            arrays[0][start:end] = piece.to_numpy()
+        else:
+            for (i, array) in enumerate(arrays):
+                array[start:end] = piece.iloc[:, i].to_numpy()
+
+    def assemble(self, arrays, piece):
+        index = pd.RangeIndex(len(arrays[0]))
+        if isinstance(piece, pd.Series):
+            return pd.Series(arrays[0], index=index, name=piece.name, copy=False)
+        frame = pd.DataFrame(dict(enumerate(arrays)), index=index, copy=False)
+        frame.columns = piece.columns
+        return frame
+
 class SumSplit(SplitType):
     def combine(self, values):
         return sum(values)
@@ -152,12 +242,13 @@ def series_str_contains(series, target):
     return result
 
 dfgroupby = sa((DataFrameSplit(), Broadcast()), {}, GroupBySplit())(dfgroupby)
-merge = sa((DataFrameSplit(), Broadcast()), {}, DataFrameSplit())(merge)
-filter = sa((DataFrameSplit(), Broadcast(), Broadcast()), {}, DataFrameSplit())(filter)
+# Joins may drop or repeat rows, so they are selective too.
+merge = sa((DataFrameSplit(), Broadcast()), {}, DataFrameSplit(), selective=True)(merge)
+filter = sa((DataFrameSplit(), Broadcast(), Broadcast()), {}, DataFrameSplit(), selective=True)(filter)
 
 # Return split type should be ApplySplit(subclass of DataFrameSplit), and it
 # should take the first argument as a parameter. The parameter is guaranteed to
 # be a dag.Operation.  The combiner can then use the `by` arguments to groupby
 # in the combiner again, and then apply again.
-gbapply = sa((GroupBySplit(), Broadcast()), {}, DataFrameSplit())(gbapply)
+gbapply = sa((GroupBySplit(), Broadcast()), {}, DataFrameSplit(), selective=True)(gbapply)
 gbsize = sa((GroupBySplit(), Broadcast()), {}, SizeSplit())(gbsize)
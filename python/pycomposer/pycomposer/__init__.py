@@ -1,7 +1,13 @@
 
-from .composer import sa, evaluate, mut
+from .composer import sa, evaluate, evaluate_async, mut
 from .split_types import SplitType, Broadcast
 from .vm.driver import STOP_ITERATION
+from .vm.options import Options
+from .vm.pool import WorkerPool, shutdown
+from .vm.remote import RemotePool, connect, disconnect, start_local_workers
+from .vm.spill import spill_array, spill_empty, spilled
+from .vm.transport import shared_empty
+from .vm.worker_objects import worker_initializer, worker_object, clear_worker_objects
 
 # Import the generics.
 from .split_types import A, B, C, D, E, F, G, H, I, J, K, L, M, N, O, P, Q, R, S, T, U, V, W, X, Y, Z
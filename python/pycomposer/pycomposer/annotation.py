@@ -23,9 +23,9 @@ class Annotation(object):
 
     """
 
-    __slots__ = [ "mutables", "arg_types", "return_type", "kwarg_types" ]
+    __slots__ = [ "mutables", "arg_types", "return_type", "kwarg_types", "selective" ]
 
-    def __init__(self, func, types, kwtypes, return_type):
+    def __init__(self, func, types, kwtypes, return_type, selective=False):
         """ Initialize an annotation for a function invocation with the given
         arguments.
 
@@ -35,6 +35,8 @@ class Annotation(object):
         func : the function that was invoked.
         types : the split types of the non-keyword arguments and return type.
         kwtypes : the split types of the keyword arguments.
+        selective : whether the function may return a different number of
+        elements than it was given (e.g., a filter or a join).
         
         """
 
@@ -82,6 +84,9 @@ class Annotation(object):
         # The return type. This can be None if the function doesn't return anything.
         self.return_type = return_type
 
+        # Whether the output of the function should be coalesced.
+        self.selective = selective
+
         # Dictionary of kwarg types.
         self.kwarg_types = dict()
         for (key, value) in kwtypes.items():
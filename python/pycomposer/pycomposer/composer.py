@@ -1,9 +1,11 @@
 
 from .annotation import Annotation, mut
-from .dag import LogicalPlan, evaluate_dag
+from .dag import LogicalPlan, Operation, evaluate_dag
 from .split_types import *
-from .vm.driver import DEFAULT_BATCH_SIZE
+from .unevaluated import UNEVALUATED
+from .vm.options import Options
 
+import asyncio
 import functools 
 
 import copy
@@ -14,7 +16,7 @@ _DAG = LogicalPlan()
 class sa(object):
     """ A splitability annotation."""
 
-    def __init__(self, types, kwtypes, return_type):
+    def __init__(self, types, kwtypes, return_type, selective=False):
         """ A splitability annotation.
 
         Parameters
@@ -29,13 +31,20 @@ class sa(object):
 
         return_type : split type of the value returned by this function.
 
+        selective : whether this function may return a different number of
+        elements than it receives (e.g., a filter or a join). The pieces it
+        returns are buffered until they reach a target size before they are
+        passed to later functions, and the values computed from them are not
+        preallocated.
+
         """
         self.types = types
         self.kwtypes = kwtypes
         self.return_type = return_type
+        self.selective = selective
 
     def __call__(self, func):
-        annotation = Annotation(func, self.types, self.kwtypes, self.return_type)
+        annotation = Annotation(func, self.types, self.kwtypes, self.return_type, self.selective)
 
         @functools.wraps(func)
         def _decorated(*args, **kwargs):
@@ -43,5 +52,81 @@ class sa(object):
 
         return _decorated
 
-def evaluate(workers=1, batch_size=DEFAULT_BATCH_SIZE, profile=False):
-    evaluate_dag(_DAG, workers, batch_size, profile)
+def evaluate(*args, **kwargs):
+    """ Evaluate the registered operations.
+
+    The options of the evaluation are given as arguments in the order of
+    `Options` (`workers`, `batch_size`, `profile`, ...) or as keyword
+    arguments such as `workers=4`. An `Options` object may be passed instead,
+    as the only positional argument or as `options`, and keyword arguments
+    then override its options. See `Options` for each option.
+
+    Returns a list with the run statistics of each pipeline.
+
+    """
+    return evaluate_dag(_DAG, _options(args, kwargs))
+
+def evaluate_async(*args, **kwargs):
+    """ Evaluate the registered operations without blocking the event loop.
+
+    Must be called from a coroutine. The operations registered so far are
+    evaluated on a background thread, with the same options as `evaluate`,
+    and operations registered afterwards belong to the next evaluation, so
+    several evaluations can be in flight at once. With `persistent`, they
+    share the worker pool (see `Options`).
+
+    Returns an awaitable for the run statistics of each pipeline. The
+    operations themselves are awaitable too: awaiting one resumes as soon as
+    the pipeline that computes it has committed its outputs, and returns its
+    value.
+
+    """
+    options = _options(args, kwargs)
+    loop = asyncio.get_running_loop()
+    plan = _DAG.detach()
+    operations = plan.operations()
+    for op in operations:
+        op._future = loop.create_future()
+
+    def committed(values):
+        loop.call_soon_threadsafe(_set_outputs, values.values())
+
+    future = loop.run_in_executor(None, functools.partial(evaluate_dag, plan, options,
+            committed))
+    future.add_done_callback(functools.partial(_finish_operations, operations))
+    return future
+
+def _options(args, kwargs):
+    """ Returns the options of an evaluation given to `evaluate`. """
+    options = kwargs.pop("options", None)
+    if len(args) > 0 and isinstance(args[0], Options):
+        if options is not None or len(args) > 1:
+            raise TypeError("options after an Options object must be given by keyword")
+        options = args[0]
+    elif options is None:
+        return Options(*args, **kwargs)
+    elif len(args) > 0:
+        raise TypeError("options must be given by keyword with an Options object")
+    return options.replace(**kwargs) if kwargs else options
+
+def _set_outputs(values):
+    """ Resolves the futures of the evaluated operations among values. """
+    for value in values:
+        if isinstance(value, Operation) and value._future is not None and\
+                not value._future.done() and value._output is not UNEVALUATED:
+            value._future.set_result(value._output)
+
+def _finish_operations(operations, future):
+    """ Resolves the futures of the operations of a finished evaluation. """
+    for op in operations:
+        if op._future.done():
+            continue
+        if future.cancelled():
+            op._future.cancel()
+        elif future.exception() is not None:
+            op._future.set_exception(future.exception())
+            # The error is reported by the evaluation's own future, so it
+            # should not also be logged for operations nobody awaited.
+            op._future.exception()
+        else:
+            op._future.set_result(op._output)
@@ -1,5 +1,6 @@
 
 from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import copy
 
 from .annotation import Annotation
@@ -10,8 +11,14 @@ from .vm.instruction import *
 from .vm.vm import VM
 from .vm import Program, Driver, STOP_ITERATION
 from .vm.driver import DEFAULT_BATCH_SIZE
+from .vm.affinity import worker_cpus
+from .vm.limits import threads_per_worker
+from .vm.options import Options
+from .vm.pool import default_pool
+from .vm.remote import remote_pool
 
 import functools
+import warnings
 
 class Operation:
     """ A lazily evaluated computation in the DAG.
@@ -41,6 +48,9 @@ class Operation:
 
         # Reference to the computed output.
         self._output = UNEVALUATED
+        # An asyncio future for the output, if the operation is evaluated with
+        # `evaluate_async`.
+        self._future = None
 
         # The pipeline this operator is a part of.
         self.pipeline = None
@@ -91,9 +101,9 @@ class Operation:
         
     def dependency_of(self, other):
         """ Returns whether self is a dependency of other. """
-        if self in other.args:
-            return True
-        elif self in other.kwargs.values():
+        # Compare by identity, since `in` would compare arguments such as
+        # arrays with `==`.
+        if any(arg is self for arg in other.all_args()):
             return True
         else:
             # Check if any of our mutable arguments appear in other.
@@ -115,9 +125,18 @@ class Operation:
 
         """
         if self._output is UNEVALUATED:
-            evaluate_dag(self._owner_ref, workers=workers)
+            evaluate_dag(self._owner_ref, Options(batch_size=DEFAULT_BATCH_SIZE))
         return self._output
 
+    def __await__(self):
+        """ Waits for the value of the operation without blocking the event
+        loop, if it is being evaluated with `evaluate_async`. Otherwise, the
+        DAG is evaluated as by `value`.
+        """
+        if self._future is not None:
+            return (yield from self._future)
+        return self.value
+
     def _str(self, depth):
         s = "{}@sa({}){}(...) (pipeline {})".format(
                 "  " * depth,
@@ -173,6 +192,23 @@ class LogicalPlan:
     def clear(self):
         """ Clear the operators in this DAG by removing its nodes. """
         self.roots = []
+
+    def detach(self):
+        """ Moves the operators in this DAG to a new DAG and returns it.
+
+        Operations registered afterwards are added to this DAG, so they are
+        not part of an evaluation of the detached one that is in progress.
+        """
+        plan = LogicalPlan()
+        plan.roots = self.roots
+        self.roots = []
+        return plan
+
+    def operations(self):
+        """ Returns a list of the operations in this DAG. """
+        operations = []
+        self.walk(lambda op, _: operations.append(op), None, mode="bottomup")
+        return operations
     
     def register(self, func, args, kwargs, annotation):
         """ Register a function invocation along with its annotation.
@@ -350,6 +386,7 @@ class LogicalPlan:
             kwargs = {}
             for (i, arg) in enumerate(op.args):
                 valnum = vm.get(arg)
+                valnum = vm.coalesced.get(valnum, valnum)
                 if valnum is None:
                     valnum = vm.register_value(arg)
                     ty = op.split_type_of(i)
@@ -359,6 +396,7 @@ class LogicalPlan:
 
             for (key, value) in op.kwargs.items():
                 valnum = vm.get(value)
+                valnum = vm.coalesced.get(valnum, valnum)
                 if valnum is None:
                     valnum = vm.register_value(value)
                     ty = op.split_type_of(key)
@@ -369,13 +407,24 @@ class LogicalPlan:
             result = vm.register_value(op)
             # In this context, mutability just means we need to merge objects.
             setattr(op.annotation.return_type, "mutable", not op.dontsend)
-            vm.program.insts.append(Call(result, op.func, args, kwargs, op.annotation.return_type))
+            # The VM may pass its own buffer as `out` if the caller did not.
+            out_capable = "out" in op.annotation.kwarg_types and "out" not in op.kwargs
+            vm.program.insts.append(Call(result, op.func, args, kwargs, op.annotation.return_type,
+                out_capable=out_capable, selective=op.annotation.selective))
+
+            if op.annotation.selective:
+                # Buffer the small pieces of the result for later calls.
+                ty = copy.deepcopy(op.annotation.return_type)
+                setattr(ty, "mutable", False)
+                vm.program.insts.append(Coalesce(vm.register_coalesced(result), result, ty))
             added.add(op)
 
         # programs: Maps Pipeline IDs to VM Programs.
         # arg_id_to_ops: Maps Arguments to ops. Store separately so we don't serialize ops.
         vms = (set(), defaultdict(lambda: VM()))
         self.walk(construct, vms, mode="bottomup")
+        for vm in vms[1].values():
+            vm.program.remove_invalid_coalescing(vm.values)
         return sorted(list(vms[1].items()))
 
 
@@ -383,11 +432,27 @@ class LogicalPlan:
     def commit(values, results):
         """
         Commit outputs into the DAG nodes so programs can access data.
+
+        Operations computed by earlier pipelines keep their outputs.
         """
         for (arg_id, value) in values.items():
-            if isinstance(value, Operation):
+            if isinstance(value, Operation) and value._output is UNEVALUATED:
                 value._output = results[arg_id]
 
+    @staticmethod
+    def materialize(vm):
+        """
+        Returns the values of a VM, with the Operations that it splits (i.e.,
+        the outputs of earlier pipelines) replaced by their outputs.
+        """
+        values = dict(vm.values)
+        for inst in vm.program.insts:
+            if isinstance(inst, Split):
+                value = values[inst.target]
+                if isinstance(value, Operation) and value._output is not UNEVALUATED:
+                    values[inst.target] = value._output
+        return values
+
     def __str__(self):
         roots = []
         for root in self.roots:
@@ -395,26 +460,133 @@ class LogicalPlan:
         return "\n".join(roots)
 
 
-def evaluate_dag(dag, workers=1, batch_size=DEFAULT_BATCH_SIZE, profile=False):
+def pipeline_dependencies(vms):
+    """
+    Returns, for each VM in a list, the indices of the earlier VMs that it
+    must run after.
+
+    A pipeline depends on an earlier one if it splits a value the earlier
+    one computes, or if both split the same value and either may mutate it.
+    Pipelines with no dependency between them can run at the same time.
+
+    """
+    # For each VM, the ids of the Operations it computes, and maps the ids of
+    # the values it splits to whether it may mutate them.
+    computed = []
+    split = []
+    for vm in vms:
+        computed.append(set(id(vm.values[inst.target]) for inst in vm.program.insts\
+                if isinstance(inst, Call)))
+        splits = {}
+        for inst in vm.program.insts:
+            if isinstance(inst, Split):
+                key = id(vm.values[inst.target])
+                splits[key] = splits.get(key, False) or inst.ty.mutable
+        split.append(splits)
+
+    dependencies = []
+    for (j, splits) in enumerate(split):
+        dependencies.append(set())
+        for i in range(j):
+            for (key, mutable) in splits.items():
+                if key in computed[i] or\
+                        (key in split[i] and (mutable or split[i][key])):
+                    dependencies[j].add(i)
+                    break
+    return dependencies
+
+def evaluate_dag(dag, options=None, committed=None):
+    """ Evaluates a DAG with the given `Options` and returns the run
+    statistics of each pipeline.
+
+    Pipelines that do not depend on each other run at the same time only
+    when the evaluation runs on a pool; otherwise they run in order.
+    `committed`, if given, is called with the values of each pipeline as
+    soon as its outputs are committed to its operations. It may be called
+    from another thread.
+
+    """
+    if options is None:
+        options = Options()
     try:
         dag.infer_types()
     except (SplitTypeError) as e:
         print(e)
 
-    vms = dag.to_vm()
-    for _, vm in vms:
-
+    vms = [vm for (_, vm) in dag.to_vm()]
+    pool = None
+    if options.backend == "remote":
+        pool = remote_pool()
+    elif options.persistent and options.workers > 1 and options.backend == "processes":
+        pool = default_pool(options.workers, options.start_method)
+    if pool is None and (options.priority != 0 or options.weight != 1.0):
+        warnings.warn("priority and weight only apply to evaluations on a shared pool "
+                "(persistent with several workers, or the remote backend); ignoring them",
+                RuntimeWarning)
+
+    def run(vm, options):
         # print(vm.program)
+        driver = Driver(options, pool=pool)
+        results = driver.run(vm.program, dag.materialize(vm))
+        dag.commit(vm.values, results)
+        if committed is not None:
+            committed(vm.values)
+        return driver.stats
+
+    try:
+        if pool is None:
+            return [run(vm, options) for vm in vms]
+        return _run_concurrently(vms, pool, options, run)
+    finally:
+        # A failed run should not leave its operations in the DAG.
+        dag.clear()
+
+def _run_concurrently(vms, pool, options, run):
+    """
+    Runs pipelines that do not depend on each other at the same time on the
+    pool, which interleaves their chunks with those of other evaluations.
 
-        driver = Driver(workers=workers, batch_size=batch_size, optimize_single=True, profile=profile)
-        results = driver.run(vm.program, vm.values)
+    Pipelines at the same depth of the dependency graph split the workers
+    evenly. A pipeline's job leaves the pool as soon as its workers finish,
+    so the pipelines running at the same time get its workers while it
+    merges their results. A pipeline that depends on another still waits
+    for that pipeline's merge to finish before it starts. Returns the
+    statistics of each pipeline.
 
-        dag.commit(vm.values, results)
-        # TODO We need to update vm.values in the remaining programs to use the
-        # materialized data in _DAG.operation.
-        #
-        # If in the future we see something like "object dag.Operation does not
-        # have method <annotated method>" in a multi-stage program, that's why!
-        pass
-
-    dag.clear()
+    """
+    if len(vms) == 0:
+        return []
+    dependencies = pipeline_dependencies(vms)
+    depths = []
+    for deps in dependencies:
+        depths.append(1 + max([depths[i] for i in deps], default=-1))
+    # The number of pipelines at each depth, and the position of each
+    # pipeline among them.
+    width = defaultdict(int)
+    rank = []
+    for depth in depths:
+        rank.append(width[depth])
+        width[depth] += 1
+
+    # Pipelines share the machine, so their CPUs and library threads are
+    # chosen for all of the pool's workers.
+    workers = options.workers
+    cpus = worker_cpus(workers, options.affinity) if options.affinity is not None else None
+    library_threads = threads_per_worker(workers, options.library_threads)
+
+    def run_pipeline(j):
+        for i in dependencies[j]:
+            futures[i].result()
+        (share, extra) = divmod(workers, width[depths[j]])
+        first = rank[j] * share + min(rank[j], extra)
+        share = max(1, share + int(rank[j] < extra))
+        # Pipelines at the same depth are pinned to different CPUs.
+        pipeline_cpus = cpus[first:first + share] if cpus is not None else None
+        return run(vms[j], options.replace(workers=share, affinity=pipeline_cpus or cpus,
+                library_threads=library_threads))
+
+    with ThreadPoolExecutor(len(vms)) as executor:
+        futures = []
+        for j in range(len(vms)):
+            futures.append(executor.submit(run_pipeline, j))
+        return [future.result() for future in futures]
@@ -2,7 +2,6 @@
 
 from abc import ABC, abstractmethod
 import copy
-import numpy as np
 
 class SplitTypeError(TypeError):
     """ Custom type error for when annotation types cannot be propagated.
@@ -40,6 +39,90 @@ class SplitType(ABC):
         """
         return len(value)
 
+    def bytes_per_element(self, value):
+        """ Returns the number of bytes a single element of value occupies in
+        a split piece.
+
+        The driver uses this to size batches so that the pieces live in a
+        batch fit in cache. This function should return `None` if the size is
+        not known, or if the value is not split into pieces.
+
+        The default implementation returns `None`.
+
+        """
+        return None
+
+    def combines_pieces(self):
+        """ Returns whether `combine` uses the pieces of values of this type.
+
+        If this returns `False`, the pieces returned by calls are only read by
+        later calls in the same batch, so the VM may recycle their buffers.
+
+        The default implementation returns `True`.
+
+        """
+        return True
+
+    def prefetchable(self):
+        """ Returns whether this type's splitter may run ahead of the calls
+        that consume its pieces.
+
+        When prefetching is enabled, the driver runs the splitters for the
+        next batch on a helper thread while the calls for the current batch
+        execute. A splitter is only safe to prefetch if it does not depend on
+        values written by calls in the same pipeline and if it can run on a
+        thread other than the one executing the calls.
+
+        The default implementation returns `False`.
+
+        """
+        return False
+
+    def spill(self, value):
+        """ Returns a copy of a piece or partial value stored on disk, or
+        `None` if the value cannot be spilled.
+
+        When the pieces of a merged value take more memory than the driver's
+        `spill_bytes`, they are replaced by their spilled copies, which are
+        passed to `combine` along with the pieces that were not spilled.
+        Types that implement this should store arrays with
+        `pycomposer.spill_array` or `pycomposer.spill_empty`, which are passed
+        between processes by file, and should combine spilled pieces into a
+        spilled value without loading them all at once.
+
+        The default implementation returns `None`.
+
+        """
+        return None
+
+    def allocate(self, piece, elements):
+        """ Allocates storage for a merged value with `elements` elements.
+
+        Types that implement this let the driver allocate a value's storage
+        once, before the pipeline runs, and have workers write each piece
+        directly into its range with `write`. `combine` is then not called
+        for the value. `piece` is the first piece of the value, which fixes
+        its dtype and shape.
+
+        This function should return a list of arrays allocated with
+        `pycomposer.shared_empty`, so that worker processes can write into
+        them, or `None` if the value cannot be preallocated.
+
+        The default implementation returns `None`.
+
+        """
+        return None
+
+    def write(self, arrays, start, end, piece):
+        """ Writes the piece of elements [start, end) into the arrays returned
+        by `allocate`. """
+        raise NotImplementedError
+
+    def assemble(self, arrays, piece):
+        """ Returns the merged value whose data is in the arrays returned by
+        `allocate`. `piece` is the piece that was passed to `allocate`. """
+        raise NotImplementedError
+
     @abstractmethod
     def combine(self, values):
         """Combine a list of values into a single merged value."""
@@ -210,6 +293,9 @@ class Broadcast(SplitType):
     def elements(self, _):
         return None
 
+    def prefetchable(self):
+        return True
+
     def __str__(self): return "broadcast"
 
 # Convinience functions for creating named generics.
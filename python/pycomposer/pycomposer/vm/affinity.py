@@ -0,0 +1,94 @@
+
+import glob
+import os
+
+# Where Linux exposes the NUMA topology.
+_SYSFS_NODES = "/sys/devices/system/node"
+
+def _parse_cpulist(cpulist):
+    """ Parses a sysfs CPU list such as "0-3,8-11" into a set of CPUs. """
+    cpus = set()
+    for part in cpulist.strip().split(","):
+        if part == "":
+            continue
+        if "-" in part:
+            (first, last) = part.split("-")
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+def _allowed_cpus():
+    """ Returns the CPUs this process may run on. """
+    if hasattr(os, "sched_getaffinity"):
+        return os.sched_getaffinity(0)
+    return set(range(os.cpu_count() or 1))
+
+def numa_nodes():
+    """ Returns the set of CPUs of each NUMA node that this process may use.
+
+    The topology is read from `/sys/devices/system/node` on Linux. If it
+    cannot be read, all CPUs are treated as one node.
+
+    """
+    allowed = _allowed_cpus()
+    nodes = []
+    paths = glob.glob(os.path.join(_SYSFS_NODES, "node[0-9]*"))
+    for path in sorted(paths, key=lambda path: int(os.path.basename(path)[4:])):
+        try:
+            with open(os.path.join(path, "cpulist")) as f:
+                cpus = _parse_cpulist(f.read()) & allowed
+        except (OSError, ValueError):
+            continue
+        if len(cpus) > 0:
+            nodes.append(cpus)
+    if len(nodes) == 0:
+        nodes.append(set(allowed))
+    return nodes
+
+def worker_cpus(workers, policy):
+    """ Returns the set of CPUs to pin each worker to.
+
+    Workers are assigned to NUMA nodes in contiguous blocks, so that workers
+    with neighboring partitions share a node.
+
+    Parameters
+    ----------
+
+    workers : the number of workers.
+    policy : "numa" pins each worker to all CPUs of its node, "cores" pins
+    each worker to a single CPU of its node, and a list gives the CPUs of
+    each worker explicitly.
+
+    """
+    if not isinstance(policy, str):
+        return [set(cpus) for cpus in policy]
+    assert policy in ("numa", "cores"), "unknown affinity policy {}".format(policy)
+
+    nodes = numa_nodes()
+    assignment = []
+    # Number of workers placed on each node so far.
+    placed = [0] * len(nodes)
+    for worker in range(workers):
+        node = worker * len(nodes) // workers
+        cpus = sorted(nodes[node])
+        if policy == "numa":
+            assignment.append(set(cpus))
+        else:
+            assignment.append(set([cpus[placed[node] % len(cpus)]]))
+        placed[node] += 1
+    return assignment
+
+def pin(cpus):
+    """ Pins the calling thread to a set of CPUs, if the platform allows it.
+
+    Returns whether the thread was pinned.
+
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        return False
+    try:
+        os.sched_setaffinity(0, cpus)
+        return True
+    except (OSError, ValueError):
+        return False
@@ -0,0 +1,58 @@
+
+from collections import defaultdict
+import sys
+
+class BufferPool:
+    """
+    A per-worker pool of scratch arrays for pipeline temporaries.
+
+    Calls that accept an `out` argument are handed a buffer from the pool
+    instead of allocating a new result on every batch. Once the last
+    instruction in a batch that reads a temporary has run, its buffer is
+    returned to the pool, so steady-state batches do not allocate.
+
+    """
+
+    __slots__ = [ "free", "specs", "allocations" ]
+
+    def __init__(self):
+        # Free buffers, keyed by (shape, dtype).
+        self.free = defaultdict(list)
+        # Maps (target, argument signature) to the (shape, dtype) of the
+        # result, learned from the first batch with that signature.
+        self.specs = {}
+        # Number of buffers allocated by the pool.
+        self.allocations = 0
+
+    @staticmethod
+    def signature(args, kwargs):
+        """ Returns a hashable description of the arguments of a call.
+
+        Calls with the same signature produce results of the same shape and
+        type.
+
+        """
+        # Values can only be arrays if NumPy was imported (see
+        # `transport._numpy`).
+        np = sys.modules.get("numpy")
+        def describe(value):
+            if np is not None and isinstance(value, np.ndarray):
+                return (value.shape, value.dtype.str)
+            return type(value)
+        return (tuple(describe(arg) for arg in args),
+                tuple((name, describe(value)) for (name, value) in sorted(kwargs.items())))
+
+    def acquire(self, shape, dtype):
+        """ Returns a free buffer of the given shape and type. """
+        free = self.free[(shape, dtype)]
+        if len(free) > 0:
+            return free.pop()
+        self.allocations += 1
+        import numpy as np
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, buf):
+        """ Returns a buffer to the pool. """
+        np = sys.modules.get("numpy")
+        if np is not None and isinstance(buf, np.ndarray) and buf.base is None:
+            self.free[(buf.shape, buf.dtype)].append(buf)
@@ -2,28 +2,67 @@
 from collections import defaultdict
 import pickle
 
+from .buffers import BufferPool
+from .frame import Frame
+from .limits import threads_per_worker, ThreadLimits
+from .prefetch import Prefetcher
+from .scheduler import ChunkScheduler
+from .sizing import cache_size, auto_batch_size, choose_workers, fit_memory,\
+        resident_bytes, BatchController
+from .spill import Spiller, nbytes, reclaim, run_directory, spilled, use_directory
+from .transport import Export, attach, dumps_by_reference, share_result, load_result
+from .affinity import pin, worker_cpus
+
+import cloudpickle
+
+import concurrent.futures
 import multiprocessing
 #import multiprocessing.dummy as multiprocessing
 
+import os
 import threading
 import time
+import warnings
 
 STOP_ITERATION = "stop"
+# Returned by instructions whose consumers should not run in this batch.
+DEFERRED = "deferred"
 
-# Global reference to values. These should be in read-only shared memory with
-# all child processes.
-_VALUES = None
-# Global reference to program currently being executed.
-_PROGRAM = None
-# Batch size to use.
-_BATCH_SIZE = None
+class _Published(threading.local):
+    """
+    The program being executed and its values, set by `_publish`.
+
+    The state is per-thread, so that several drivers can run pipelines at
+    the same time in one process. Worker processes fork from the thread that
+    publishes, and thread workers publish the driver's state themselves.
 
-# Size of the L2 Cache (TODO read this from somewhere)
+    """
+    # Reference to values. These should be in read-only shared memory with
+    # all child processes.
+    values = None
+    # Reference to program currently being executed.
+    program = None
+    # Batch size to use.
+    batch_size = None
+    # Execution options (see Driver.worker_options).
+    options = None
+    # Maps targets to their split type and preallocated arrays.
+    outputs = None
+
+_PUBLISHED = _Published()
+
+# Size of the L2 Cache, used if the cache size cannot be read from the system.
 CACHE_SIZE = 252144
+# Cache level whose size bounds automatically chosen batch sizes.
+DEFAULT_CACHE_LEVEL = 2
 # Default batch size if we don't know anything
 DEFAULT_BATCH_SIZE = 4096 * 4 * 4
+# Estimated time in seconds to hand work to one worker and collect its
+# result, by how the workers run.
+WORKER_OVERHEAD = { "threads": 1e-4, "interpreters": 1e-2, "pool": 1e-3, "forked": 2e-2,
+        "remote": 5e-2 }
 
-def _worker(worker_id, index_range):
+def _worker(worker_id, index_range, segment=None):
     """
     A multiprocessing worker.
 
@@ -37,13 +76,106 @@ def _worker(worker_id, index_range):
     worker_id : the thread ID of this worker.
     index_range : A range 
     and the master.
+    segment : the name of the segment to return the result in (see
+    `share_result`).
 
     """
-    result = _run_program(worker_id, index_range)
-    return result
+    # Native libraries in each worker process share the CPUs with the others.
+    with ThreadLimits(_PUBLISHED.options["library_threads"]):
+        (result, stats) = _run_pinned(worker_id, index_range)
+    if _PUBLISHED.options["remote"]:
+        # Remote workers do not share memory with the driver.
+        return result, stats
+    # Return large buffers through shared memory instead of pickling them.
+    return share_result(result, segment), stats
+
+def _run_pinned(worker_id, index_range):
+    """
+    Runs `_run_program` with the calling thread pinned to the CPUs of the
+    worker, if the driver was given an affinity.
+
+    The previous affinity is restored afterwards, since the thread may be
+    reused for other work.
+
+    """
+    cpus = _PUBLISHED.options["affinity"]
+    if cpus is None:
+        return _run_program(worker_id, index_range)
+    previous = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else None
+    pin(cpus[worker_id % len(cpus)])
+    try:
+        return _run_program(worker_id, index_range)
+    finally:
+        if previous is not None:
+            pin(previous)
+
+def _export_job(program, values, batch_size, options, outputs):
+    """
+    Prepares a job for workers that do not share the driver's memory.
+
+    Such workers do not inherit the published globals, so they are sent the
+    program and descriptors of its values and outputs (see
+    `transport.Export`), and map the values from shared memory.
+
+    Returns the Export of the job and the pickled job. Jobs for remote workers
+    carry the values themselves, whole, since any worker may be given any
+    chunk, and have no Export.
+
+    """
+    split_values, mutable = program.split_values(values)
+    if options["remote"]:
+        if len(mutable) > 0:
+            raise ValueError("remote workers cannot write into their inputs; "
+                    "return new values instead")
+        assert len(outputs) == 0, "outputs cannot be preallocated for remote workers"
+        return None, dumps_by_reference((program, split_values, batch_size, options, {}))
+    for (target, (_, arrays)) in outputs.items():
+        for (i, array) in enumerate(arrays):
+            split_values[("output", target, i)] = array
+    export = Export(split_values, mutable)
+    types = dict((target, (ty, len(arrays))) for (target, (ty, arrays)) in outputs.items())
+    payload = cloudpickle.dumps((program, export.descriptors, batch_size, options, types))
+    return export, payload
+
+def _load_job(payload, segments):
+    """
+    Rebuilds a job prepared by `_export_job`, mapping its segments into
+    `segments`. Returns the arguments for `_publish`.
+    """
+    (program, descriptors, batch_size, options, types) = pickle.loads(payload)
+    values = attach(descriptors, segments)
+    outputs = {}
+    for (target, (ty, count)) in types.items():
+        outputs[target] = (ty, [values.pop(("output", target, i)) for i in range(count)])
+    return (program, values, batch_size, options, outputs)
+
+def _batches(index_range, batch_size):
+    """ Yields the (start, end) pieces of an index range, clamped to the range.
+
+    batch_size is either a fixed batch size or a BatchController, whose
+    current size is read before each batch.
+
+    An empty range still yields one empty batch, so that the program's calls
+    run once and its merged values have a (possibly empty) piece to combine.
+
+    """
+    piece_start = index_range[0]
+    if piece_start >= index_range[1]:
+        yield (piece_start, piece_start)
+        return
+    while piece_start < index_range[1]:
+        if isinstance(batch_size, BatchController):
+            size = batch_size.size
+        else:
+            size = batch_size
+        yield (piece_start, min(piece_start + size, index_range[1]))
+        piece_start += size
 
 def _run_program(worker_id, index_range):
     """Runs the global program to completion and return partial values.
+
+    Returns the partial values along with a dictionary of statistics about
+    the run.
     
     Parameters
     ----------
@@ -51,39 +183,81 @@ def _run_program(worker_id, index_range):
     worker_id : the ID of this worker.
     program : the program to execute.
     """
-    global _VALUES
-    global _PROGRAM
-    global _BATCH_SIZE
+    program = _PUBLISHED.program
+    values = _PUBLISHED.values
+    options = _PUBLISHED.options
 
-    print("Thread", worker_id, "range:", index_range, "batch size:", _BATCH_SIZE)
+    print("Thread", worker_id, "range:", index_range, "batch size:", _PUBLISHED.batch_size)
     start = time.time()
 
     context = defaultdict(list)
+    batch_size = _PUBLISHED.batch_size
     just_parallel = False
     if just_parallel:
-        _BATCH_SIZE = index_range[1] - index_range[0]
-        piece_start = index_range[0]
-        piece_end = index_range[1] 
+        batch_size = index_range[1] - index_range[0]
+
+    # Per-worker state, so workers can share the program.
+    pool = BufferPool() if options["recycle"] else None
+    frame = Frame(worker_id, coalesce_elements=options["coalesce_elements"] or batch_size,
+            pool=pool, outputs=_PUBLISHED.outputs)
+
+    spiller = None
+    # Workers of a persistent pool must not keep the directory of an earlier
+    # job, which is removed when that job ends.
+    use_directory(None)
+    if options["spill"] is not None:
+        (spill_directory, threshold) = options["spill"]
+        use_directory(spill_directory)
+        types = program.merged_types()
+        for target in frame.outputs:
+            types.pop(target, None)
+        spiller = Spiller(types, threshold)
+
+    adaptive = options["adaptive"]
+    if adaptive:
+        batch_size = BatchController(batch_size)
+    # Size of each batch that was processed.
+    batch_sizes = []
+
+    batches = _batches(index_range, batch_size)
+    if options["prefetch"] and program.prefetchable():
+        # Split batch i+1 on a helper thread while batch i computes.
+        prefetcher = Prefetcher(program, frame, batches, values)
+        try:
+            for (piece_start, piece_end, pieces) in prefetcher:
+                batch_start = time.perf_counter()
+                for (target, piece) in pieces.items():
+                    context[target].extend(piece)
+                program.call(frame, piece_start, piece_end, values, context)
+                program.write_outputs(frame, piece_start, piece_end, context)
+                if spiller is not None:
+                    spiller.update(context)
+                if adaptive:
+                    batch_size.record(piece_end - piece_start, time.perf_counter() - batch_start)
+                batch_sizes.append(piece_end - piece_start)
+        finally:
+            # A call that raises leaves the iterator suspended, so the helper
+            # thread would keep splitting until it is garbage collected.
+            prefetcher.stop()
     else:
-        piece_start = index_range[0]
-        piece_end = piece_start + _BATCH_SIZE
-
-    _PROGRAM.set_range_end(index_range[1])
-
-    while _PROGRAM.step(worker_id, piece_start, piece_end, _VALUES, context):
-        piece_start += _BATCH_SIZE
-        piece_end += _BATCH_SIZE
-        # Clamp to the range assigned to this thread.
-
-        if piece_start >= index_range[1]:
-            break
-        elif piece_end > index_range[1]:
-            piece_end = index_range[1]
+        for (piece_start, piece_end) in batches:
+            batch_start = time.perf_counter()
+            if not program.step(frame, piece_start, piece_end, values, context):
+                break
+            program.write_outputs(frame, piece_start, piece_end, context)
+            if spiller is not None:
+                spiller.update(context)
+            if adaptive:
+                batch_size.record(piece_end - piece_start, time.perf_counter() - batch_start)
+            batch_sizes.append(piece_end - piece_start)
+
+    # Run the consumers of pieces still buffered after selective calls.
+    program.flush(frame, values, context)
 
     process_end = time.time()
 
     # Free non-shared memory on this worker.
-    _merge(_PROGRAM, context)
+    _merge(program, context)
 
     merge_end = time.time()
 
@@ -93,7 +267,33 @@ def _run_program(worker_id, index_range):
             merge_end - process_end,
             merge_end - start))
 
-    return context
+    stats = {
+        "worker": worker_id,
+        "range": index_range,
+        "batch_sizes": batch_sizes,
+        "allocations": pool.allocations if pool is not None else None,
+        "processing": process_end - start,
+        "merge": merge_end - process_end,
+    }
+    return context, stats
+
+def _publish(program, values, batch_size, options, outputs=None):
+    """ Makes a program and its values accessible to `_run_program` on the
+    calling thread. """
+    _PUBLISHED.values = values
+    _PUBLISHED.program = program
+    _PUBLISHED.batch_size = batch_size
+    _PUBLISHED.options = options
+    _PUBLISHED.outputs = outputs
+
+def _published():
+    """ Returns the arguments of the last `_publish` on the calling thread. """
+    return (_PUBLISHED.program, _PUBLISHED.values, _PUBLISHED.batch_size,
+            _PUBLISHED.options, _PUBLISHED.outputs)
+
+def _unpublish():
+    """ Clears the references set by `_publish`. """
+    _publish(None, None, None, None)
 
 def _merge(program, context):
     """
@@ -108,7 +308,10 @@ def _merge(program, context):
             continue
         else:
             merged.add(inst.target)
-            if inst.ty is not None:
+            if _PUBLISHED.outputs and inst.target in _PUBLISHED.outputs:
+                # Already written into its preallocated output.
+                context[inst.target] = None
+            elif inst.ty is not None:
                 if inst.ty.mutable:
                     context[inst.target] = inst.ty.combine(context[inst.target])
                 else:
@@ -116,27 +319,126 @@ def _merge(program, context):
                     # and should not have changed on the master process.
                     context[inst.target] = None
 
+def _reduce(program, partial_results):
+    """
+    Combines a list of partial results, in element order, into one partial
+    result.
+    """
+    result = defaultdict(list)
+    for partial_result in partial_results:
+        if partial_result is not None:
+            for (key, value) in partial_result.items():
+                # Don't add unnecessary None values.
+                if value is not None:
+                    result[key].append(value)
+
+    _merge(program, result)
+    return result
+
+def _reduce_worker(handles, segment=None):
+    """ Combines partial results returned by other workers (see `_reduce`),
+    returning the result in the named segment (see `share_result`). """
+    partial_results = [load_result(handle) for handle in handles]
+    # Results combined from spilled pieces are spilled to the job's directory.
+    spill = _PUBLISHED.options["spill"]
+    use_directory(spill[0] if spill is not None else None)
+    result = _reduce(_PUBLISHED.program, partial_results)
+    if _PUBLISHED.options["remote"]:
+        return result
+    return share_result(result, segment)
+
+def _in_order(chunk_results):
+    """
+    Sorts (chunk, (partial result, stats)) pairs by the start of each chunk.
+
+    Returns the partial results and the stats as separate lists.
+
+    """
+    # Combine in element order, whichever worker ran each chunk.
+    chunk_results = sorted(chunk_results, key=lambda chunk_result: chunk_result[0][0])
+    partial_results = [partial_result for (_, (partial_result, _)) in chunk_results]
+    stats = [stats for (_, (_, stats)) in chunk_results]
+    return partial_results, stats
+
+def _reduce_tree(partial_results, fanin, reduce_groups):
+    """
+    Reduces partial results in a tree before the final combine.
+
+    Groups of `fanin` neighboring results are combined in parallel by
+    `reduce_groups`, which takes a list of groups and returns one result per
+    group, until at most `fanin` results remain. Each level only combines
+    neighbors, so the results stay in element order.
+
+    Returns the remaining results and the number of levels.
+
+    """
+    levels = 0
+    while fanin is not None and len(partial_results) > fanin:
+        groups = [partial_results[i:i + fanin] for i in range(0, len(partial_results), fanin)]
+        partial_results = reduce_groups(groups)
+        levels += 1
+    return partial_results, levels
+
 class Driver:
     """
     Parallel driver and scheduler for the virtual machine.
     """
 
-    __slots__ = [ "workers", "batch_size", "optimize_single", "profile" ]
+    __slots__ = [ "options", "workers", "optimize_single", "pool", "backend", "cpus",
+            "library_threads", "spill_directory", "stats" ]
 
-    def __init__(self, workers=1, batch_size=DEFAULT_BATCH_SIZE, optimize_single=True, profile=False):
-        self.workers = workers
-        self.batch_size = batch_size
+    def __init__(self, options, pool=None, optimize_single=True):
+        # The Options of the run. The fields below are derived from them, and
+        # may be lowered for a program by `run`.
+        self.options = options
         self.optimize_single = optimize_single
-        self.profile = profile
-        if self.profile:
+        # A WorkerPool or RemotePool to run on. If None, a process pool is
+        # forked per run.
+        self.pool = pool
+        backend = options.backend
+        if backend == "interpreters":
+            # Imported here since the module imports this one.
+            from .interpreters import available
+            if not available():
+                warnings.warn("subinterpreters with their own GIL are not available; "
+                        "using the processes backend", RuntimeWarning)
+                backend = "processes"
+            elif options.prefetch or options.preallocate:
+                # See `interpreters.run`.
+                warnings.warn("subinterpreters cannot prefetch or preallocate; "
+                        "ignoring these options", RuntimeWarning)
+        self.backend = backend
+        assert backend != "remote" or pool is not None, "the remote backend needs a RemotePool"
+        # The number of workers, the CPUs to pin each worker to (see
+        # `affinity.worker_cpus`) or None to let the OS place workers, and the
+        # number of threads native libraries (BLAS, OpenMP, ...) may use in
+        # each worker or None to not limit them. The driver's own thread is
+        # not pinned.
+        self.set_workers(options.workers)
+        # The directory of the spill files of the current run (see
+        # `spill.run_directory`), or None if the run does not spill.
+        self.spill_directory = None
+        # Statistics about the last run.
+        self.stats = None
+        if options.profile:
             assert self.workers == 1, "Profiling only supported on single thread"
             assert self.optimize_single, "Profiling only supported with optimize_single=True"
 
-    def get_partitions(self, total_elements):
+    def set_workers(self, workers):
+        """ Sets the number of workers, and the CPUs and library threads of
+        each worker, which depend on it. """
+        self.workers = workers
+        self.cpus = worker_cpus(workers, self.options.affinity)\
+                if self.options.affinity is not None else None
+        self.library_threads = threads_per_worker(workers, self.options.library_threads)
+
+    def get_partitions(self, total_elements, workers=None):
         """ Returns a list of index ranges to process for each worker. """
+        if workers is None:
+            workers = self.workers
         ranges = []
-        for tid in range(self.workers):
-            elements = total_elements // self.workers
+        for tid in range(workers):
+            elements = total_elements // workers
             if elements == 0 and tid != 0:
                 ranges.append(None)
                 continue
@@ -147,85 +449,340 @@ class Driver:
             else:
                 # Round up
                 elements = total_elements //\
-                        self.workers + int(total_elements % self.workers != 0)
+                        workers + int(total_elements % workers != 0)
 
             thread_start = elements * tid
             thread_end = min(total_elements, elements * (tid + 1))
             ranges.append((thread_start, thread_end))
 
         return ranges
-        
+
+    def get_batch_size(self, program, values):
+        """ Returns the batch size to use for the program. """
+        if self.options.batch_size is not None:
+            return self.options.batch_size
+        cache_bytes = cache_size(self.options.cache_level, default=CACHE_SIZE)
+        return auto_batch_size(program, values, cache_bytes, DEFAULT_BATCH_SIZE)
+
+    def fit_memory(self, program, values, elements, batch_size):
+        """ Returns the number of workers, batch size, and estimated bytes of
+        a run of the program that fits in the memory limit. """
+        return fit_memory(self.options.memory_limit, elements, program.bytes_per_element(values),
+                program.merged_bytes_per_element(values), resident_bytes() or 0, batch_size,
+                self.workers)
+
+    def worker_options(self):
+        """ Returns the execution options that are passed to workers. """
+        return {
+            "prefetch": self.options.prefetch,
+            "adaptive": self.options.adaptive,
+            "recycle": self.options.recycle,
+            "coalesce_elements": self.options.coalesce_elements,
+            "affinity": self.cpus,
+            "library_threads": self.library_threads,
+            "remote": self.backend == "remote",
+            # Remote workers cannot write to the driver's spill directory.
+            "spill": (self.spill_directory, self.options.spill_bytes)\
+                    if self.spill_directory is not None and self.backend != "remote" else None,
+        }
+
+    def worker_overhead(self):
+        """ Returns the estimated per-worker overhead of the backend. """
+        if self.backend in ("threads", "interpreters", "remote"):
+            return WORKER_OVERHEAD[self.backend]
+        elif self.pool is not None:
+            return WORKER_OVERHEAD["pool"]
+        return WORKER_OVERHEAD["forked"]
+
+    def probe(self, elements, batch_size):
+        """ Runs the first batch of the published program in-process and
+        chooses the number of workers for the remaining elements.
+
+        Returns the result of the first batch and the number of workers.
+
+        """
+        probe_end = min(elements, batch_size)
+        result, stats = _run_program(0, (0, probe_end))
+        self.stats["workers"].append(stats)
+        if probe_end == 0 or probe_end == elements:
+            return result, 1
+        if not self.options.auto_workers:
+            return result, self.workers
+
+        # Partial results are copied when they are sent back by processes.
+        merge_time = stats["merge"]
+        if self.backend != "threads":
+            start = time.time()
+            load_result(share_result(result))
+            merge_time += time.time() - start
+
+        element_cost = stats["processing"] / probe_end
+        merge_cost = merge_time / probe_end
+        workers = choose_workers(elements - probe_end, element_cost, merge_cost,
+                self.worker_overhead(), self.workers)
+        self.stats["element_cost"] = element_cost
+        self.stats["merge_cost"] = merge_cost
+        return result, workers
+
+    def allocate_outputs(self, program, elements, probe_result):
+        """ Allocates the merged values of the program that can be preallocated.
+
+        The first batch's pieces of these values are written into the new
+        outputs and removed from `probe_result`. Returns a map from targets to
+        (split type, arrays, first piece).
+
+        """
+        probe_end = self.stats["workers"][0]["range"][1]
+        outputs = {}
+        for (target, ty) in program.preallocatable().items():
+            piece = probe_result.get(target)
+            if piece is None or ty.elements(piece) != probe_end:
+                continue
+            arrays = ty.allocate(piece, elements)
+            if arrays is None:
+                continue
+            ty.write(arrays, 0, probe_end, piece)
+            probe_result[target] = None
+            outputs[target] = (ty, arrays, piece)
+        return outputs
+
     def run(self, program, values):
         """ Executes the program with the provided values. """
         elements = program.elements(values)
+        batch_size = self.get_batch_size(program, values)
+        estimated_memory = None
+        if self.options.memory_limit is not None and elements is not None:
+            # This driver runs only this program, so it can use fewer workers.
+            (workers, batch_size, estimated_memory) = self.fit_memory(program, values,
+                    elements, batch_size)
+            self.set_workers(workers)
         ranges = self.get_partitions(elements)
+        if self.options.spill_bytes is not None:
+            self.spill_directory = run_directory(self.options.spill_directory)
 
         # Make the values accessible to child processes.
-        global _VALUES
-        global _PROGRAM
-        global _BATCH_SIZE
-
-        _VALUES = values
-        _PROGRAM = program
-        _BATCH_SIZE = self.batch_size
-
-        if self.workers == 1 and self.optimize_single:
-            if self.profile:
-                import cProfile
-                import sys
-                cProfile.runctx("_run_program(0, ranges[0])", globals(), locals())
-                print("Finished profiling! exiting...")
-                sys.exit(1)
-            result = _run_program(0, ranges[0])
-        elif self.workers > 1 and ranges[1] is None:
-            # We should really dynamically adjust the number of processes
-            # (i.e., self.workers should be the maximum allowed workers), but
-            # for now its 1 or all to make evaluation easier.
-            result = _run_program(0, ranges[0])
-        else:
-            # This needs to go after the assignment to _VALUES, so
-            # the process snapshot sees the updated variable. The advantage of
-            # this approach is copy-on-write semantics on POSIX systems for
-            # (potentially large) inputs. I'm not sure what the Python
-            # interpreter does, but assuming it's sane, the underlying objects
-            # should never be written to, hence preventing the copy. The big
-            # disadvantage of this approach is that we need to incur a
-            # process-start overhead every time...
-            pool = multiprocessing.Pool(self.workers)
-
-            # TODO Just use Pool.imap instead?
-            partial_results = []
-            for (i, index_range) in enumerate(ranges):
-                partial_results.append(pool.apply_async(_worker, args=(i, index_range)))
-            for i in range(len(partial_results)):
-                partial_results[i] = partial_results[i].get()
-
-            result = defaultdict(list)
-            start = time.time()
-            if self.workers > 1:
-                for partial_result in partial_results:
-                    if partial_result is not None:
-                        for (key, value) in partial_result.items():
-                            # Don't add unnecessary None values.
-                            if value is not None:
-                                result[key].append(value)
-                
-                _merge(program, result)
-
-                # Reinstate non-mutable values, broadcast values, etc.
-                for value_key in _VALUES:
-                    if value_key not in result:
-                        result[value_key] = _VALUES[value_key]
+        _publish(program, values, batch_size, self.worker_options())
+
+        self.stats = { "batch_size": batch_size, "workers": [], "final_merge": 0.0 }
+        if estimated_memory is not None:
+            self.stats["estimated_memory"] = estimated_memory
+
+        try:
+            if (self.options.auto_workers and self.workers > 1 or self.options.preallocate) and\
+                    elements is not None:
+                # The first batch is part of the result, so measuring its
+                # cost does not repeat any work.
+                probe_result, workers = self.probe(elements, batch_size)
+                self.stats["workers_used"] = workers
+                if workers != self.workers:
+                    self.set_workers(workers)
+                probe_end = self.stats["workers"][0]["range"][1]
+                if probe_end == elements:
+                    result = probe_result
+                else:
+                    outputs = {}
+                    # Remote workers and subinterpreters cannot map the outputs.
+                    if self.options.preallocate and self.backend not in ("remote", "interpreters"):
+                        # The first batch fixes the type of each output.
+                        outputs = self.allocate_outputs(program, elements, probe_result)
+                        _publish(program, values, batch_size, self.worker_options(),
+                                dict((t, (ty, arrays)) for (t, (ty, arrays, _)) in outputs.items()))
+                        self.stats["preallocated"] = sorted(outputs)
+
+                    ranges = self.get_partitions(elements - probe_end, workers)
+                    ranges = [(r[0] + probe_end, r[1] + probe_end) if r is not None else None\
+                            for r in ranges]
+                    if workers == 1:
+                        rest, stats = _run_program(0, ranges[0])
+                        self.stats["workers"].append(stats)
+                        partial_results = [rest]
+                    else:
+                        partial_results = self._run_parallel(program, values, batch_size, ranges)
+                    result = self._combine_results(program, values,
+                            [probe_result] + partial_results)
+                    for (target, (ty, arrays, piece)) in outputs.items():
+                        result[target] = ty.assemble(arrays, piece)
+            elif self.workers == 1 and self.optimize_single:
+                if self.options.profile:
+                    import cProfile
+                    import sys
+                    cProfile.runctx("_run_program(0, ranges[0])", globals(), locals())
+                    print("Finished profiling! exiting...")
+                    sys.exit(1)
+                result, stats = _run_program(0, ranges[0])
+                self.stats["workers"].append(stats)
+            elif self.workers > 1 and ranges[1] is None:
+                # We should really dynamically adjust the number of processes
+                # (i.e., self.workers should be the maximum allowed workers), but
+                # for now its 1 or all to make evaluation easier.
+                result, stats = _run_program(0, ranges[0])
+                self.stats["workers"].append(stats)
             else:
-                result = partial_results[0]
+                partial_results = self._run_parallel(program, values, batch_size, ranges)
+                result = self._combine_results(program, values, partial_results)
+        finally:
+            _unpublish()
+            if self.spill_directory is not None:
+                # Removes the files of results that were sent back by workers
+                # but never loaded, e.g. when another chunk failed.
+                reclaim(self.spill_directory)
+                use_directory(None)
+                self.spill_directory = None
+
+        return result
 
-            end = time.time()
-            print("Final merge time:", end - start)
-            pool.terminate()
+    def _run_parallel(self, program, values, batch_size, ranges):
+        """ Runs the published program on one worker per range.
 
-        _VALUES = None
-        _PROGRAM = None
-        _BATCH_SIZE = None
+        Returns the partial results in element order, and records the
+        statistics of each chunk. If `merge_fanin` is set, the partial results
+        are first reduced in a tree on the workers.
 
+        """
+        if self.options.chunk_batches is None:
+            scheduler = ChunkScheduler(ranges)
+        else:
+            scheduler = ChunkScheduler(ranges, batch_size * self.options.chunk_batches)
+
+        # Thread workers and subinterpreters share the libraries' thread pools
+        # with the driver.
+        # Worker processes also inherit the limit through the environment when
+        # they start, and set it at runtime themselves (see `_worker`).
+        with ThreadLimits(self.library_threads):
+            if self.backend == "threads":
+                partial_results, stats, levels = self._run_threaded(scheduler)
+            elif self.backend == "interpreters":
+                partial_results, stats, levels = self._run_interpreters(program, values,
+                        batch_size, scheduler)
+            elif self.pool is not None:
+                # Long-lived workers receive the program and values explicitly.
+                options = self.options
+                partial_results, stats, levels = self.pool.run(program, values, batch_size,
+                        self.worker_options(), scheduler, options.merge_fanin,
+                        _PUBLISHED.outputs or {}, options.priority, options.weight,
+                        options.retries, options.speculate, options.memory_limit)
+            else:
+                partial_results, stats, levels = self._run_forked(program, values,
+                        batch_size, scheduler)
+        self.stats["steals"] = sum(scheduler.steals)
+        self.stats["retries"] = scheduler.retries
+        self.stats["speculated"] = scheduler.speculated
+        if scheduler.peak_memory is not None:
+            self.stats["peak_memory"] = scheduler.peak_memory
+        self.stats["workers"].extend(stats)
+        self.stats["merge_levels"] = levels
+        return partial_results
+
+    def _combine_results(self, program, values, partial_results):
+        """ Combines partial results on the driver, recording the merge time. """
+        start = time.time()
+        result = self._combine(program, values, partial_results)
+        end = time.time()
+        self.stats["final_merge"] = end - start
+        print("Final merge time:", end - start)
         return result
 
+    def _run_threaded(self, scheduler):
+        """ Runs the published program on a pool of threads.
+
+        The threads share the program and values; each keeps its own state in
+        a Frame. Returns the partial results in element order, the statistics
+        of each chunk, and the number of merge levels run on the threads.
+        """
+        published = _published()
+
+        def run_chunks(worker_id):
+            _publish(*published)
+            results = []
+            chunk = scheduler.next(worker_id)
+            while chunk is not None:
+                results.append((chunk, _run_pinned(worker_id, chunk)))
+                chunk = scheduler.next(worker_id)
+            return results
+
+        def reduce_group(group):
+            _publish(*published)
+            return _reduce(published[0], group)
+
+        def reduce_groups(groups):
+            futures = [executor.submit(reduce_group, group) if len(group) > 1 else None\
+                    for group in groups]
+            return [future.result() if future is not None else group[0]\
+                    for (future, group) in zip(futures, groups)]
+
+        with concurrent.futures.ThreadPoolExecutor(scheduler.workers) as executor:
+            futures = [executor.submit(run_chunks, i) for i in range(scheduler.workers)]
+            chunk_results = [result for future in futures for result in future.result()]
+            (partial_results, stats) = _in_order(chunk_results)
+            partial_results, levels = _reduce_tree(partial_results, self.options.merge_fanin,
+                    reduce_groups)
+        return partial_results, stats, levels
+
+    def _run_interpreters(self, program, values, batch_size, scheduler):
+        """ Runs the published program on subinterpreters (see
+        `interpreters.run`). """
+        from . import interpreters
+        return interpreters.run(program, values, batch_size, self.worker_options(), scheduler,
+                self.options.merge_fanin, _PUBLISHED.outputs or {})
+
+    def _run_forked(self, program, values, batch_size, scheduler):
+        """ Runs the published program on a freshly started WorkerPool. """
+        # Imported here since the pool imports this module.
+        from .pool import WorkerPool
+
+        # When forking, this needs to go after the call to _publish, so
+        # the process snapshot sees the updated variable. The advantage of
+        # this approach is copy-on-write semantics on POSIX systems for
+        # (potentially large) inputs. I'm not sure what the Python
+        # interpreter does, but assuming it's sane, the underlying objects
+        # should never be written to, hence preventing the copy. The big
+        # disadvantage of this approach is that we need to incur a
+        # process-start overhead every time (see WorkerPool)...
+        context = multiprocessing.get_context(self.options.start_method)
+        inherited = _published() if context.get_start_method() == "fork" else None
+        pool = WorkerPool(scheduler.workers, self.options.start_method, inherited)
+        try:
+            return pool.run(program, values, batch_size, self.worker_options(), scheduler,
+                    self.options.merge_fanin, _PUBLISHED.outputs or {},
+                    retries=self.options.retries, speculate=self.options.speculate,
+                    memory_limit=self.options.memory_limit)
+        finally:
+            pool.shutdown()
+
+    def _spill_partial_results(self, program, partial_results):
+        """ Spills the merged values of the partial results if they take more
+        than `spill_bytes`, so that they are combined from disk. """
+        types = program.merged_types()
+        held = sum(nbytes(result.get(target)) for result in partial_results\
+                if result is not None for target in types)
+        if held <= self.options.spill_bytes:
+            return
+        use_directory(self.spill_directory)
+        spills = 0
+        for result in partial_results:
+            if result is None:
+                continue
+            for (target, ty) in types.items():
+                value = result.get(target)
+                if value is None or spilled(value):
+                    continue
+                copy = ty.spill(value)
+                if copy is not None:
+                    result[target] = copy
+                    spills += 1
+        self.stats["spilled_results"] = spills
+
+    def _combine(self, program, values, partial_results):
+        """ Merges the partial results of the workers into a single context. """
+        if len(partial_results) == 1:
+            return partial_results[0]
+
+        if self.options.spill_bytes is not None:
+            self._spill_partial_results(program, partial_results)
+        result = _reduce(program, partial_results)
+
+        # Reinstate non-mutable values, broadcast values, etc.
+        for value_key in values:
+            if value_key not in result:
+                result[value_key] = values[value_key]
+        return result
@@ -0,0 +1,33 @@
+
+class Frame:
+    """
+    The execution state of one worker running a program.
+
+    Programs and their instructions are shared by all workers, so any state
+    that changes while a worker runs lives in its frame instead. This lets
+    several workers run the same program at the same time in one process.
+
+    """
+
+    __slots__ = [ "worker_id", "splitters", "buffered", "coalesce_elements", "pool", "outputs" ]
+
+    def __init__(self, worker_id, coalesce_elements=None, pool=None, outputs=None):
+        """
+        Parameters
+        ----------
+
+        worker_id : the ID of the worker.
+        coalesce_elements : the target number of elements per coalesced piece.
+        pool : an optional BufferPool of scratch buffers for temporaries.
+        outputs : maps targets to their split type and the preallocated
+        arrays their pieces are written into (see `SplitType.allocate`).
+
+        """
+        self.worker_id = worker_id
+        # Maps Split targets to their splitter function or generator.
+        self.splitters = {}
+        # Maps Coalesce targets to (pieces, total elements) buffered so far.
+        self.buffered = {}
+        self.coalesce_elements = coalesce_elements
+        self.pool = pool
+        self.outputs = outputs if outputs is not None else {}
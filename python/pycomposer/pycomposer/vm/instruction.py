@@ -2,7 +2,8 @@
 from abc import ABC, abstractmethod
 import types
 
-from .driver import STOP_ITERATION
+from .driver import STOP_ITERATION, DEFERRED
+from .worker_objects import WorkerObject
 
 class Instruction(ABC):
     """
@@ -10,14 +11,14 @@ class Instruction(ABC):
     """
 
     @abstractmethod
-    def evaluate(self, thread, start, end, values, context):
+    def evaluate(self, frame, start, end, values, context):
         """
         Evaluates an instruction.
 
         Parameters
         ----------
 
-        thread : the thread that is  currently executing
+        frame : the Frame of the worker that is currently executing.
         start : the start index of the current split value.
         end : the end index of the current split value
         values : a global value map holding the inputs.
@@ -44,27 +45,32 @@ class Split(Instruction):
         """
         self.target = target
         self.ty = ty
-        self.splitter = None
 
     def __str__(self):
         return "v{} = split {}:{}".format(self.target, self.target, self.ty)
 
-    def evaluate(self, thread, start, end, values, context):
+    def evaluate(self, frame, start, end, values, context):
         """ Returns values from the split. """
 
-        if self.splitter is None:
+        value = values[self.target]
+        if isinstance(value, WorkerObject):
+            # Built once per worker, the first time it is split.
+            value = value.get()
+
+        splitter = frame.splitters.get(self.target)
+        if splitter is None:
             # First time - check if the splitter is actually a generator.
-            result = self.ty.split(start, end, values[self.target])
+            result = self.ty.split(start, end, value)
             if isinstance(result, types.GeneratorType):
-                self.splitter = result
-                result = next(self.splitter)
+                frame.splitters[self.target] = result
+                result = next(result)
             else:
-                self.splitter = self.ty.split
+                frame.splitters[self.target] = self.ty.split
         else:
-            if isinstance(self.splitter, types.GeneratorType):
-                result = next(self.splitter)
+            if isinstance(splitter, types.GeneratorType):
+                result = next(splitter)
             else:
-                result = self.splitter(start, end, values[self.target])
+                result = splitter(start, end, value)
 
         if isinstance(result, str) and result == STOP_ITERATION:
             return STOP_ITERATION
@@ -73,7 +79,7 @@ class Split(Instruction):
 
 class Call(Instruction):
     """ An instruction that calls an SA-enabled function. """
-    def __init__(self,  target, func, args, kwargs, ty):
+    def __init__(self,  target, func, args, kwargs, ty, out_capable=False, selective=False):
         self.target = target
         # Function to call.
         self.func = func
@@ -83,6 +89,10 @@ class Call(Instruction):
         self.kwargs = kwargs
         # Return split type.
         self.ty = ty
+        # Whether the function accepts an `out` argument that was not passed.
+        self.out_capable = out_capable
+        # Whether the function may return fewer elements than it was passed.
+        self.selective = selective
 
     def __str__(self):
         args = ", ".join(map(lambda a: "v" + str(a), self.args))
@@ -96,12 +106,101 @@ class Call(Instruction):
     def get_kwargs(self, context):
         return dict([ (name, context[target][-1]) for (name, target) in self.kwargs.items() ])
 
-    def evaluate(self, _thread, _start, _end, _values, context):
+    def recyclable(self):
+        """ Returns whether the result of this call is a temporary whose buffer
+        can be reused once its consumers in a batch have run.
+
+        This is the case if the function can write into a provided buffer and
+        the pieces of its result are not needed to produce a merged value.
+        """
+        return self.out_capable and\
+                (not self.ty.mutable or not self.ty.combines_pieces())
+
+    def evaluate(self, frame, _start, _end, _values, context):
         """
         Evaluates a function call by gathering arguments and calling the
         function.
+
+        If the result is preallocated, it is written directly into its range
+        of the output. Otherwise, if the frame has a buffer pool and the
+        result is recyclable, the result is written into a buffer from the
+        pool.
         
         """
         args = self.get_args(context)
         kwargs = self.get_kwargs(context)
-        context[self.target].append(self.func(*args, **kwargs))
+        if self.out_capable and self.target in frame.outputs:
+            (_, arrays) = frame.outputs[self.target]
+            if len(arrays) == 1:
+                kwargs["out"] = self.ty.split(_start, _end, arrays[0])
+            context[self.target].append(self.func(*args, **kwargs))
+            return
+
+        pool = frame.pool
+        if pool is None or not self.recyclable():
+            context[self.target].append(self.func(*args, **kwargs))
+            return
+
+        key = (self.target, pool.signature(args, kwargs))
+        spec = pool.specs.get(key)
+        if spec is not None:
+            kwargs["out"] = pool.acquire(*spec)
+        result = self.func(*args, **kwargs)
+        if spec is None and hasattr(result, "shape") and hasattr(result, "dtype"):
+            pool.specs[key] = (result.shape, result.dtype)
+        context[self.target].append(result)
+
+class Coalesce(Instruction):
+    """
+    An instruction that buffers the small pieces produced by a selective
+    call until they reach a target number of elements.
+
+    Calls that consume the coalesced value only run once enough pieces have
+    been buffered, so they are not invoked on tiny inputs. The buffered pieces
+    are combined in order, so the output order stays deterministic.
+
+    """
+    def __init__(self, target, source, ty):
+        """
+        Parameters
+        ----------
+
+        target : the arg ID of the coalesced value.
+        source : the arg ID of the selective call's result.
+        ty : the split type of the selective call's result.
+        """
+        self.target = target
+        self.ty = ty
+        # Arguments, so the instruction can be treated like a call.
+        self.args = [source]
+        self.kwargs = {}
+
+    def __str__(self):
+        return "v{} = coalesce v{}:{}".format(self.target, self.args[0], self.ty)
+
+    def recyclable(self):
+        return False
+
+    def evaluate(self, frame, _start, _end, _values, context):
+        """
+        Buffers the latest piece of the source and emits a coalesced piece
+        once the frame's target number of elements is reached. Returns
+        DEFERRED if the pieces are still being buffered.
+        """
+        piece = context[self.args[0]][-1]
+        (pieces, buffered) = frame.buffered.get(self.target, ([], 0))
+        pieces.append(piece)
+        elements = self.ty.elements(piece)
+        buffered += elements if elements is not None else 1
+        frame.buffered[self.target] = (pieces, buffered)
+        if frame.coalesce_elements is not None and buffered < frame.coalesce_elements:
+            return DEFERRED
+        self.flush(frame, context)
+
+    def flush(self, frame, context):
+        """ Emits the buffered pieces, returning whether there were any. """
+        (pieces, _) = frame.buffered.pop(self.target, ([], 0))
+        if len(pieces) == 0:
+            return False
+        context[self.target].append(self.ty.combine(pieces))
+        return True
@@ -0,0 +1,235 @@
+
+import concurrent.futures
+import os
+import pickle
+import queue
+import sys
+import tempfile
+import threading
+
+from . import driver
+from .pool import WorkerError
+from .transport import share_result, load_result
+
+try:
+    # Creates subinterpreters with their own GIL. Added in Python 3.13, and
+    # used by `concurrent.interpreters` in later releases. The isolated
+    # subinterpreters of Python 3.12 abort the process when it exits once
+    # modules such as hashlib were imported in them, so they are not used.
+    import _interpreters
+except ImportError:
+    _interpreters = None
+
+# Whether programs can run in subinterpreters, once checked.
+_AVAILABLE = None
+_AVAILABLE_LOCK = threading.Lock()
+
+# The job installed in a subinterpreter by `_init_interpreter`, as arguments
+# for `_publish`, and the shared memory segments it maps.
+_JOB = None
+_SEGMENTS = None
+
+# Runs in a new subinterpreter, with `_path` (the driver's `sys.path`,
+# separated by NUL characters), `_module` (the name of this module), and
+# `_replies` bound in its `__main__` module.
+_SETUP = """
+import importlib
+import sys
+sys.path[:] = _path.split("\\0")
+_worker = importlib.import_module(_module)
+"""
+
+class _Interpreter:
+    """
+    A subinterpreter of this process, with its own GIL.
+
+    The subinterpreter shares no objects with the driver. Scripts run in its
+    `__main__` module, and are given bytes, strings, and integers as
+    variables of that module. They reply by writing a pickled value to a
+    file, since running a script does not return a value.
+
+    """
+
+    __slots__ = [ "id", "replies" ]
+
+    def __init__(self):
+        self.id = _interpreters.create()
+        # The file the subinterpreter writes its replies to (see `_reply`).
+        self.replies = tempfile.TemporaryFile()
+        try:
+            self.run(_SETUP, _path="\0".join(sys.path), _module=__name__)
+        except Exception:
+            self.close()
+            raise
+
+    def run(self, script, **variables):
+        """ Runs a script in the subinterpreter, raising a WorkerError if it
+        fails. Returns the value it replied with, or None. """
+        variables["_replies"] = self.replies.fileno()
+        os.ftruncate(self.replies.fileno(), 0)
+        _interpreters.set___main___attrs(self.id, variables)
+        error = _interpreters.exec(self.id, script)
+        if error is not None:
+            raise WorkerError("subinterpreter {} failed:\n{}".format(self.id,
+                    getattr(error, "formatted", error)))
+        size = os.fstat(self.replies.fileno()).st_size
+        if size == 0:
+            return None
+        return pickle.loads(os.pread(self.replies.fileno(), size, 0))
+
+    def close(self):
+        """ Destroys the subinterpreter. """
+        try:
+            _interpreters.destroy(self.id)
+        finally:
+            self.replies.close()
+
+def _reply(fd, value):
+    """ Replies to the driver from a subinterpreter (see `_Interpreter`). """
+    os.pwrite(fd, pickle.dumps(value, protocol=5), 0)
+
+def available():
+    """
+    Returns whether the "interpreters" backend can run here.
+
+    This needs Python 3.13 or later, and a subinterpreter that can import
+    this module. The check starts a subinterpreter once per process.
+
+    """
+    global _AVAILABLE
+    with _AVAILABLE_LOCK:
+        if _AVAILABLE is None:
+            _AVAILABLE = False
+            if _interpreters is not None:
+                try:
+                    _Interpreter().close()
+                    _AVAILABLE = True
+                except Exception:
+                    pass
+        return _AVAILABLE
+
+def _init_interpreter(payload):
+    """ Installs a job prepared by `_export_job` in a subinterpreter. """
+    global _JOB, _SEGMENTS
+    _SEGMENTS = {}
+    _JOB = driver._load_job(payload, _SEGMENTS)
+
+def _interpreter_worker(worker_id, start, end, replies):
+    """
+    Runs a chunk of the installed job in a subinterpreter, and replies with
+    its partial result and statistics.
+
+    Unlike `_worker`, this does not limit the threads of native libraries:
+    the limit is set in the environment of the process, which the driver
+    already did for all subinterpreters.
+
+    """
+    driver._publish(*_JOB)
+    try:
+        (result, stats) = driver._run_pinned(worker_id, (start, end))
+        _reply(replies, (share_result(result), stats))
+    finally:
+        driver._unpublish()
+
+def _interpreter_reduce(handles, replies):
+    """ Combines pickled partial results in a subinterpreter (see
+    `_reduce_worker`). """
+    driver._publish(*_JOB)
+    try:
+        _reply(replies, driver._reduce_worker(pickle.loads(handles)))
+    finally:
+        driver._unpublish()
+
+def run(program, values, batch_size, options, scheduler, merge_fanin, outputs):
+    """
+    Runs a program on subinterpreters of this process, one per worker.
+
+    Each subinterpreter has its own GIL, so pure-Python functions run in
+    parallel as in worker processes, without starting processes. The
+    interpreters share no objects with the driver: they are sent the job like
+    spawned workers, and their partial results are pickled.
+
+    Subinterpreters cannot import extension modules that do not support
+    them, such as NumPy and Pandas, so the program's functions, split types,
+    and values must not need these. For the same reason, the program's
+    functions may not write into their inputs, and values are not
+    preallocated. Batches are not prefetched either, since isolated
+    subinterpreters may not start the prefetch helper's daemon thread. The
+    driver warns when `prefetch` or `preallocate` are ignored.
+
+    Returns the partial results in element order, the statistics of each
+    chunk, and the number of merge levels run on the workers, like
+    `WorkerPool.run`.
+
+    """
+    if len(program.split_values(values)[1]) > 0:
+        raise ValueError("subinterpreters cannot write into their inputs; "
+                "return new values instead")
+    # The prefetch helper is a daemon thread, which isolated subinterpreters
+    # may not start.
+    options = dict(options, prefetch=False)
+    export, payload = driver._export_job(program, values, batch_size, options, outputs)
+    interpreters = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(scheduler.workers) as slots:
+
+            def start():
+                interpreter = _Interpreter()
+                try:
+                    interpreter.run("_worker._init_interpreter(_payload)", _payload=payload)
+                except Exception:
+                    interpreter.close()
+                    raise
+                return interpreter
+
+            # Interpreters that started are closed even if others failed.
+            starting = [slots.submit(start) for _ in range(scheduler.workers)]
+            concurrent.futures.wait(starting)
+            interpreters.extend(future.result() for future in starting\
+                    if future.exception() is None)
+            for future in starting:
+                future.result()
+
+            # Each thread of `slots` feeds one interpreter with the chunks of
+            # its worker, so workers keep their partitions and steal as with
+            # threads.
+            def run_chunks(worker_id):
+                results = []
+                chunk = scheduler.next(worker_id)
+                while chunk is not None:
+                    reply = interpreters[worker_id].run(
+                            "_worker._interpreter_worker(_worker_id, _start, _end, _replies)",
+                            _worker_id=worker_id, _start=chunk[0], _end=chunk[1])
+                    results.append((chunk, reply))
+                    chunk = scheduler.next(worker_id)
+                return results
+
+            # Merges take any idle interpreter.
+            idle = queue.Queue()
+            for interpreter in interpreters:
+                idle.put(interpreter)
+
+            def reduce_group(group):
+                interpreter = idle.get()
+                try:
+                    return interpreter.run("_worker._interpreter_reduce(_handles, _replies)",
+                            _handles=pickle.dumps(group, protocol=5))
+                finally:
+                    idle.put(interpreter)
+
+            def reduce_groups(groups):
+                futures = [slots.submit(reduce_group, group) if len(group) > 1 else None\
+                        for group in groups]
+                return [future.result() if future is not None else group[0]\
+                        for (future, group) in zip(futures, groups)]
+
+            futures = [slots.submit(run_chunks, i) for i in range(scheduler.workers)]
+            chunk_results = [result for future in futures for result in future.result()]
+            (handles, stats) = driver._in_order(chunk_results)
+            handles, levels = driver._reduce_tree(handles, merge_fanin, reduce_groups)
+            partial_results = [load_result(handle) for handle in handles]
+    finally:
+        for interpreter in interpreters:
+            interpreter.close()
+        export.close()
+    return partial_results, stats, levels
@@ -0,0 +1,121 @@
+
+import os
+import threading
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+# Environment variables read by native libraries when they create their
+# thread pools.
+THREAD_VARIABLES = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+# Number of active ThreadLimits in this process, the environment they
+# replaced, and the threadpoolctl limiter of the first one.
+_ACTIVE = 0
+_ENVIRONMENT = None
+_LIMITER = None
+_LOCK = threading.Lock()
+
+# Controller of the thread pools loaded in this process. Created on first use,
+# since inspecting the loaded libraries is slow.
+_CONTROLLER = None
+
+def threads_per_worker(workers, setting):
+    """ Returns the number of threads native libraries may use per worker.
+
+    Parameters
+    ----------
+
+    workers : the number of workers running at once.
+    setting : "auto" to split the CPUs evenly between the workers, an
+    integer to use that many threads, or None to leave libraries alone.
+
+    """
+    if setting is None:
+        return None
+    if setting == "auto":
+        if workers <= 1:
+            return None
+        return max(1, (os.cpu_count() or 1) // workers)
+    assert setting >= 1, "library_threads must be at least 1"
+    return setting
+
+def _controller():
+    """ Returns a threadpoolctl controller, or None if it is not installed. """
+    global _CONTROLLER
+    if threadpoolctl is None:
+        return None
+    if _CONTROLLER is None:
+        _CONTROLLER = threadpoolctl.ThreadpoolController()
+    return _CONTROLLER
+
+class ThreadLimits:
+    """
+    Limits the threads used by native libraries, such as BLAS and OpenMP, in
+    this process while the context is active.
+
+    The limit is set in the environment, which libraries that are loaded or
+    start their pools later will read, and in the libraries that are already
+    loaded through threadpoolctl if it is installed. The previous settings
+    are restored when the last active limit exits. Limits are process-wide,
+    so while one is active, limits entered by other threads only keep it
+    active.
+
+    """
+
+    __slots__ = [ "threads", "entered" ]
+
+    def __init__(self, threads):
+        """
+        Parameters
+        ----------
+
+        threads : the number of threads, or None to not limit them.
+
+        """
+        self.threads = threads
+        self.entered = False
+
+    def __enter__(self):
+        global _ACTIVE, _ENVIRONMENT, _LIMITER
+        if self.threads is None:
+            return self
+        with _LOCK:
+            if _ACTIVE == 0:
+                _ENVIRONMENT = dict((name, os.environ.get(name)) for name in THREAD_VARIABLES)
+                for name in THREAD_VARIABLES:
+                    os.environ[name] = str(self.threads)
+                controller = _controller()
+                if controller is not None:
+                    _LIMITER = controller.limit(limits=self.threads)
+            _ACTIVE += 1
+            self.entered = True
+        return self
+
+    def __exit__(self, *args):
+        global _ACTIVE, _ENVIRONMENT, _LIMITER
+        if not self.entered:
+            return
+        with _LOCK:
+            self.entered = False
+            _ACTIVE -= 1
+            if _ACTIVE > 0:
+                return
+            if _LIMITER is not None:
+                _LIMITER.restore_original_limits()
+                _LIMITER = None
+            for (name, value) in _ENVIRONMENT.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            _ENVIRONMENT = None
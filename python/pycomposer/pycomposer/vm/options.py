@@ -0,0 +1,156 @@
+
+from .driver import DEFAULT_CACHE_LEVEL
+from .sizing import parse_bytes
+
+class Options:
+    """
+    Options of an evaluation, taken by `evaluate`, `evaluate_async`,
+    `evaluate_dag`, and `Driver`. Each option is described where `__init__`
+    sets it; the defaults run each pipeline on `workers` forked processes
+    with batch sizes chosen from the cache size.
+
+    Some options only apply together. Evaluations share workers, and
+    independent pipelines of one evaluation run at the same time, only on a
+    shared pool: `persistent` with more than one worker and the "processes"
+    backend, or the "remote" backend. Otherwise `priority` and `weight` are
+    ignored with a warning. Workers steal, speculate, and wait for memory
+    between chunks, so `chunk_batches` should be set with `speculate` and
+    `memory_limit`, and on shared pools so that large evaluations return
+    their workers often.
+
+    Objects that are expensive to build, such as models, can be built once
+    per worker instead of being sent by every evaluation: register an
+    initializer with `worker_initializer(key, initializer)` and pass
+    `worker_object(key)` to annotated functions in place of the object.
+    With `persistent`, each worker of the pool builds the object once for
+    all evaluations; otherwise the workers of each pipeline build it again.
+
+    """
+
+    __slots__ = [ "workers", "batch_size", "profile", "prefetch", "cache_level", "adaptive",
+            "recycle", "coalesce_elements", "persistent", "backend", "chunk_batches",
+            "auto_workers", "start_method", "merge_fanin", "preallocate", "affinity",
+            "library_threads", "priority", "weight", "retries", "speculate", "memory_limit",
+            "spill_bytes", "spill_directory" ]
+
+    def __init__(self, workers=1, batch_size=None, profile=False, prefetch=False,
+            cache_level=DEFAULT_CACHE_LEVEL, adaptive=False, recycle=False, coalesce_elements=None,
+            persistent=False, backend="processes", chunk_batches=None, auto_workers=False,
+            start_method=None, merge_fanin=None, preallocate=False, affinity=None,
+            library_threads="auto", priority=0, weight=1.0, retries=2, speculate=False,
+            memory_limit=None, spill_bytes=None, spill_directory=None):
+        # The number of workers, or the most workers with `auto_workers`.
+        self.workers = workers
+        # If None, the batch size is chosen per program so that the pieces
+        # live in a batch fit in the cache at `cache_level`.
+        self.batch_size = batch_size
+        self.cache_level = cache_level
+        # Run a single worker under cProfile.
+        self.profile = profile
+        # Split the next batch on a helper thread while the current one runs.
+        # Only used if every split type in a program is prefetchable.
+        self.prefetch = prefetch
+        # Time each batch and adjust the batch size with a BatchController.
+        self.adaptive = adaptive
+        # Write temporaries of `out`-capable calls into per-worker buffers.
+        self.recycle = recycle
+        # Number of elements to buffer after selective calls before running
+        # their consumers. If None, the batch size is used.
+        self.coalesce_elements = coalesce_elements
+        # Run on a process-wide WorkerPool, one per start method, that is
+        # reused across calls instead of forking one per run. The pools are
+        # stopped by `shutdown()` or when the process exits.
+        self.persistent = persistent
+        # "processes" runs workers in child processes. "threads" runs them
+        # as threads in this process, which avoids copying inputs and results
+        # for functions that release the GIL.
+        #
+        # "remote" runs them on the worker daemons given to `connect` (or
+        # started by `start_local_workers`), sending them the inputs and
+        # results over TCP. Each daemon is sent all of the inputs, since
+        # chunks move between workers. The annotated functions and split
+        # types must be importable by module path, and may not write into
+        # their inputs.
+        #
+        # "interpreters" runs them in subinterpreters of this process, each
+        # with its own GIL, on Python 3.13 or later; elsewhere, the driver
+        # falls back to "processes" with a warning. NumPy and Pandas cannot
+        # be imported in subinterpreters, so only programs over pure-Python
+        # values run on them, and `prefetch` and `preallocate` are ignored
+        # with a warning.
+        if backend not in ("processes", "threads", "remote", "interpreters"):
+            raise ValueError("unknown backend {}".format(backend))
+        self.backend = backend
+        # If set, workers process chunks of this many batches and steal chunks
+        # from other workers when they run out. Otherwise, each worker
+        # processes one contiguous partition. Results are still combined in
+        # element order.
+        self.chunk_batches = chunk_batches
+        # Choose the number of workers for each program, up to `workers`,
+        # from the time of its first batch, which runs in-process (see
+        # `choose_workers`).
+        self.auto_workers = auto_workers
+        # The multiprocessing start method of worker processes. Under "spawn"
+        # and "forkserver", arrays and the columns of Pandas values are sent
+        # to workers through shared memory instead of being inherited.
+        self.start_method = start_method
+        # If set, workers combine their partial results in groups of this
+        # many, level by level, before the driver's final combine.
+        if merge_fanin is not None and merge_fanin < 2:
+            raise ValueError("merge_fanin must be at least 2")
+        self.merge_fanin = merge_fanin
+        # Allocate merged values whose split types support it (see
+        # `SplitType.allocate`) in shared memory after the first batch, and
+        # write each batch's piece into its range. Ignored by the remote and
+        # interpreters backends, whose workers cannot map them.
+        self.preallocate = preallocate
+        # "numa" pins workers to the CPUs of a NUMA node, neighboring
+        # partitions on the same node, "cores" pins each worker to one CPU,
+        # and a list gives the CPUs of each worker (see
+        # `affinity.worker_cpus`). None lets the OS place workers.
+        self.affinity = affinity
+        # The number of threads native libraries (BLAS, OpenMP, ...) may use in
+        # each worker: "auto" splits the CPUs between the workers, and None
+        # leaves the libraries alone (see `limits.threads_per_worker`).
+        self.library_threads = library_threads
+        # How a shared pool splits its workers between this evaluation and
+        # others: higher priorities go first, and equal priorities share in
+        # proportion to their weights.
+        if weight <= 0:
+            raise ValueError("weight must be positive")
+        self.priority = priority
+        self.weight = weight
+        # The number of times a chunk or merge runs again on another worker
+        # if its worker process exits, e.g. because it ran out of memory,
+        # before the evaluation fails with a WorkerCrashedError. Programs that
+        # write into their inputs are never retried. The number of chunks
+        # run again is in the "retries" statistic.
+        self.retries = retries
+        # Run copies of straggling chunks on idle workers near the end of a
+        # run, and use whichever copy finishes first. Not for programs that
+        # write into their inputs or into preallocated values. The number of
+        # copies is in the "speculated" statistic.
+        self.speculate = speculate
+        # The memory budget of a run in bytes or as a string such as "8G", or
+        # None. Runs use fewer workers and smaller batches until their
+        # estimated footprint fits (see `fit_memory`), and are given chunks
+        # only while the measured memory leaves room. The estimate is in the
+        # "estimated_memory" statistic, and the most memory measured in
+        # "peak_memory".
+        self.memory_limit = parse_bytes(memory_limit) if memory_limit is not None else None
+        # If set, workers and the driver move the pieces they keep for merged
+        # values to spill files under `spill_directory` (by default, the
+        # system's temporary directory) once they take more than this many
+        # bytes. Split types opt in with `SplitType.spill`.
+        self.spill_bytes = parse_bytes(spill_bytes) if spill_bytes is not None else None
+        self.spill_directory = spill_directory
+
+    def replace(self, **changes):
+        """ Returns a copy of these options with the given options changed. """
+        options = dict((name, getattr(self, name)) for name in Options.__slots__)
+        options.update(changes)
+        return Options(**options)
+
+    def __repr__(self):
+        return "Options({})".format(", ".join("{}={!r}".format(name, getattr(self, name))\
+                for name in Options.__slots__))
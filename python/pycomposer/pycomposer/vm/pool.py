@@ -0,0 +1,698 @@
+
+import atexit
+import itertools
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing import resource_tracker
+import os
+import threading
+import time
+import traceback
+
+from . import driver
+from .sizing import resident_bytes
+from .transport import detach, discard_result, load_result, segment_name, unlink_segment
+
+# A job runs copies of its slowest tasks once this fraction of its slots
+# have no tasks left...
+SPECULATION_QUANTILE = 0.75
+# ...and only of tasks that have run this many times longer than the
+# job's median task so far.
+SPECULATION_SLOWDOWN = 1.5
+# How often, in seconds, the dispatcher checks for stragglers while a job
+# may run copies of its tasks.
+SPECULATION_INTERVAL = 0.05
+# A job with a memory limit is given no new tasks while the driver and the
+# workers use this fraction of the limit, unless none of its tasks run...
+MEMORY_HEADROOM = 0.9
+# ...and the dispatcher measures their memory this often, in seconds.
+MEMORY_INTERVAL = 0.05
+
+class WorkerCrashedError(RuntimeError):
+    """ Raised when a worker process exits while running a job. """
+    pass
+
+class WorkerError(RuntimeError):
+    """ Raised when a job fails with an exception on a worker. """
+    pass
+
+def _pool_worker(conn, inherited=None):
+    """
+    The main loop of a persistent worker process.
+
+    The worker receives messages over `conn`:
+
+    ("job", job_id, payload) : installs a job's program and values. If the
+    payload is None, the job is `inherited`, the arguments of
+    `driver._publish` that a forked worker inherited from the driver.
+    ("run", job_id, worker_id, index_range, segment) : runs a job on a range.
+    ("merge", job_id, handles, segment) : combines partial results of a job.
+    ("drop", job_id) : frees a job's state.
+    ("stop",) : exits the worker.
+
+    and replies to each "run" and "merge" message with ("done", job_id,
+    result) or ("error", job_id, traceback). Partial results are sent as
+    SharedResult handles, whose segment is created under the name `segment`
+    given by the pool.
+
+    """
+    # Maps job IDs to (program, values, batch_size, options, outputs).
+    jobs = {}
+    # Maps job IDs to the shared memory segments mapped for them.
+    segments = {}
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+
+        kind = message[0]
+        if kind == "stop":
+            break
+        elif kind == "job":
+            (_, job_id, payload) = message
+            segments[job_id] = {}
+            if payload is None:
+                jobs[job_id] = inherited
+            else:
+                jobs[job_id] = driver._load_job(payload, segments[job_id])
+        elif kind == "drop":
+            (_, job_id) = message
+            jobs.pop(job_id, None)
+            detach(segments.pop(job_id, {}))
+        elif kind in ("run", "merge"):
+            job_id = message[1]
+            try:
+                driver._publish(*jobs[job_id])
+                if kind == "run":
+                    (_, _, worker_id, index_range, segment) = message
+                    result = driver._worker(worker_id, index_range, segment)
+                else:
+                    (_, _, handles, segment) = message
+                    result = driver._reduce_worker(handles, segment)
+                reply = ("done", job_id, result)
+            except Exception:
+                reply = ("error", job_id, traceback.format_exc())
+            finally:
+                driver._unpublish()
+            conn.send(reply)
+
+class _Job:
+    """
+    The state of a job in the pool's dispatcher.
+
+    A job runs in phases (its chunks, then each level of its merge tree).
+    In each phase, tasks are drawn from `next_task` for `slots` slots, where a
+    slot is one partition of the job's scheduler. Any worker may run any
+    slot, so jobs can ask for more slots than the pool has workers.
+
+    """
+
+    __slots__ = [ "job_id", "payload", "priority", "weight", "vtime", "sent", "retries",
+            "retried", "failed", "speculate", "speculated", "copied", "durations", "memory_limit",
+            "peak_memory", "next_task", "slots", "running", "exhausted", "results", "error",
+            "finished" ]
+
+    def __init__(self, job_id, payload, priority, weight, retries, speculate, memory_limit):
+        self.job_id = job_id
+        # The pickled job, or None if the workers inherited it.
+        self.payload = payload
+        # Jobs with a higher priority are dispatched first.
+        self.priority = priority
+        # Among jobs of the same priority, workers are shared in proportion
+        # to their weights.
+        self.weight = weight
+        # Worker time used so far, divided by the weight. The job with the
+        # least virtual time is dispatched next.
+        self.vtime = 0.0
+        # Indices of the workers that were sent the job's payload.
+        self.sent = set()
+        # The number of times a task may run again after its worker exits,
+        # the number of tasks run again so far, and the (slot, tag, message,
+        # attempts) of the tasks waiting to run again.
+        self.retries = retries
+        self.retried = 0
+        self.failed = []
+        # Whether idle workers may run copies of the job's slowest tasks, the
+        # number of copies run so far, and the slots copied in this phase.
+        self.speculate = speculate
+        self.speculated = 0
+        self.copied = set()
+        # Times of the tasks finished in this phase.
+        self.durations = []
+        # The memory budget in bytes, or None, and the most memory the driver
+        # and workers were measured to use while the job ran.
+        self.memory_limit = memory_limit
+        self.peak_memory = None
+        self.next_task = None
+        self.slots = 0
+        # Slots with a task on a worker, and slots with no tasks left.
+        self.running = set()
+        self.exhausted = set()
+        self.results = []
+        self.error = None
+        self.finished = threading.Event()
+
+    def runnable(self):
+        """ Returns a slot that may be given a task, or None. """
+        if self.error is not None:
+            return None
+        if len(self.failed) > 0:
+            return self.failed[0][0]
+        for slot in range(self.slots):
+            if slot not in self.running and slot not in self.exhausted:
+                return slot
+        return None
+
+    def over_budget(self, used):
+        """ Returns whether the job must wait for its running tasks before it
+        is given another, since the processes use `used` bytes. """
+        return self.memory_limit is not None and used is not None and\
+                len(self.running) > 0 and used >= MEMORY_HEADROOM * self.memory_limit
+
+    def straggling(self, slot, elapsed):
+        """ Returns whether a copy of the task of a slot that has run for
+        `elapsed` seconds should run on an idle worker. """
+        if not self.speculate or self.error is not None or slot in self.copied or\
+                len(self.durations) == 0 or len(self.exhausted) < SPECULATION_QUANTILE * self.slots:
+            return False
+        median = sorted(self.durations)[len(self.durations) // 2]
+        return elapsed > SPECULATION_SLOWDOWN * median
+
+    def done(self):
+        return len(self.running) == 0 and (self.error is not None or\
+                (len(self.exhausted) == self.slots and len(self.failed) == 0))
+
+class WorkerPool:
+    """
+    A pool of long-lived worker processes.
+
+    Unlike `multiprocessing.Pool`, which the driver would otherwise create and
+    tear down for each pipeline, the workers in this pool are reused across
+    pipelines and calls to `evaluate`. Programs are sent to workers with
+    cloudpickle, and arrays are sent through shared memory. Workers that exit
+    unexpectedly are restarted.
+
+    Several jobs may run on the pool at once, from different threads. A
+    dispatcher thread hands each idle worker a task of the job with the
+    highest priority, and among those, of the job that used the least worker
+    time relative to its weight. Jobs thus share the workers chunk by chunk,
+    and a small job does not wait for a large one to finish.
+
+    """
+
+    def __init__(self, workers, start_method=None, inherited=None):
+        """
+        Parameters
+        ----------
+
+        workers : the number of worker processes.
+        start_method : the multiprocessing start method for workers. Uses
+        the platform default if None.
+        inherited : the arguments of `driver._publish` for a pool that runs
+        only the published job. Its workers are forked, so they inherit the
+        job's values instead of receiving them.
+
+        """
+        self.context = multiprocessing.get_context(start_method)
+        self.inherited = inherited
+        assert inherited is None or self.context.get_start_method() == "fork",\
+                "only forked workers can inherit a job"
+        self.processes = []
+        self.conns = []
+        self.job_ids = itertools.count()
+        # Guards the workers and jobs, which the dispatcher shares with the
+        # threads that submit jobs.
+        self.lock = threading.RLock()
+        # Jobs with a phase in progress.
+        self.active = []
+        # Maps the index of each busy worker to (job, slot, tag, message,
+        # attempts, start time, the name of the segment of its result).
+        self.busy = {}
+        # Wakes up the dispatcher when jobs or workers are added. At most one
+        # wakeup is pending, so senders never block on a full pipe.
+        (self.wakeup_recv, self.wakeup_send) = multiprocessing.Pipe(duplex=False)
+        self.woken = False
+        self.stopping = False
+        self.resize(workers)
+        self.dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self.dispatcher.start()
+
+    @property
+    def workers(self):
+        return len(self.processes)
+
+    def _spawn(self, index):
+        """ Starts the worker at index and returns its (process, connection). """
+        # Workers share this process's resource tracker if it runs before they
+        # start; otherwise each forked worker would start its own, and warn
+        # about the segments it created for results that the driver unlinked.
+        resource_tracker.ensure_running()
+        (conn, child_conn) = self.context.Pipe()
+        process = self.context.Process(target=_pool_worker, args=(child_conn, self.inherited),
+                daemon=True)
+        process.start()
+        child_conn.close()
+        return (process, conn)
+
+    def _wakeup(self):
+        """ Wakes up the dispatcher. Called with the lock held. """
+        if not self.woken:
+            self.woken = True
+            self.wakeup_send.send(None)
+
+    def resize(self, workers):
+        """ Grows the pool to at least the given number of workers. """
+        with self.lock:
+            while len(self.processes) < workers:
+                (process, conn) = self._spawn(len(self.processes))
+                self.processes.append(process)
+                self.conns.append(conn)
+            self._wakeup()
+
+    def restart(self, index):
+        """ Replaces the worker at index with a new process. """
+        with self.lock:
+            old = self.processes[index]
+            if old.is_alive():
+                old.terminate()
+            old.join()
+            self.conns[index].close()
+            (self.processes[index], self.conns[index]) = self._spawn(index)
+            # The new process has none of the jobs' state.
+            for job in self.active:
+                job.sent.discard(index)
+
+    def run(self, program, values, batch_size, options, scheduler, merge_fanin=None,
+            outputs=None, priority=0, weight=1.0, retries=0, speculate=False,
+            memory_limit=None):
+        """
+        Runs a program on the chunks handed out by a ChunkScheduler, using
+        one slot per partition of the scheduler. Each slot is given its next
+        chunk when it finishes the previous one. If `merge_fanin` is set,
+        the workers then reduce the partial results in a tree. `outputs` maps
+        targets to the split type and arrays of preallocated values.
+        `priority` and `weight` decide how the workers are shared with jobs
+        that run at the same time.
+
+        If a worker exits while running a task, the task runs again on
+        another or a restarted worker, up to `retries` times. Each task writes
+        only its own range of the outputs, so running it again is safe unless
+        the program writes into its inputs; such programs are not retried.
+        The number of tasks run again is recorded in the scheduler.
+
+        If `speculate` is set, workers that are idle near the end of a phase
+        run copies of the tasks that take much longer than the others (see
+        SPECULATION_SLOWDOWN), and the first copy to finish is used; the
+        worker running the other copy is restarted. Copies run only if every
+        task writes to private buffers, so not for programs that write into
+        their inputs or preallocated outputs. The number of copies run is
+        recorded in the scheduler.
+
+        If `memory_limit` is set, the job is given a task only while the
+        resident memory of this process and the pool's local workers is
+        below MEMORY_HEADROOM of the limit, or if none of its tasks are
+        running. The most memory measured is recorded in the scheduler.
+
+        Returns the partial results in element order, the statistics of each
+        chunk, and the number of merge levels run on the workers.
+
+        """
+        assert weight > 0, "weight must be positive"
+        if self.inherited is not None:
+            export, payload = None, None
+        else:
+            # Only the values that are split are needed by the workers.
+            export, payload = driver._export_job(program, values, batch_size, options,
+                    outputs or {})
+        if len(program.split_values(values)[1]) > 0:
+            retries = 0
+            speculate = False
+        if outputs:
+            speculate = False
+        job = _Job(next(self.job_ids), payload, priority, weight, retries, speculate,
+                memory_limit)
+        # The results the workers returned. If the run fails, those that were
+        # not merged on a worker are never loaded, so they are discarded.
+        collected = []
+        try:
+            def gather(slots, next_task, handle_of):
+                try:
+                    return self._gather(job, slots, next_task)
+                finally:
+                    collected.extend(handle_of(result) for (_, result) in job.results)
+
+            def next_chunk(slot):
+                chunk = scheduler.next(slot)
+                if chunk is not None:
+                    return (chunk, ("run", job.job_id, slot, chunk))
+
+            chunk_results = gather(scheduler.workers, next_chunk, lambda result: result[0])
+            (handles, stats) = driver._in_order(chunk_results)
+
+            def reduce_groups(groups):
+                merges = iter([(index, ("merge", job.job_id, group))\
+                        for (index, group) in enumerate(groups) if len(group) > 1])
+                reduced = dict(gather(len(groups), lambda slot: next(merges, None),
+                        lambda result: result))
+                return [reduced.get(index, group[0]) for (index, group) in enumerate(groups)]
+
+            handles, levels = driver._reduce_tree(handles, merge_fanin, reduce_groups)
+        except BaseException:
+            # Results merged on a worker were already freed by it, and
+            # discarding them again does nothing.
+            for handle in collected:
+                discard_result(handle)
+            raise
+        finally:
+            scheduler.retries = job.retried
+            scheduler.speculated = job.speculated
+            scheduler.peak_memory = job.peak_memory
+            with self.lock:
+                for index in job.sent:
+                    try:
+                        self.conns[index].send(("drop", job.job_id))
+                    except (OSError, ValueError):
+                        pass
+            if export is not None:
+                export.close()
+        return [load_result(handle) for handle in handles], stats, levels
+
+    def _gather(self, job, slots, next_task):
+        """
+        Runs a phase of a job and waits for its results.
+
+        next_task(slot) returns the next (tag, message) to run for a slot, or
+        None if there are no tasks left for it. Returns a list of (tag,
+        result), or raises the first error of the phase.
+
+        """
+        with self.lock:
+            job.next_task = next_task
+            job.slots = slots
+            job.exhausted = set()
+            job.copied = set()
+            job.durations = []
+            job.results = []
+            job.finished.clear()
+            # A job joins with the virtual time of the furthest behind job, so
+            # it does not take the workers until it catches up with the others.
+            job.vtime = max(job.vtime, min([other.vtime for other in self.active], default=0.0))
+            self.active.append(job)
+            self._wakeup()
+        job.finished.wait()
+        if job.error is not None:
+            raise job.error
+        return job.results
+
+    def _memory_used(self):
+        """ Returns the resident memory of this process and the local workers
+        in bytes, or None if it cannot be measured. Called with the lock
+        held. """
+        used = resident_bytes()
+        if used is None:
+            return None
+        for process in self.processes:
+            # Remote workers have no local process.
+            pid = getattr(process, "pid", None)
+            if pid is not None:
+                used += resident_bytes(pid) or 0
+        return used
+
+    def _next_job(self, used=None):
+        """ Returns the job to give the next task to, or None. `used` is the
+        memory used by the processes, if measured. """
+        jobs = [job for job in self.active if job.runnable() is not None and\
+                not job.over_budget(used)]
+        if len(jobs) == 0:
+            return None
+        return min(jobs, key=lambda job: (-job.priority, job.vtime))
+
+    def _finish_if_done(self, job):
+        if job.done() and job in self.active:
+            self.active.remove(job)
+            job.finished.set()
+
+    def _revive(self, index):
+        """ Restarts the worker at index if it exited. Returns whether it is
+        running. Called with the lock held. """
+        if self.processes[index].is_alive():
+            return True
+        try:
+            self.restart(index)
+            return True
+        except OSError:
+            # E.g., a remote daemon that does not accept connections.
+            return False
+
+    def _dispatch(self):
+        """ Gives tasks to idle workers. Called with the lock held. """
+        used = None
+        budgeted = [job for job in self.active if job.memory_limit is not None]
+        if len(budgeted) > 0:
+            used = self._memory_used()
+            if used is not None:
+                for job in budgeted:
+                    job.peak_memory = max(job.peak_memory or 0, used)
+        alive = 0
+        for index in range(len(self.processes)):
+            if index in self.busy:
+                alive += 1
+                continue
+            if not self._revive(index):
+                continue
+            alive += 1
+            while True:
+                job = self._next_job(used)
+                if job is None:
+                    self._speculate(index)
+                    break
+                if len(job.failed) > 0:
+                    (slot, tag, message, attempts) = job.failed.pop(0)
+                else:
+                    slot = job.runnable()
+                    attempts = 0
+                    try:
+                        task = job.next_task(slot)
+                    except Exception as e:
+                        job.error = e
+                        self._finish_if_done(job)
+                        continue
+                    if task is None:
+                        job.exhausted.add(slot)
+                        self._finish_if_done(job)
+                        continue
+                    (tag, message) = task
+                try:
+                    segment = self._send(index, job, message)
+                except (OSError, ValueError):
+                    # The worker exited before it got the task, so the task
+                    # did not run. It goes to the next worker.
+                    job.failed.insert(0, (slot, tag, message, attempts))
+                    break
+                job.running.add(slot)
+                self.busy[index] = (job, slot, tag, message, attempts, time.time(), segment)
+                break
+
+        if alive == 0:
+            # No worker can run the remaining tasks.
+            for job in list(self.active):
+                if job.error is None:
+                    job.error = WorkerCrashedError("no workers are running")
+                self._finish_if_done(job)
+
+    def _send(self, index, job, message):
+        """ Sends a task to the worker at index, with its job if the worker
+        does not have it yet. Returns the name of the segment the worker
+        returns the task's result in. Called with the lock held. """
+        if index not in job.sent:
+            self.conns[index].send(("job", job.job_id, job.payload))
+            job.sent.add(index)
+        segment = segment_name()
+        self.conns[index].send(message + (segment,))
+        return segment
+
+    def _speculate(self, index):
+        """ Gives an idle worker a copy of the longest running straggler, if
+        any. Called with the lock held. """
+        now = time.time()
+        stragglers = [(start, job, slot, tag, message, attempts)\
+                for (job, slot, tag, message, attempts, start, _) in self.busy.values()\
+                if job.straggling(slot, now - start)]
+        if len(stragglers) == 0:
+            return
+        (_, job, slot, tag, message, attempts) = min(stragglers, key=lambda task: task[0])
+        try:
+            segment = self._send(index, job, message)
+        except (OSError, ValueError):
+            return
+        job.copied.add(slot)
+        job.speculated += 1
+        self.busy[index] = (job, slot, tag, message, attempts, now, segment)
+
+    def _timeout(self):
+        """ Returns how long the dispatcher may wait for a message, or None
+        to wait indefinitely. Called with the lock held. """
+        timeouts = []
+        if len(self.busy) < len(self.processes) and\
+                any(job.speculate and job.error is None for job in self.active):
+            # Stragglers are found by time rather than by a message.
+            timeouts.append(SPECULATION_INTERVAL)
+        if any(job.memory_limit is not None for job in self.active):
+            # Memory may be freed without a message.
+            timeouts.append(MEMORY_INTERVAL)
+        return min(timeouts, default=None)
+
+    def _cancel(self, index):
+        """ Stops the task of a busy worker by restarting the worker. Called
+        with the lock held. """
+        segment = self.busy.pop(index)[-1]
+        try:
+            self.restart(index)
+        except OSError:
+            # Restarted before it is given its next task.
+            pass
+        # The worker may have created the segment of its result, or even
+        # sent its reply, before it was stopped. Nothing else unlinks it.
+        unlink_segment(segment)
+
+    def _dispatch_loop(self):
+        """ The main loop of the dispatcher thread. """
+        while True:
+            with self.lock:
+                if self.stopping:
+                    return
+                self._dispatch()
+                waiting = [self.wakeup_recv]
+                for index in self.busy:
+                    waiting.append(self.conns[index])
+                    if self.processes[index].sentinel is not self.conns[index]:
+                        waiting.append(self.processes[index].sentinel)
+                owners = dict((self.conns[index], index) for index in self.busy)
+                owners.update((self.processes[index].sentinel, index) for index in self.busy)
+                timeout = self._timeout()
+
+            ready = multiprocessing.connection.wait(waiting, timeout)
+            with self.lock:
+                for obj in ready:
+                    if obj is self.wakeup_recv:
+                        self.wakeup_recv.recv()
+                        self.woken = False
+                        continue
+                    index = owners[obj]
+                    if index not in self.busy:
+                        # Handled through the worker's other handle.
+                        continue
+                    conn = self.conns[index]
+                    reply = None
+                    if conn.poll():
+                        try:
+                            reply = conn.recv()
+                        except (EOFError, OSError):
+                            reply = None
+                    elif obj is conn:
+                        continue
+                    self._complete(index, reply)
+
+    def _complete(self, index, reply):
+        """ Records the reply of a busy worker, or its exit if reply is None. """
+        (job, slot, tag, message, attempts, start, segment) = self.busy.pop(index)
+        job.vtime += (time.time() - start) / job.weight
+        # Other workers running a copy of the same task.
+        copies = [other for (other, task) in self.busy.items()\
+                if task[0] is job and task[1] == slot]
+        if reply is None:
+            # The worker is restarted before it is given its next task.
+            self.processes[index].join()
+            exitcode = self.processes[index].exitcode
+            self.processes[index].terminate()
+            # The worker may have exited after it created its result.
+            unlink_segment(segment)
+            if job.error is not None or len(copies) > 0:
+                pass
+            elif attempts < job.retries:
+                job.failed.append((slot, tag, message, attempts + 1))
+                job.retried += 1
+            elif exitcode is None:
+                job.error = WorkerCrashedError("worker {} disconnected".format(index))
+            else:
+                job.error = WorkerCrashedError("worker {} exited with code {}".format(
+                    index, exitcode))
+        else:
+            (kind, _, result) = reply
+            if kind == "error":
+                if job.error is None:
+                    job.error = WorkerError("worker {} failed:\n{}".format(index, result))
+            else:
+                job.results.append((tag, result))
+                job.durations.append(time.time() - start)
+            for other in copies:
+                self._cancel(other)
+            copies = []
+        if len(copies) == 0:
+            job.running.discard(slot)
+        self._finish_if_done(job)
+
+    def shutdown(self):
+        """ Stops all workers. """
+        with self.lock:
+            self.stopping = True
+            self._wakeup()
+        if self.dispatcher is not threading.current_thread():
+            self.dispatcher.join()
+        for (process, conn) in zip(self.processes, self.conns):
+            try:
+                conn.send(("stop",))
+            except (OSError, ValueError):
+                pass
+        for (process, conn) in zip(self.processes, self.conns):
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            conn.close()
+        self.processes = []
+        self.conns = []
+        # Jobs that were still running fail instead of waiting forever.
+        for job in self.active:
+            job.error = WorkerCrashedError("the pool was shut down")
+            job.finished.set()
+        self.active = []
+        self.busy = {}
+
+# The most workers the process-wide pool starts. Evaluations that ask for
+# more workers share these.
+MAX_WORKERS = os.cpu_count() or 1
+
+# The pools shared by all evaluations in this process, keyed by their start
+# method, and a lock for starting them, since evaluations may run in several
+# threads.
+_DEFAULT_POOLS = {}
+_DEFAULT_POOL_LOCK = threading.RLock()
+
+def default_pool(workers, start_method=None):
+    """ Returns the process-wide worker pool with at least `workers` workers,
+    up to MAX_WORKERS.
+
+    Each start method has a pool of its own, so that evaluations asking for
+    another start method do not stop a pool that others are running on.
+
+    """
+    start_method = multiprocessing.get_context(start_method).get_start_method()
+    with _DEFAULT_POOL_LOCK:
+        workers = max(1, min(workers, MAX_WORKERS))
+        pool = _DEFAULT_POOLS.get(start_method)
+        if pool is None:
+            pool = _DEFAULT_POOLS[start_method] = WorkerPool(workers, start_method)
+        else:
+            pool.resize(workers)
+        return pool
+
+def shutdown():
+    """ Stops the process-wide worker pools, if they were started. """
+    with _DEFAULT_POOL_LOCK:
+        for pool in _DEFAULT_POOLS.values():
+            pool.shutdown()
+        _DEFAULT_POOLS.clear()
+
+atexit.register(shutdown)
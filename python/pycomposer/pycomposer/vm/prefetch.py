@@ -0,0 +1,86 @@
+
+from collections import defaultdict
+import queue
+import threading
+
+class Prefetcher:
+    """
+    Runs the Split instructions of a program on a helper thread.
+
+    The prefetcher is double-buffered: while the calls for batch i execute on
+    the worker, the helper thread splits the inputs for batch i+1. Splitters
+    that read from files or generators can thus hide their latency behind
+    computation.
+
+    """
+
+    # Marks the end of the batches.
+    _DONE = object()
+
+    def __init__(self, program, frame, batches, values, depth=1):
+        """
+        Start prefetching the given batches.
+
+        Parameters
+        ----------
+
+        program : the program whose splits should be prefetched.
+        frame : the Frame of the worker that owns this prefetcher.
+        batches : an iterable of (start, end) piece ranges.
+        values : a global value map holding the inputs.
+        depth : the number of batches to split ahead of the calls.
+
+        """
+        self.program = program
+        self.frame = frame
+        self.batches = batches
+        self.values = values
+        # Bounded, so the helper thread stays at most `depth` batches ahead.
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.helper = threading.Thread(target=self._run, name="pycomposer-prefetch",
+                daemon=True)
+        self.helper.start()
+
+    def _put(self, item):
+        """ Blocks until the item is queued or the prefetcher is stopped. """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            for (piece_start, piece_end) in self.batches:
+                pieces = defaultdict(list)
+                more = self.program.split(self.frame,
+                        piece_start, piece_end, self.values, pieces)
+                if not more:
+                    break
+                if not self._put((piece_start, piece_end, pieces)):
+                    return
+            self._put(Prefetcher._DONE)
+        except BaseException as e:
+            # Re-raised on the worker thread.
+            self._put(e)
+
+    def __iter__(self):
+        """ Yields (start, end, pieces) for each prefetched batch. """
+        try:
+            while True:
+                item = self.queue.get()
+                if item is Prefetcher._DONE:
+                    return
+                elif isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.stop()
+
+    def stop(self):
+        """ Stops the helper thread and waits for it to exit. """
+        self.stopped.set()
+        self.helper.join()
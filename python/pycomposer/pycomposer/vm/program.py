@@ -1,6 +1,6 @@
 
-from .driver import STOP_ITERATION
-from .instruction import Split
+from .driver import STOP_ITERATION, DEFERRED
+from .instruction import Split, Call, Coalesce
 
 class Program:
     """
@@ -10,7 +10,7 @@ class Program:
 
     """
 
-    __slots__ = ["ssa_counter", "insts", "registered", "index"]
+    __slots__ = ["ssa_counter", "insts", "registered", "index", "releases", "dependents"]
 
     def __init__(self):
         # Counter for registering instructions.
@@ -19,6 +19,12 @@ class Program:
         self.insts = []
         # Registered values. Maps SSA value to real value.
         self.registered = {} 
+        # Maps instruction index to the temporaries whose last use in a batch
+        # is that instruction. Computed on first use.
+        self.releases = None
+        # Maps the index of each Coalesce instruction to the indices of the
+        # instructions that consume its value. Computed on first use.
+        self.dependents = None
 
     def get(self, value):
         """
@@ -31,18 +37,242 @@ class Program:
             if value is val:
                 return num
 
-    def set_range_end(self, range_end):
-        for inst in self.insts:
+    def _release_schedule(self):
+        """ Returns, for each instruction, the recyclable temporaries that are
+        last read by that instruction in a batch.
+        """
+        last_use = {}
+        for (i, inst) in enumerate(self.insts):
+            if isinstance(inst, Split):
+                continue
+            for target in list(inst.args) + list(inst.kwargs.values()):
+                last_use[target] = i
+            if inst.recyclable():
+                last_use.setdefault(inst.target, i)
+
+        # Coalesce instructions hold on to pieces across batches.
+        buffered = set(inst.args[0] for inst in self.insts if isinstance(inst, Coalesce))
+
+        releases = [[] for _ in self.insts]
+        for (i, inst) in enumerate(self.insts):
+            if not isinstance(inst, Split) and inst.recyclable() and inst.target not in buffered:
+                releases[max(i, last_use[inst.target])].append((i, inst.target))
+        return releases
+
+    def _release(self, index, context, pool, skipped):
+        """ Return temporaries whose last use is at index to the pool.
+
+        Temporaries whose call was skipped in this batch were not produced,
+        so they are not released.
+        """
+        if self.releases is None:
+            self.releases = self._release_schedule()
+        for (producer, target) in self.releases[index]:
+            if producer not in skipped:
+                pool.release(context[target].pop())
+
+    def _dependents_of(self, index):
+        """ Returns the indices of instructions that consume the value of the
+        instruction at index, directly or transitively.
+        """
+        targets = set([self.insts[index].target])
+        dependents = set()
+        for (i, inst) in enumerate(self.insts[index+1:], start=index+1):
             if isinstance(inst, Split):
-                inst.ty.range_end = range_end
+                continue
+            if any(target in targets for target in list(inst.args) + list(inst.kwargs.values())):
+                dependents.add(i)
+                targets.add(inst.target)
+        return dependents
+
+    def _can_coalesce(self, index, values):
+        """ Returns whether the consumers of the Coalesce instruction at index
+        only read the coalesced value, values derived from it, and values that
+        are not split into pieces. Consumers that also read per-batch pieces
+        of other values would see misaligned pieces.
+        """
+        dependents = self._dependents_of(index)
+        aligned = set([self.insts[index].target])
+        aligned.update(self.insts[i].target for i in dependents)
+        unsplit = set(inst.target for inst in self.insts
+                if isinstance(inst, Split) and inst.ty.elements(values[inst.target]) is None)
+        for i in dependents:
+            inst = self.insts[i]
+            for target in list(inst.args) + list(inst.kwargs.values()):
+                if target not in aligned and target not in unsplit:
+                    return False
+        return True
+
+    def remove_invalid_coalescing(self, values):
+        """ Removes Coalesce instructions whose consumers cannot run on
+        coalesced pieces, rewiring the consumers to the uncoalesced value.
+        """
+        removed = True
+        while removed:
+            removed = False
+            for (i, inst) in enumerate(self.insts):
+                if isinstance(inst, Coalesce) and not self._can_coalesce(i, values):
+                    source = inst.args[0]
+                    for other in self.insts:
+                        if isinstance(other, Split):
+                            continue
+                        other.args = [source if a == inst.target else a for a in other.args]
+                        other.kwargs = dict((k, source if v == inst.target else v)\
+                                for (k, v) in other.kwargs.items())
+                    del self.insts[i]
+                    removed = True
+                    break
+        self.releases = None
+        self.dependents = None
+
+    def _coalesce_dependents(self):
+        """ Maps the index of each Coalesce instruction to its consumers. """
+        return dict((i, self._dependents_of(i)) for (i, inst)
+                in enumerate(self.insts) if isinstance(inst, Coalesce))
 
-    def step(self, thread, piece_start, piece_end, values, context):
+    def _evaluate(self, indices, frame, piece_start, piece_end, values, context):
+        """
+        Evaluate the instructions at the given indices, skipping the consumers
+        of deferred values. Returns False if a split was exhausted.
+        """
+        if self.dependents is None:
+            self.dependents = self._coalesce_dependents()
+        skipped = set()
+        for i in indices:
+            if i in skipped:
+                continue
+            result = self.insts[i].evaluate(frame, piece_start, piece_end, values, context)
+            if isinstance(result, str):
+                if result == STOP_ITERATION:
+                    return False
+                elif result == DEFERRED:
+                    skipped.update(self.dependents[i])
+            if frame.pool is not None:
+                self._release(i, context, frame.pool, skipped)
+        return True
+
+    def step(self, frame, piece_start, piece_end, values, context):
         """
         Step the program and return whether are still items to process.
+
+        If the frame has a BufferPool, temporaries are recycled through it.
+        """
+        return self._evaluate(range(len(self.insts)),
+                frame, piece_start, piece_end, values, context)
+
+    def flush(self, frame, values, context):
+        """
+        Emit the pieces still buffered by Coalesce instructions and run their
+        consumers. Must be called once after the last batch.
+        """
+        if self.dependents is None:
+            self.dependents = self._coalesce_dependents()
+        active = set()
+        for (i, inst) in enumerate(self.insts):
+            if isinstance(inst, Coalesce):
+                emitted = False
+                if i in active:
+                    # Buffer the piece produced by an upstream flush first.
+                    result = inst.evaluate(frame, None, None, values, context)
+                    emitted = not (isinstance(result, str) and result == DEFERRED)
+                if inst.flush(frame, context) or emitted:
+                    active.update(self.dependents[i])
+            elif i in active:
+                inst.evaluate(frame, None, None, values, context)
+                if frame.pool is not None:
+                    self._release(i, context, frame.pool, set())
+
+    def split(self, frame, piece_start, piece_end, values, context):
+        """
+        Run only the Split instructions of the program and return whether
+        there are still items to process.
+
+        Splits only read from the input values, so they can run ahead of the
+        calls that consume them.
         """
         for task in self.insts:
-            result = task.evaluate(thread, piece_start, piece_end, values, context)
-            if isinstance(result, str) and result == STOP_ITERATION:
+            if isinstance(task, Split):
+                result = task.evaluate(frame, piece_start, piece_end, values, context)
+                if isinstance(result, str) and result == STOP_ITERATION:
+                    return False
+        return True
+
+    def call(self, frame, piece_start, piece_end, values, context):
+        """
+        Run the non-Split instructions of the program on pieces that were
+        already split into the context.
+        """
+        indices = [i for (i, task) in enumerate(self.insts) if not isinstance(task, Split)]
+        self._evaluate(indices, frame, piece_start, piece_end, values, context)
+
+    def merged_types(self):
+        """ Returns the targets of calls whose pieces are merged into the
+        result, mapped to their split types. """
+        types = {}
+        for inst in self.insts:
+            # The last split type of each target decides whether it is merged.
+            types[inst.target] = inst.ty if isinstance(inst, Call) and inst.ty.mutable else None
+        return dict((target, ty) for (target, ty) in types.items() if ty is not None)
+
+    def preallocatable(self):
+        """ Returns the targets of calls whose merged values may be
+        preallocated, mapped to their split types.
+
+        These are calls whose results are merged and whose pieces cover
+        exactly the elements of their batch, i.e., calls that are not
+        selective and do not depend on a selective call.
+        """
+        unaligned = set()
+        for (i, inst) in enumerate(self.insts):
+            if isinstance(inst, Call) and inst.selective:
+                unaligned.add(i)
+                unaligned.update(self._dependents_of(i))
+
+        targets = {}
+        for (i, inst) in enumerate(self.insts):
+            if isinstance(inst, Call) and inst.ty.mutable and i not in unaligned:
+                targets[inst.target] = inst.ty
+        return targets
+
+    def write_outputs(self, frame, piece_start, piece_end, context):
+        """ Writes the pieces of preallocated values in a batch into their
+        outputs.
+
+        Raises a ValueError if a piece does not have one element for each
+        element of the batch, i.e., if it was returned by a function that
+        changes the number of elements but is not annotated as selective.
+        """
+        for (target, (ty, arrays)) in frame.outputs.items():
+            pieces = context.get(target)
+            if pieces:
+                piece = pieces.pop()
+                elements = ty.elements(piece)
+                if elements != piece_end - piece_start:
+                    raise ValueError("cannot preallocate {}: a batch of {} elements returned {} "
+                            "(annotate functions that change the number of elements with "
+                            "selective=True)".format(target, piece_end - piece_start, elements))
+                ty.write(arrays, piece_start, piece_end, piece)
+
+    def split_values(self, values):
+        """ Returns the values read by Split instructions, and the subset of
+        their arg IDs that the program may write to.
+
+        These are the only values workers need to run the program.
+
+        """
+        split_values = {}
+        mutable = set()
+        for inst in self.insts:
+            if isinstance(inst, Split):
+                split_values[inst.target] = values[inst.target]
+                if inst.ty.mutable:
+                    mutable.add(inst.target)
+        return split_values, mutable
+
+    def prefetchable(self):
+        """ Returns whether every splitter in this program may be prefetched. """
+        for inst in self.insts:
+            if isinstance(inst, Split) and not inst.ty.prefetchable():
                 return False
         return True
 
@@ -64,5 +294,49 @@ class Program:
                     elements = e
         return elements
 
+    def _target_sizes(self, values):
+        """ Estimates the bytes per element of each target's pieces.
+
+        Split values report their size through their split type. The result of
+        a call is assumed to be as wide as the widest of its arguments. Targets
+        of unknown size map to `None`.
+
+        """
+        sizes = {}
+        for inst in self.insts:
+            if isinstance(inst, Split):
+                sizes[inst.target] = inst.ty.bytes_per_element(values[inst.target])
+            else:
+                arg_sizes = [sizes.get(target) for target in inst.args]
+                arg_sizes += [sizes.get(target) for target in inst.kwargs.values()]
+                arg_sizes = [size for size in arg_sizes if size is not None]
+                sizes[inst.target] = max(arg_sizes) if len(arg_sizes) > 0 else None
+        return sizes
+
+    def bytes_per_element(self, values):
+        """ Estimates the bytes per element of all pieces live in one batch.
+
+        Returns `None` if no value reports a size (see `_target_sizes`).
+
+        """
+        known = [size for size in self._target_sizes(values).values() if size is not None]
+        if len(known) == 0:
+            return None
+        return sum(known)
+
+    def merged_bytes_per_element(self, values):
+        """ Estimates the bytes per element of the values that are merged
+        into the result, which workers keep for every batch.
+
+        Returns `None` if no merged value reports a size.
+
+        """
+        sizes = self._target_sizes(values)
+        known = [sizes[target] for target in self.merged_types()\
+                if sizes.get(target) is not None]
+        if len(known) == 0:
+            return None
+        return sum(known)
+
     def __str__(self):
         return "\n".join([str(i) for i in self.insts])
@@ -0,0 +1,206 @@
+
+import argparse
+import atexit
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+
+from .pool import WorkerPool, _pool_worker
+
+# The environment variable holding the authentication key of the daemons, if
+# none is given explicitly.
+AUTHKEY_VARIABLE = "PYCOMPOSER_AUTHKEY"
+
+def _authkey(authkey):
+    """ Returns the authentication key to use, as bytes. """
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_VARIABLE)
+    assert authkey is not None, "remote workers need an authkey (or ${})".format(AUTHKEY_VARIABLE)
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    return authkey
+
+def serve(address, authkey=None, ready=None):
+    """
+    Runs a worker daemon that accepts drivers on `address` until it is
+    killed.
+
+    Each connection is served by a forked process that runs the messages of
+    the pool's workers (see `pool._pool_worker`), so a job that crashes its
+    worker does not take down the daemon, and the driver can reconnect.
+    Connections are authenticated with `authkey`, since jobs are pickled.
+
+    Parameters
+    ----------
+
+    address : the (host, port) to listen on. Port 0 picks a free port.
+    authkey : the shared secret of the daemons and drivers.
+    ready : an optional connection that is sent the address once the daemon
+    is listening.
+
+    """
+    if hasattr(os, "fork"):
+        context = multiprocessing.get_context("fork")
+    else:
+        context = None
+    with multiprocessing.connection.Listener(address, authkey=_authkey(authkey)) as listener:
+        if ready is not None:
+            ready.send(listener.address)
+            ready.close()
+        children = []
+        while True:
+            try:
+                conn = listener.accept()
+            except (multiprocessing.AuthenticationError, OSError):
+                continue
+            children = [child for child in children if child.is_alive()]
+            if context is None:
+                _pool_worker(conn)
+                conn.close()
+                continue
+            child = context.Process(target=_pool_worker, args=(conn,), daemon=True)
+            child.start()
+            conn.close()
+            children.append(child)
+
+class _RemoteWorker:
+    """
+    The connection to a worker daemon, in place of the process of a local
+    worker.
+    """
+
+    __slots__ = [ "conn" ]
+
+    exitcode = None
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @property
+    def sentinel(self):
+        # The connection becomes ready when the daemon's process exits.
+        return self.conn
+
+    def is_alive(self):
+        return not self.conn.closed
+
+    def join(self, timeout=None):
+        pass
+
+    def terminate(self):
+        self.conn.close()
+
+class RemotePool(WorkerPool):
+    """
+    A pool of worker daemons on other machines, reached over TCP.
+
+    The pool schedules jobs like a local WorkerPool, but its workers share no
+    memory with the driver: each daemon is sent the program and the values it
+    splits, pickled with functions and split types referenced by module path,
+    and sends its partial results back over its connection. Workers that
+    exit are reconnected to their daemon.
+
+    Every daemon receives all of the values, not only the slices of its
+    partition: chunks are assigned while the job runs (workers steal chunks,
+    and crashed or straggling chunks run again elsewhere), so any daemon may
+    process any range. The values of a job are therefore sent once per
+    daemon, which bounds the inputs to what the network and each daemon's
+    memory can hold.
+
+    """
+
+    def __init__(self, addresses, authkey=None):
+        """
+        Parameters
+        ----------
+
+        addresses : the (host, port) of each worker daemon (see `serve`).
+        Start several daemons on a host to use several of its cores.
+        authkey : the shared secret of the daemons.
+
+        """
+        self.addresses = [tuple(address) for address in addresses]
+        self.authkey = _authkey(authkey)
+        WorkerPool.__init__(self, len(self.addresses))
+
+    def _spawn(self, index):
+        conn = multiprocessing.connection.Client(self.addresses[index], authkey=self.authkey)
+        return (_RemoteWorker(conn), conn)
+
+    def resize(self, workers):
+        WorkerPool.resize(self, min(workers, len(self.addresses)))
+
+# The remote pool used by the "remote" backend, and the local daemons started
+# by `start_local_workers`.
+_REMOTE_POOL = None
+_LOCAL_DAEMONS = []
+_REMOTE_LOCK = threading.Lock()
+
+def connect(addresses, authkey=None):
+    """ Connects the "remote" backend to worker daemons, replacing the
+    daemons it was connected to. Returns the RemotePool. """
+    global _REMOTE_POOL
+    with _REMOTE_LOCK:
+        if _REMOTE_POOL is not None:
+            _REMOTE_POOL.shutdown()
+        _REMOTE_POOL = RemotePool(addresses, authkey)
+        return _REMOTE_POOL
+
+def remote_pool():
+    """ Returns the RemotePool of the "remote" backend. """
+    assert _REMOTE_POOL is not None,\
+            "not connected to remote workers; call connect() or start_local_workers()"
+    return _REMOTE_POOL
+
+def start_local_workers(workers, authkey=None):
+    """
+    Starts worker daemons on this machine and connects the "remote" backend
+    to them. This runs programs as they would run on other machines, e.g.
+    for testing.
+
+    The daemons are spawned, so they only share code with this process
+    through imports. They are stopped by `disconnect` or when this process
+    exits. Returns the RemotePool.
+
+    """
+    if authkey is None:
+        authkey = os.urandom(16)
+    context = multiprocessing.get_context("spawn")
+    addresses = []
+    for _ in range(workers):
+        (ready, child_ready) = context.Pipe(duplex=False)
+        # Not a daemonic process, since it forks a process per connection.
+        daemon = context.Process(target=serve, args=(("127.0.0.1", 0), authkey, child_ready))
+        daemon.start()
+        child_ready.close()
+        _LOCAL_DAEMONS.append(daemon)
+        addresses.append(ready.recv())
+        ready.close()
+    return connect(addresses, authkey)
+
+def disconnect():
+    """ Disconnects the "remote" backend and stops the local daemons. """
+    global _REMOTE_POOL
+    with _REMOTE_LOCK:
+        if _REMOTE_POOL is not None:
+            _REMOTE_POOL.shutdown()
+            _REMOTE_POOL = None
+        for daemon in _LOCAL_DAEMONS:
+            daemon.terminate()
+            daemon.join()
+        del _LOCAL_DAEMONS[:]
+
+atexit.register(disconnect)
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a pycomposer worker daemon.")
+    parser.add_argument("--host", default="0.0.0.0", help="the address to listen on")
+    parser.add_argument("--port", type=int, default=7070, help="the port to listen on")
+    parser.add_argument("--authkey", default=None,
+            help="the shared secret of the daemons (default: ${})".format(AUTHKEY_VARIABLE))
+    args = parser.parse_args()
+    serve((args.host, args.port), args.authkey)
+
+if __name__ == "__main__":
+    main()
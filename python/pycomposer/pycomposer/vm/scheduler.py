@@ -0,0 +1,85 @@
+
+from collections import deque
+import threading
+
+class ChunkScheduler:
+    """
+    Hands out chunks of an index range to workers.
+
+    Each worker starts with the chunks of its own contiguous partition, so it
+    processes neighboring elements. A worker that finishes its chunks steals
+    from the end of the partition of the worker with the most chunks left,
+    so one slow partition does not hold up the whole pipeline.
+
+    The scheduler is thread-safe.
+
+    """
+
+    def __init__(self, ranges, chunk_size=None):
+        """
+        Parameters
+        ----------
+
+        ranges : the index range of each worker's partition. A range may be
+        None if the worker has no elements.
+        chunk_size : the number of elements per chunk. If None, each
+        partition is a single chunk and no chunks are stolen.
+
+        """
+        self.lock = threading.Lock()
+        self.queues = []
+        for index_range in ranges:
+            chunks = deque()
+            if index_range is not None:
+                if chunk_size is None:
+                    chunks.append(index_range)
+                else:
+                    start = index_range[0]
+                    while start < index_range[1]:
+                        chunks.append((start, min(start + chunk_size, index_range[1])))
+                        start += chunk_size
+            self.queues.append(chunks)
+        self.stealing = chunk_size is not None
+        # Number of chunks each worker took from another worker.
+        self.steals = [0] * len(ranges)
+        # Number of tasks that ran again after their worker exited.
+        self.retries = 0
+        # Number of copies of straggling tasks that ran on idle workers.
+        self.speculated = 0
+        # The most memory the driver and workers used, in bytes, if measured.
+        self.peak_memory = None
+
+    @property
+    def workers(self):
+        return len(self.queues)
+
+    def next(self, worker_id):
+        """ Returns the next chunk for a worker, or None if there is no work
+        left for it.
+        """
+        with self.lock:
+            own = self.queues[worker_id]
+            if len(own) > 0:
+                return own.popleft()
+            if not self.stealing:
+                return None
+            victim = max(self.queues, key=len)
+            if len(victim) == 0:
+                return None
+            self.steals[worker_id] += 1
+            return victim.pop()
+
+    def drain(self):
+        """ Removes and returns all remaining chunks as (worker_id, chunk)
+        pairs, interleaving the workers' partitions.
+
+        This is used by executors that distribute chunks through their own
+        shared queue.
+        """
+        chunks = []
+        with self.lock:
+            while any(len(queue) > 0 for queue in self.queues):
+                for (worker_id, queue) in enumerate(self.queues):
+                    if len(queue) > 0:
+                        chunks.append((worker_id, queue.popleft()))
+        return chunks
@@ -0,0 +1,275 @@
+
+import glob
+import os
+
+# Where Linux exposes the cache hierarchy of the first CPU.
+_SYSFS_CACHE = "/sys/devices/system/cpu/cpu0/cache"
+
+# Bounds on automatically chosen batch sizes. Very small batches make the
+# per-call overhead dominate.
+MIN_BATCH_SIZE = 1024
+MAX_BATCH_SIZE = 4096 * 4 * 4 * 16
+# Estimated resident memory of a worker process before it runs a program
+# (the interpreter and the imported modules).
+WORKER_BYTES = 64 << 20
+
+def _parse_size(size):
+    """ Parses a sysfs cache size such as "32K" or "8M" into bytes. """
+    size = size.strip()
+    units = { "K": 1 << 10, "M": 1 << 20, "G": 1 << 30 }
+    if size[-1:] in units:
+        return int(size[:-1]) * units[size[-1]]
+    return int(size)
+
+def parse_bytes(size):
+    """ Parses a size in bytes given as a number or a string such as "512M"
+    or "8G". """
+    if isinstance(size, str):
+        return _parse_size(size)
+    return int(size)
+
+def resident_bytes(pid=None):
+    """ Returns the resident memory of a process in bytes, or None if it
+    cannot be read.
+
+    The size is read from `/proc/<pid>/statm` on Linux. If `pid` is None, the
+    size of this process is returned.
+
+    """
+    path = "/proc/{}/statm".format("self" if pid is None else pid)
+    try:
+        with open(path) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def cache_size(level, default=None):
+    """ Returns the size in bytes of the data cache at the given level.
+
+    The size is read from `/sys/devices/system/cpu` on Linux. If it cannot be
+    determined, `default` is returned.
+
+    """
+    for index in sorted(glob.glob(os.path.join(_SYSFS_CACHE, "index*"))):
+        try:
+            with open(os.path.join(index, "level")) as f:
+                if int(f.read()) != level:
+                    continue
+            with open(os.path.join(index, "type")) as f:
+                if f.read().strip() == "Instruction":
+                    continue
+            with open(os.path.join(index, "size")) as f:
+                return _parse_size(f.read())
+        except (OSError, ValueError):
+            continue
+    return default
+
+def auto_batch_size(program, values, cache_bytes, default):
+    """ Returns a batch size whose live pieces fit in `cache_bytes`.
+
+    Returns `default` if the footprint of the program is unknown.
+
+    """
+    per_element = program.bytes_per_element(values)
+    if per_element is None or per_element == 0:
+        return default
+    batch_size = cache_bytes // per_element
+    return max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, batch_size))
+
+class BatchController:
+    """ A feedback controller that adjusts the batch size while a worker runs.
+
+    The controller fits the time of each batch to `overhead + cost * size`.
+    It grows the batch size while the fixed per-batch overhead is more than
+    `target_overhead` of a batch's time, and shrinks it when the time per
+    element spikes above the best observed time per element (e.g., because
+    pieces no longer fit in cache).
+
+    After a spike, the batch size does not grow above the smaller size for
+    `window` batches. Each time the size that spiked spikes again when it is
+    probed, the controller waits twice as long before probing it again, so
+    the batch size settles below sizes that are always slow.
+
+    """
+
+    __slots__ = [ "size", "target_overhead", "tolerance", "min_size", "max_size",
+            "window", "samples", "best_cost", "ceiling", "hold", "held", "spiked" ]
+
+    def __init__(self, size, target_overhead=0.05, tolerance=0.5,
+            min_size=MIN_BATCH_SIZE, max_size=MAX_BATCH_SIZE, window=8):
+        """ Create a controller starting at the given batch size.
+
+        Parameters
+        ----------
+
+        size : the initial batch size.
+        target_overhead : the fraction of a batch's time that may be spent on
+        fixed per-batch overhead before the batch size grows.
+        tolerance : the fraction by which the time per element may exceed the
+        best observed time per element before the batch size shrinks.
+        min_size : the smallest batch size to choose.
+        max_size : the largest batch size to choose.
+        window : the number of recent batches used to fit the cost model.
+
+        """
+        self.size = size
+        self.target_overhead = target_overhead
+        self.tolerance = tolerance
+        self.min_size = min(min_size, size)
+        self.max_size = max(max_size, size)
+        self.window = window
+        # Recent (elements, seconds) pairs.
+        self.samples = []
+        self.best_cost = None
+        # After a spike, the size the batch size may not grow above until
+        # `hold` batches were recorded since the spike, and the number
+        # recorded so far.
+        self.ceiling = None
+        self.hold = window
+        self.held = 0
+        # The batch size at which the last spike happened.
+        self.spiked = None
+
+    def _fit(self):
+        """ Returns (overhead, cost per element) fit to the recent samples,
+        or None if the samples do not have distinct sizes.
+        """
+        n = len(self.samples)
+        mean_x = sum(x for (x, _) in self.samples) / n
+        mean_y = sum(y for (_, y) in self.samples) / n
+        var_x = sum((x - mean_x) ** 2 for (x, _) in self.samples)
+        if var_x == 0:
+            return None
+        cov = sum((x - mean_x) * (y - mean_y) for (x, y) in self.samples)
+        cost = max(cov / var_x, 0.0)
+        overhead = max(mean_y - cost * mean_x, 0.0)
+        return (overhead, cost)
+
+    def record(self, elements, seconds):
+        """ Record the time taken by a batch and update the batch size. """
+        if elements <= 0:
+            return
+        self.samples.append((elements, seconds))
+        if len(self.samples) > self.window:
+            self.samples.pop(0)
+
+        cost = seconds / elements
+        if elements == self.size and self.best_cost is not None and\
+                cost > self.best_cost * (1.0 + self.tolerance):
+            # Latency spike: back off and forget the old model.
+            if self.spiked is not None and self.size >= self.spiked:
+                # The size spiked again when it was probed.
+                self.hold *= 2
+            self.spiked = self.size
+            self.size = max(self.min_size, self.size // 2)
+            self.ceiling = self.size
+            self.held = 0
+            self.samples = []
+            self.best_cost = None
+            return
+
+        if self.spiked is not None and elements >= self.spiked:
+            # The size that spiked no longer does.
+            self.spiked = None
+            self.hold = self.window
+
+        if elements == self.size and (self.best_cost is None or cost < self.best_cost):
+            self.best_cost = cost
+
+        if self.ceiling is not None:
+            self.held += 1
+            if self.held >= self.hold:
+                self.ceiling = None
+        largest = self.max_size if self.ceiling is None else self.ceiling
+
+        fit = self._fit()
+        if fit is None:
+            # Probe a second size so the overhead can be estimated.
+            self.size = min(largest, self.size * 2)
+            return
+
+        (overhead, per_element) = fit
+        total = overhead + per_element * self.size
+        if total > 0 and overhead / total > self.target_overhead:
+            self.size = min(largest, self.size * 2)
+
+def choose_workers(elements, element_cost, merge_cost, worker_overhead, max_workers):
+    """ Returns the number of workers that minimizes the estimated run time.
+
+    A pipeline over `elements` elements is modeled as taking
+
+        elements * element_cost / workers + worker_overhead * workers
+
+    seconds with more than one worker, plus `elements * merge_cost` seconds to
+    merge the partial results. With one worker, the pipeline runs in-process
+    and needs no merge.
+
+    Parameters
+    ----------
+
+    elements : the number of elements to process.
+    element_cost : the measured processing time per element, in seconds.
+    merge_cost : the estimated merge time per element, in seconds.
+    worker_overhead : the time to start a worker and collect its result.
+    max_workers : the largest number of workers to choose.
+
+    """
+    best_workers = 1
+    best_time = elements * element_cost
+    for workers in range(2, max_workers + 1):
+        time = elements * (element_cost / workers + merge_cost) + worker_overhead * workers
+        if time < best_time:
+            best_workers = workers
+            best_time = time
+    return best_workers
+
+def fit_memory(limit, elements, batch_bytes, result_bytes, driver_bytes, batch_size,
+        max_workers):
+    """ Returns the (workers, batch size, estimated bytes) of a pipeline run
+    that fits in `limit` bytes.
+
+    A run with `workers` workers and batches of `batch_size` elements is
+    modeled as using
+
+        driver_bytes + 2 * elements * result_bytes
+            + workers * (WORKER_BYTES + batch_size * batch_bytes)
+            + elements * result_bytes
+
+    bytes: the driver holds the partial results and the merged result, each
+    worker holds the pieces of one batch, and the workers together hold the
+    merged values of their partitions until they are sent back. The most
+    workers whose batches can be at least MIN_BATCH_SIZE (or `batch_size`, if
+    it is smaller) are chosen, with the largest batch size up to
+    `batch_size`. If no run fits, one worker with the smallest batches is
+    used.
+
+    Parameters
+    ----------
+
+    limit : the memory budget of the run, in bytes.
+    elements : the number of elements to process.
+    batch_bytes : the bytes per element of the pieces live in one batch, or
+    None if unknown.
+    result_bytes : the bytes per element of the merged values, or None if
+    unknown.
+    driver_bytes : the memory the driver uses before the run.
+    batch_size : the largest batch size to choose.
+    max_workers : the largest number of workers to choose.
+
+    """
+    batch_bytes = batch_bytes or 0
+    result_bytes = result_bytes or 0
+    min_batch_size = min(MIN_BATCH_SIZE, batch_size)
+    fixed = driver_bytes + 3 * elements * result_bytes
+
+    def footprint(workers, batch_size):
+        return fixed + workers * (WORKER_BYTES + batch_size * batch_bytes)
+
+    for workers in range(max_workers, 0, -1):
+        available = (limit - fixed) // workers - WORKER_BYTES
+        if available < 0:
+            continue
+        size = batch_size if batch_bytes == 0 else min(batch_size, available // batch_bytes)
+        if size >= min_batch_size:
+            return workers, size, footprint(workers, size)
+    return 1, min_batch_size, footprint(1, min_batch_size)
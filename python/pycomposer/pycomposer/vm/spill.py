@@ -0,0 +1,296 @@
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import weakref
+
+# Maps the spill files of this process to a weak reference to the array
+# stored in each. Files are keyed by path rather than by the id of their
+# array, which a new array may reuse before the old array's file is removed.
+_FILES = {}
+# The spill directory created by this process under each base directory.
+_DIRECTORIES = {}
+# The directories of ended runs that still hold files of live arrays (see
+# `reclaim`).
+_ENDED = set()
+# The spill directory of the job running on each thread.
+_CURRENT = threading.local()
+# Guards the tables above, which pipelines running on different threads
+# share.
+_LOCK = threading.RLock()
+
+def directory(base=None):
+    """ Returns this process's spill directory under `base` (by default, the
+    system's temporary directory), creating it if necessary. The directory
+    and the files left in it are removed when the process exits. """
+    if base is None:
+        base = tempfile.gettempdir()
+    # Spill files are keyed by the absolute paths their arrays report.
+    base = os.path.abspath(base)
+    with _LOCK:
+        path = _DIRECTORIES.get(base)
+        if path is None:
+            path = tempfile.mkdtemp(prefix="pycomposer-spill-", dir=base)
+            _DIRECTORIES[base] = path
+        return path
+
+def _remove_directories():
+    for path in _DIRECTORIES.values():
+        shutil.rmtree(path, ignore_errors=True)
+
+atexit.register(_remove_directories)
+
+def run_directory(base=None):
+    """ Returns a new directory for the spill files of one run, in this
+    process's spill directory under `base` (see `directory`). """
+    return tempfile.mkdtemp(prefix="run-", dir=directory(base))
+
+def _remove_if_unused(path):
+    """ Removes the directory of an ended run if no array owns a file in it.
+    Called with the lock held. """
+    if any(os.path.dirname(file) == path for file in _FILES):
+        _ENDED.add(path)
+        return
+    _ENDED.discard(path)
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+def reclaim(path):
+    """ Ends a run started with `run_directory`.
+
+    Workers hand the files of the results they send to the driver (see
+    `reduce_spilled`), so the files of results that the driver discarded
+    without loading them, e.g. because another chunk of the run failed, are
+    owned by no process. These are the files in the run's directory that no
+    array of this process owns, and they are removed. The directory itself
+    is removed once the arrays that own its other files are collected.
+
+    """
+    with _LOCK:
+        owned = set(_FILES)
+        for name in os.listdir(path):
+            file = os.path.join(path, name)
+            if file not in owned:
+                try:
+                    os.unlink(file)
+                except FileNotFoundError:
+                    pass
+        _remove_if_unused(path)
+
+def use_directory(path):
+    """ Sets the directory the calling thread creates spill files in. Workers
+    use the directory of the driver that sent them the job. """
+    _CURRENT.directory = path
+
+def _unlink(path, ref):
+    """ Removes the file of a collected spilled array, and the directory of
+    its run if it was the last file of an ended run. `ref` is the weak
+    reference registered for the array, since the file may have been handed
+    to another process, and a new file created under the same path. """
+    with _LOCK:
+        if _FILES.get(path) is not ref:
+            return
+        del _FILES[path]
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        if os.path.dirname(path) in _ENDED:
+            _remove_if_unused(os.path.dirname(path))
+
+def _own(array, path):
+    """ Registers the file of an array, which is removed with the array. """
+    path = os.path.abspath(path)
+    ref = weakref.ref(array)
+    with _LOCK:
+        _FILES[path] = ref
+    weakref.finalize(array, _unlink, path, ref)
+    return array
+
+def spill_empty(shape, dtype=float):
+    """ Returns a new array stored in a spill file.
+
+    The array is memory mapped, so the OS can write its pages back to disk
+    instead of keeping them in memory. The file is removed when the array is
+    garbage collected. Arrays allocated this way are passed to other
+    processes by the name of their file instead of being copied.
+
+    """
+    import numpy as np
+    if not isinstance(shape, tuple):
+        shape = tuple(shape) if np.iterable(shape) else (shape,)
+    (fd, path) = tempfile.mkstemp(suffix=".npy", dir=getattr(_CURRENT, "directory", None) or directory())
+    os.close(fd)
+    array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    return _own(array, path)
+
+def spill_array(array):
+    """ Returns a copy of an array stored in a spill file (see
+    `spill_empty`). """
+    copy = spill_empty(array.shape, array.dtype)
+    copy[...] = array
+    copy.flush()
+    return copy
+
+def _columns(value):
+    """ Returns the NumPy arrays of the columns of a Series or DataFrame. """
+    if value.ndim == 1:
+        return [value.to_numpy(copy=False)]
+    return [value.iloc[:, i].to_numpy(copy=False) for i in range(value.shape[1])]
+
+def _array(value):
+    """ Returns whether a value is a NumPy array. Checked without importing
+    NumPy, as in `transport._numpy`. """
+    np = sys.modules.get("numpy")
+    return np is not None and isinstance(value, np.ndarray)
+
+def _pandas_value(value):
+    """ Returns whether a value is a Pandas Series or DataFrame. Checked
+    without importing Pandas, as in `transport._pandas`. """
+    pd = sys.modules.get("pandas")
+    return pd is not None and isinstance(value, (pd.Series, pd.DataFrame))
+
+def spilled(value):
+    """ Returns whether a value is an array stored in a spill file, or a
+    Pandas value with a column stored in one. """
+    if _array(value):
+        return _file_of(value) is not None
+    if _pandas_value(value):
+        return any(_file_of(column) is not None for column in _columns(value))
+    return False
+
+def frame(columns, names, index, name):
+    """ Returns a Series (if `names` is None) or a DataFrame whose columns are
+    the given arrays, without copying them. """
+    import pandas as pd
+    if names is None:
+        return pd.Series(columns[0], index=index, name=name, copy=False)
+    value = pd.DataFrame(dict(enumerate(columns)), index=index, copy=False)
+    value.columns = names
+    return value
+
+def _root(array):
+    """ Returns the array that an array is a view of, or the array itself. """
+    root = array
+    while _array(root.base):
+        root = root.base
+    return root
+
+def _owner(root):
+    """ Returns the spill file of an array that is not a view, or None if it
+    is not stored in one. """
+    # Memory-mapped arrays know the file they map.
+    path = getattr(root, "filename", None)
+    with _LOCK:
+        ref = _FILES.get(path)
+    if ref is None or ref() is not root:
+        return None
+    return path
+
+def _file_of(array):
+    """ Returns the spill file of an array, or None if it is not exactly an
+    array returned by `spill_empty`. """
+    root = _root(array)
+    path = _owner(root)
+    if path is None or array.shape != root.shape or array.strides != root.strides or\
+            array.__array_interface__["data"][0] != root.__array_interface__["data"][0]:
+        return None
+    return path
+
+def active():
+    """ Returns whether this process has spilled arrays. """
+    return len(_FILES) > 0
+
+def nbytes(value):
+    """ Returns the bytes held by an array or a Pandas value, or 0 if it is
+    unknown. """
+    if _array(value):
+        return value.nbytes
+    memory_usage = getattr(value, "memory_usage", None)
+    if memory_usage is not None and hasattr(value, "index"):
+        usage = memory_usage(index=True, deep=False)
+        return int(usage.sum()) if hasattr(usage, "sum") else int(usage)
+    return 0
+
+def _transfer(array):
+    """ Hands the file of a spilled array to the process that unpickles it,
+    which removes it once it is done with the array. """
+    with _LOCK:
+        path = _owner(_root(array))
+        del _FILES[path]
+        return path
+
+def _load(path):
+    """ Maps a spilled array handed over by another process. """
+    import numpy as np
+    array = np.load(path, mmap_mode="r+")
+    return _own(array, path)
+
+def reduce_spilled(value):
+    """ Returns the pickle reduction of a spilled value, which passes the
+    files of its arrays instead of their data, or NotImplemented if the value
+    is not spilled. """
+    if _array(value):
+        if _file_of(value) is None:
+            return NotImplemented
+        return (_load, (_transfer(value),))
+    if _pandas_value(value) and spilled(value):
+        names = None if value.ndim == 1 else value.columns
+        name = value.name if value.ndim == 1 else None
+        return (frame, (_columns(value), names, value.index, name))
+    return NotImplemented
+
+class Spiller:
+    """
+    Spills the pieces a worker keeps for merged values once they take more
+    than a threshold of bytes.
+
+    Pieces are spilled with the `spill` method of their split type. Types that
+    do not support spilling keep their pieces in memory.
+
+    """
+
+    __slots__ = [ "types", "threshold", "pending", "held", "counted" ]
+
+    def __init__(self, types, threshold):
+        """
+        Parameters
+        ----------
+
+        types : maps the targets of merged values to their split types.
+        threshold : the bytes of pieces held before they are spilled.
+
+        """
+        self.types = types
+        self.threshold = threshold
+        # The (target, index) of pieces that were not spilled yet, and their
+        # bytes.
+        self.pending = []
+        self.held = 0
+        # The number of pieces of each target seen so far.
+        self.counted = {}
+
+    def update(self, context):
+        """ Records the new pieces in the context, spilling the pieces held in
+        memory if they take more than the threshold. """
+        for target in self.types:
+            pieces = context.get(target) or []
+            for i in range(self.counted.get(target, 0), len(pieces)):
+                self.pending.append((target, i))
+                self.held += nbytes(pieces[i])
+            self.counted[target] = len(pieces)
+        if self.held <= self.threshold:
+            return
+        for (target, i) in self.pending:
+            pieces = context[target]
+            copy = self.types[target].spill(pieces[i])
+            if copy is not None:
+                pieces[i] = copy
+        # Pieces that could not be spilled stay in memory.
+        self.pending = []
+        self.held = 0
@@ -0,0 +1,524 @@
+
+from multiprocessing import resource_tracker, shared_memory
+import importlib
+import io
+import itertools
+import os
+import pickle
+import sys
+import threading
+import types
+import weakref
+
+from . import spill
+
+# Buffers of results smaller than this are pickled with the result.
+OUT_OF_BAND_BYTES = 1 << 16
+# Alignment of buffers within a result segment.
+_ALIGNMENT = 64
+
+# Maps the id of arrays allocated with `shared_empty` to their segment.
+_SEGMENTS = {}
+# Unlinked segments that could not be closed yet because a buffer still
+# referenced their memory.
+_PENDING_CLOSE = []
+# Guards the segment tables, which pipelines running on different threads
+# share.
+_LOCK = threading.RLock()
+# Held while a segment is mapped without registering it (see `_attach`).
+_ATTACH_LOCK = threading.Lock()
+# Numbers the segments named by this process (see `segment_name`).
+_NAMES = itertools.count()
+
+def _close_pending():
+    """ Close unlinked segments whose buffers were released. """
+    global _PENDING_CLOSE
+    with _LOCK:
+        pending = []
+        for shm in _PENDING_CLOSE:
+            try:
+                shm.close()
+            except BufferError:
+                pending.append(shm)
+        _PENDING_CLOSE = pending
+
+def _free(key):
+    """ Unlinks the segment of a collected shared array. """
+    with _LOCK:
+        shm = _SEGMENTS.pop(key, None)
+        if shm is None:
+            return
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+        _PENDING_CLOSE.append(shm)
+
+def _attach(name):
+    """
+    Maps a segment created by another process without registering it with
+    the resource tracker.
+
+    The tracker unlinks the segments registered with it when the processes
+    using it exit, and warns about them. Only the process that unlinks a
+    segment (the creator, or the driver for the results of its workers)
+    may register it: workers share the driver's tracker (see
+    `WorkerPool._spawn`), so a worker that registered a segment it only
+    maps would leave the tracker a segment that is already unlinked.
+
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # Older versions register every segment they map.
+    with _ATTACH_LOCK:
+        register = resource_tracker.register
+        def register_others(resource, rtype):
+            if rtype != "shared_memory" or resource.lstrip("/") != name.lstrip("/"):
+                register(resource, rtype)
+        resource_tracker.register = register_others
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+def shared_empty(shape, dtype=float):
+    """ Returns a new array backed by a named shared memory segment.
+
+    Arrays allocated this way are passed to worker processes by name instead
+    of being copied, and writes made by workers are visible to the caller.
+    The segment is freed when the array is garbage collected.
+
+    """
+    import numpy as np
+    _close_pending()
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    with _LOCK:
+        _SEGMENTS[id(array)] = shm
+    weakref.finalize(array, _free, id(array))
+    return array
+
+def _segment_of(array):
+    """ Returns the segment backing an array or one of its views, if any. """
+    np = _numpy()
+    root = array
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    with _LOCK:
+        shm = _SEGMENTS.get(id(root))
+    if shm is None:
+        return None, None
+    return shm, root
+
+class SharedArray:
+    """
+    A descriptor of an array in a shared memory segment.
+
+    Descriptors are small, so they can be pickled and sent to workers, which
+    map the segment and rebuild the array without copying it.
+
+    """
+
+    __slots__ = [ "name", "offset", "shape", "dtype", "strides" ]
+
+    def __init__(self, name, offset, shape, dtype, strides):
+        self.name = name
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+        self.strides = strides
+
+    @staticmethod
+    def describe(array, shm, root):
+        """ Returns a descriptor for an array that is a view into root. """
+        offset = array.__array_interface__["data"][0] -\
+                root.__array_interface__["data"][0]
+        return SharedArray(shm.name, offset, array.shape, array.dtype, array.strides)
+
+    def attach(self, segments):
+        """ Rebuilds the array, mapping its segment if necessary.
+
+        segments : a dictionary of mapped segments, keyed by name.
+
+        """
+        shm = segments.get(self.name)
+        if shm is None:
+            shm = _attach(self.name)
+            segments[self.name] = shm
+        import numpy as np
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf,
+                offset=self.offset, strides=self.strides)
+
+def _shareable(value):
+    """ Returns whether a value can be placed in shared memory. """
+    np = _numpy()
+    return np is not None and isinstance(value, np.ndarray) and not value.dtype.hasobject
+
+def _numpy():
+    """ Returns the numpy module if it was imported.
+
+    Values can only be arrays if NumPy was imported, and subinterpreters
+    cannot import it (see `interpreters`), so it is only imported where
+    arrays are created.
+
+    """
+    return sys.modules.get("numpy")
+
+def _pandas():
+    """ Returns the pandas module if it was imported.
+
+    Values can only be pandas objects if pandas was imported, so this avoids
+    importing it in programs that do not use it.
+
+    """
+    return sys.modules.get("pandas")
+
+def _column_array(column):
+    """ Returns the NumPy array of a Series if it can be shared, else None. """
+    np = _numpy()
+    if not isinstance(column.dtype, np.dtype) or column.dtype.hasobject:
+        # Extension dtypes keep their data in other structures.
+        return None
+    return column.to_numpy(copy=False)
+
+class SpilledArray:
+    """
+    A descriptor of an array stored in a spill file (see `spill.spill_empty`).
+
+    Workers map the file instead of receiving a copy of the array. The driver
+    keeps the file, so the workers' writes are visible to it.
+
+    """
+
+    __slots__ = [ "path" ]
+
+    def __init__(self, path):
+        self.path = path
+
+    def attach(self, segments):
+        """ Maps the array's file. """
+        import numpy as np
+        return np.load(self.path, mmap_mode="r+")
+
+class SharedColumns:
+    """
+    A descriptor of a Pandas Series or DataFrame whose columns are in shared
+    memory.
+
+    Each column with a NumPy dtype is described by a SharedArray. Other
+    columns and the index are small or cannot be shared, so they are pickled
+    with the descriptor.
+
+    """
+
+    __slots__ = [ "columns", "names", "index", "name" ]
+
+    def __init__(self, columns, names, index, name):
+        """
+        Parameters
+        ----------
+
+        columns : a SharedArray or value for each column.
+        names : the column labels, or None for a Series.
+        index : the index of the value.
+        name : the name of a Series.
+
+        """
+        self.columns = columns
+        self.names = names
+        self.index = index
+        self.name = name
+
+    def attach(self, segments):
+        """ Rebuilds the Series or DataFrame as views of its segments. """
+        pd = _pandas()
+        if pd is None:
+            import pandas as pd
+        columns = [column.attach(segments) if isinstance(column, (SharedArray, SpilledArray))\
+                else column for column in self.columns]
+        if self.names is None:
+            return pd.Series(columns[0], index=self.index, name=self.name, copy=False)
+        frame = pd.DataFrame(dict(enumerate(columns)), index=self.index, copy=False)
+        frame.columns = self.names
+        return frame
+
+class Export:
+    """
+    The values of a job, prepared for sending to worker processes.
+
+    Arrays and the columns of Pandas objects that already live in shared
+    memory are sent as descriptors. Others are copied into temporary
+    segments first; if they are mutable, the workers' writes are copied back
+    when the export is closed. Closing the export also unlinks its temporary
+    segments, so they do not outlive the job.
+
+    """
+
+    __slots__ = [ "descriptors", "temporaries", "copy_back" ]
+
+    def __init__(self, values, mutable):
+        """
+        Parameters
+        ----------
+
+        values : a map of arg ID to value.
+        mutable : the arg IDs whose values workers may write to.
+
+        """
+        _close_pending()
+        self.descriptors = {}
+        # Arrays copied into shared memory for this export.
+        self.temporaries = []
+        # (original, column, copy) to write back after the job. column is None
+        # if original is an array.
+        self.copy_back = []
+        pd = _pandas()
+        for (key, value) in values.items():
+            if _shareable(value):
+                self.descriptors[key] = self._share(value, key in mutable, value, None)
+            elif pd is not None and isinstance(value, pd.Series):
+                array = _column_array(value)
+                column = value if array is None else\
+                        self._share(array, key in mutable, value, 0)
+                self.descriptors[key] = SharedColumns([column], None, value.index, value.name)
+            elif pd is not None and isinstance(value, pd.DataFrame):
+                columns = []
+                for i in range(value.shape[1]):
+                    array = _column_array(value.iloc[:, i])
+                    if array is None:
+                        columns.append(value.iloc[:, i].to_numpy())
+                    else:
+                        columns.append(self._share(array, key in mutable, value, i))
+                self.descriptors[key] = SharedColumns(columns, value.columns, value.index, None)
+            else:
+                self.descriptors[key] = value
+
+    def _share(self, array, mutable, original, column):
+        """ Returns a SharedArray for an array, copying it to shared memory if
+        it is not there already. Arrays in spill files are passed by file. """
+        path = spill._file_of(array)
+        if path is not None:
+            return SpilledArray(path)
+        shm, root = _segment_of(array)
+        if shm is None:
+            copy = shared_empty(array.shape, array.dtype)
+            copy[...] = array
+            self.temporaries.append(copy)
+            if mutable:
+                self.copy_back.append((original, column, copy))
+            shm, root = _segment_of(copy)
+            array = copy
+        return SharedArray.describe(array, shm, root)
+
+    def close(self):
+        """ Copies back mutable values and frees temporary segments. """
+        for (original, column, copy) in self.copy_back:
+            if column is None:
+                original[...] = copy
+            elif original.ndim == 1:
+                original.iloc[:] = copy
+            else:
+                original.iloc[:, column] = copy
+        self.copy_back = []
+        for copy in self.temporaries:
+            _free(id(copy))
+        self.temporaries = []
+        _close_pending()
+
+def attach(descriptors, segments):
+    """ Rebuilds the values of an export in a worker process. """
+    values = {}
+    for (key, value) in descriptors.items():
+        if isinstance(value, (SharedArray, SpilledArray, SharedColumns)):
+            value = value.attach(segments)
+        values[key] = value
+    return values
+
+def detach(segments):
+    """ Closes mapped segments, keeping those that are still referenced. """
+    for (name, shm) in list(segments.items()):
+        try:
+            shm.close()
+            del segments[name]
+        except BufferError:
+            pass
+
+def _lookup(module, qualname):
+    """ Returns the object at `qualname` in an imported module, or None. """
+    obj = sys.modules.get(module)
+    for name in qualname.split("."):
+        obj = getattr(obj, name, None)
+    return obj
+
+def _unwrap(module, qualname):
+    """ Imports the function wrapped by the decorated function at `qualname`
+    in a module (see `_ByReferencePickler`). """
+    importlib.import_module(module)
+    return _lookup(module, qualname).__wrapped__
+
+class _ByReferencePickler(pickle.Pickler):
+    """ A pickler that refuses functions and classes defined in `__main__`,
+    which a process running another script cannot import.
+
+    Functions replaced in their module by a decorated version of themselves
+    (e.g., `merge = sa(...)(merge)` or `@sa` in annotated libraries) cannot be
+    found by their name, so they are referenced through the `__wrapped__`
+    attribute of the function that replaced them.
+
+    """
+
+    def reducer_override(self, obj):
+        if isinstance(obj, (type, types.FunctionType, types.BuiltinFunctionType)) and\
+                getattr(obj, "__module__", None) == "__main__":
+            raise pickle.PicklingError("{!r} is defined in __main__; functions and split types "
+                    "sent to remote workers must be importable by module path".format(obj))
+        if isinstance(obj, types.FunctionType):
+            wrapper = _lookup(obj.__module__, obj.__qualname__)
+            if wrapper is not obj and getattr(wrapper, "__wrapped__", None) is obj:
+                return (_unwrap, (obj.__module__, obj.__qualname__))
+        return NotImplemented
+
+class _SpillPickler(pickle.Pickler):
+    """ A pickler that passes arrays in spill files by file (see
+    `spill.reduce_spilled`). """
+
+    def reducer_override(self, obj):
+        return spill.reduce_spilled(obj)
+
+def dumps_by_reference(obj):
+    """ Pickles an object for a process that does not share the driver's code.
+
+    Unlike cloudpickle, functions and classes are referenced by module path
+    rather than pickled by value, so the receiving process must be able to
+    import them.
+
+    """
+    buf = io.BytesIO()
+    _ByReferencePickler(buf, protocol=5).dump(obj)
+    return buf.getvalue()
+
+class SharedResult:
+    """
+    A handle to the result of a worker.
+
+    Results are pickled with protocol 5, and the large buffers that pickle
+    would otherwise copy into the payload (e.g., the data of arrays and
+    DataFrame blocks) are placed in one shared memory segment instead. The
+    driver maps the segment and rebuilds the result as views of it.
+
+    """
+
+    __slots__ = [ "payload", "name", "buffers" ]
+
+    def __init__(self, payload, name, buffers):
+        """
+        Parameters
+        ----------
+
+        payload : the pickled result, without its out-of-band buffers.
+        name : the name of the segment, or None if there are no buffers.
+        buffers : the (offset, size) of each buffer in the segment.
+
+        """
+        self.payload = payload
+        self.name = name
+        self.buffers = buffers
+
+def segment_name():
+    """ Returns a new name for the segment of a worker's result.
+
+    A pool names the segment of each task it sends, so that it can unlink
+    the segment of a task whose worker it stops, even if the worker created
+    the segment or sent its reply before it was stopped.
+
+    """
+    return "pycomposer-{}-{}".format(os.getpid(), next(_NAMES))
+
+def share_result(result, name=None):
+    """ Returns a SharedResult for a worker's result. If its buffers need a
+    segment, it is created with the given name (see `segment_name`), or with
+    a random name if `name` is None. """
+    large = []
+    # Without NumPy, the buffers could not be mapped back as arrays, so
+    # the few there are (e.g., of bytearrays) are kept in the payload.
+    in_band = _numpy() is None
+    def out_of_band(buf):
+        if in_band or buf.raw().nbytes < OUT_OF_BAND_BYTES:
+            return True
+        large.append(buf)
+        return False
+
+    if spill.active():
+        buf = io.BytesIO()
+        _SpillPickler(buf, protocol=5, buffer_callback=out_of_band).dump(result)
+        payload = buf.getvalue()
+    else:
+        payload = pickle.dumps(result, protocol=5, buffer_callback=out_of_band)
+    if len(large) == 0:
+        return SharedResult(payload, None, [])
+
+    buffers = []
+    size = 0
+    for buf in large:
+        size = -(-size // _ALIGNMENT) * _ALIGNMENT
+        buffers.append((size, buf.raw().nbytes))
+        size += buf.raw().nbytes
+
+    # The segment is unlinked by the process that loads the result.
+    shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+    for (buf, (offset, nbytes)) in zip(large, buffers):
+        shm.buf[offset:offset + nbytes] = buf.raw()
+    large = None
+    shm.close()
+    return SharedResult(payload, shm.name, buffers)
+
+def unlink_segment(name):
+    """ Unlinks a segment by name, if it still exists. """
+    try:
+        # Registered with the resource tracker, since this process unlinks it.
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+    shm.close()
+
+def discard_result(handle):
+    """ Frees a SharedResult that will not be loaded.
+
+    Loading a result is what frees its segment, so the segments of results
+    that are dropped, e.g. when another chunk of their run fails, must be
+    unlinked instead. The spill files of their values are removed with the
+    run's spill directory (see `spill.reclaim`).
+
+    """
+    if isinstance(handle, SharedResult) and handle.name is not None:
+        unlink_segment(handle.name)
+
+def load_result(handle):
+    """ Rebuilds a result from a SharedResult without copying its buffers.
+
+    The segment is freed once the rebuilt values are garbage collected.
+    Results that were not shared (e.g., from remote workers) are returned as
+    they are.
+
+    """
+    if not isinstance(handle, SharedResult):
+        return handle
+    if handle.name is None:
+        return pickle.loads(handle.payload)
+    import numpy as np
+    _close_pending()
+    # Registered with the resource tracker, since this process unlinks it.
+    shm = shared_memory.SharedMemory(name=handle.name)
+    (offset, nbytes) = handle.buffers[-1]
+    root = np.ndarray(offset + nbytes, dtype=np.uint8, buffer=shm.buf)
+    with _LOCK:
+        _SEGMENTS[id(root)] = shm
+    weakref.finalize(root, _free, id(root))
+    buffers = [root[offset:offset + nbytes] for (offset, nbytes) in handle.buffers]
+    return pickle.loads(handle.payload, buffers=buffers)
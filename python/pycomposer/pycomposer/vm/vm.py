@@ -12,6 +12,9 @@ class VM:
         self.program = Program()
         # Values, mapping argID -> values
         self.values = dict()
+        # Maps the argID of a selective call's result to the argID of its
+        # coalesced value.
+        self.coalesced = dict()
 
     def get(self, value):
         """
@@ -33,3 +36,15 @@ class VM:
         self.values[arg_id] = value
         return arg_id
 
+    def register_coalesced(self, arg_id):
+        """
+        Register a counter for the coalesced pieces of the value arg_id.
+
+        The coalesced value is internal to the program, so it has no entry
+        in the values map.
+        """
+        coalesced_id = self.ssa_counter
+        self.ssa_counter += 1
+        self.coalesced[arg_id] = coalesced_id
+        return coalesced_id
+
@@ -0,0 +1,93 @@
+
+import itertools
+import threading
+
+# Maps keys to the (initializer, version) registered in this process.
+_INITIALIZERS = {}
+# Maps keys to the (version, object) built in this process.
+_OBJECTS = {}
+# Numbers registrations, so workers rebuild objects whose initializer was
+# replaced.
+_VERSIONS = itertools.count()
+# Guards the tables above. Held while an object is built, so threads of one
+# process build each object once.
+_LOCK = threading.RLock()
+
+class WorkerObject:
+    """
+    A reference to an object built once per worker process by a registered
+    initializer (see `worker_initializer`).
+
+    References are small, so they are sent to workers in place of the object,
+    and each worker builds the object the first time a call uses it. The
+    object is then cached in the worker, so workers that are reused (e.g., by
+    `persistent` evaluations) build it once for all evaluations. Pools that
+    are started for one pipeline exit after it, so their workers build the
+    object again for every pipeline of every evaluation, unless they fork
+    from a driver that has built it itself.
+
+    """
+
+    __slots__ = [ "key", "initializer", "version" ]
+
+    def __init__(self, key, initializer, version):
+        self.key = key
+        self.initializer = initializer
+        self.version = version
+
+    def get(self):
+        """ Returns the object in this process, building it if necessary. """
+        cached = _OBJECTS.get(self.key)
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+        with _LOCK:
+            cached = _OBJECTS.get(self.key)
+            if cached is None or cached[0] != self.version:
+                cached = (self.version, self.initializer())
+                _OBJECTS[self.key] = cached
+            return cached[1]
+
+    def __repr__(self):
+        return "WorkerObject({!r})".format(self.key)
+
+def worker_initializer(key, initializer):
+    """
+    Registers a callable that builds an expensive object (e.g., a model, a
+    compiled regular expression, or a lookup table) once per worker.
+
+    Pass `worker_object(key)` to annotated functions in place of the object.
+    Registering another initializer for a key replaces the object in workers
+    the next time they use it.
+
+    Objects are built once per worker process, and built again when the
+    process is replaced. Without `persistent`, each pipeline starts a pool of
+    its own, so each of its workers builds the object once per pipeline; use
+    a persistent pool to build it once per worker for all evaluations.
+
+    Parameters
+    ----------
+
+    key : a hashable name for the object.
+    initializer : a callable without arguments that returns the object. It is
+    sent to the workers with the job, so it must be picklable; for the
+    "remote" backend, it must be importable by module path (e.g., a
+    `functools.partial` of a module-level function).
+
+    """
+    with _LOCK:
+        _INITIALIZERS[key] = (initializer, next(_VERSIONS))
+
+def worker_object(key):
+    """ Returns a WorkerObject that annotated functions receive as the object
+    built by the initializer registered for key. """
+    with _LOCK:
+        registered = _INITIALIZERS.get(key)
+    assert registered is not None, "no worker initializer registered for {!r}".format(key)
+    (initializer, version) = registered
+    return WorkerObject(key, initializer, version)
+
+def clear_worker_objects():
+    """ Drops the objects built in this process, e.g. to free their memory.
+    They are built again the next time they are used. """
+    with _LOCK:
+        _OBJECTS.clear()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Tests run against the source tree: the package, and the annotated
+# libraries next to it.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(os.path.dirname(ROOT), "lib"))
@@ -0,0 +1,27 @@
+"""
+Annotated functions over Python lists, for backends whose workers cannot
+import NumPy.
+"""
+
+from pycomposer import SplitType, STOP_ITERATION, Broadcast, sa
+
+class ListSplit(SplitType):
+
+    def combine(self, values):
+        return [element for value in values for element in value]
+
+    def split(self, start, end, value):
+        if start >= len(value):
+            return STOP_ITERATION
+        return value[start:end]
+
+    def __str__(self):
+        return "ListSplit"
+
+@sa((ListSplit(), Broadcast()), {}, ListSplit())
+def scale(values, factor):
+    return [value * factor for value in values]
+
+@sa((ListSplit(),), {}, ListSplit())
+def increment(values):
+    return [value + 1 for value in values]
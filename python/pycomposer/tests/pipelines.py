@@ -0,0 +1,34 @@
+"""
+Pipelines over NumPy arrays and Pandas frames whose results are checked
+against NumPy and Pandas, for running the same work under different options.
+"""
+
+import numpy
+import pandas
+
+import composer_numpy as cnp
+import composer_pandas as cp
+
+# Start methods of worker processes to run the pipelines under.
+START_METHODS = ["fork", "spawn"]
+
+def run_numpy(length, dtype="float64", **options):
+    """ Evaluates elementwise calls into an output array, and returns the
+    statistics of the evaluation. """
+    a = numpy.arange(length, dtype=dtype)
+    b = numpy.linspace(1.0, 2.0, length, dtype=dtype)
+    out = cnp.zeros(length, dtype)
+    cnp.sqrt(cnp.multiply(cnp.add(a, b), b), out=out)
+    stats = cnp.evaluate(**options)
+    numpy.testing.assert_allclose(out, numpy.sqrt((a + b) * b), rtol=1e-6)
+    return stats
+
+def run_pandas(length, **options):
+    """ Evaluates a filter followed by elementwise calls on a frame, and
+    returns the statistics of the evaluation. """
+    frame = pandas.DataFrame({"a": numpy.arange(length) % 7,
+            "b": numpy.arange(length, dtype="float64")})
+    result = cp.add(cp.multiply(cp.filter(frame, "a", 3), 2.0), 1.0)
+    stats = cp.evaluate(**options)
+    pandas.testing.assert_frame_equal(result.value, frame[frame["a"] > 3] * 2.0 + 1.0)
+    return stats
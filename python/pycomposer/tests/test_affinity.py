@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import composer_pandas as cp
+from composer_pandas.annotated import DataFrameSplit
+from pycomposer import sa
+from pycomposer.vm import affinity
+
+import pipelines
+
+def test_workers_fill_numa_nodes_in_blocks(monkeypatch):
+    monkeypatch.setattr(affinity, "numa_nodes", lambda: [{0, 1}, {2, 3}])
+    assert affinity.worker_cpus(4, "cores") == [{0}, {1}, {2}, {3}]
+    assert affinity.worker_cpus(4, "numa") == [{0, 1}, {0, 1}, {2, 3}, {2, 3}]
+    # More workers than CPUs share the CPUs of their node.
+    assert affinity.worker_cpus(6, "cores") == [{0}, {1}, {0}, {2}, {3}, {2}]
+    assert affinity.worker_cpus(2, [[0], [1, 2]]) == [{0}, {1, 2}]
+
+@sa((DataFrameSplit(),), {}, DataFrameSplit())
+def _cpus_of_worker(frame):
+    cpus = os.sched_getaffinity(0)
+    return pd.DataFrame({ "first": min(cpus), "count": len(cpus) }, index=frame.index)
+
+@pytest.mark.skipif(not hasattr(os, "sched_getaffinity"), reason="needs sched_getaffinity")
+@pytest.mark.parametrize("options", [
+    dict(backend="threads"),
+    dict(start_method="fork"),
+    dict(start_method="spawn"),
+], ids=repr)
+def test_workers_run_on_their_cpus(options):
+    allowed = os.sched_getaffinity(0)
+    frame = pd.DataFrame({ "x": np.arange(9000, dtype="float64") })
+    result = _cpus_of_worker(frame)
+    stats = cp.evaluate(workers=3, batch_size=1000, affinity="cores", **options)
+    cores = affinity.worker_cpus(3, "cores")
+    assert len(stats[0]["workers"]) == 3
+    for chunk in stats[0]["workers"]:
+        (start, end) = chunk["range"]
+        rows = result.value.iloc[start:end]
+        assert (rows["first"] == min(cores[chunk["worker"]])).all()
+        assert (rows["count"] == 1).all()
+    # The driver's thread is not pinned.
+    assert os.sched_getaffinity(0) == allowed
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_pinned_pipelines_match(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, affinity="cores",
+            start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, affinity="cores",
+            start_method=start_method)
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+import composer_numpy as cnp
+from composer_numpy.annotated import NdArraySplit
+from pycomposer import mut, sa
+from pycomposer.vm.buffers import BufferPool
+
+import pipelines
+
+# The temporaries passed to `_keep`, kept alive so that their buffers cannot
+# be reused by the allocator.
+KEPT = []
+
+@sa((NdArraySplit(),), { "out": mut(NdArraySplit()) }, NdArraySplit())
+def _keep(values, out=None):
+    KEPT.append(values)
+    return np.sqrt(values, out=out)
+
+def test_released_buffers_are_reused():
+    pool = BufferPool()
+    buf = pool.acquire((100,), np.dtype("float64"))
+    pool.release(buf)
+    # Views may alias memory that is still in use, so they are not pooled.
+    pool.release(buf[:])
+    assert pool.acquire((100,), np.dtype("float64")) is buf
+    assert pool.acquire((100,), np.dtype("float64")) is not buf
+    assert pool.allocations == 2
+
+@pytest.mark.parametrize("recycle", [False, True])
+def test_recycled_temporaries_are_not_allocated(recycle):
+    del KEPT[:]
+    a = np.arange(20000, dtype="float64")
+    out = cnp.zeros(20000)
+    _keep(cnp.add(a, a), out=out)
+    stats = cnp.evaluate(workers=1, batch_size=1000, recycle=recycle)
+    np.testing.assert_allclose(out, np.sqrt(a + a))
+    assert len(KEPT) == 20
+    if recycle:
+        # Every batch writes its sum into the buffer of the first batch.
+        assert len(set(id(values) for values in KEPT)) == 1
+        assert stats[0]["workers"][0]["allocations"] == 0
+    else:
+        assert len(set(id(values) for values in KEPT)) == 20
+        assert stats[0]["workers"][0]["allocations"] is None
+    del KEPT[:]
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_recycled_pipelines_match(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, recycle=True,
+            start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, recycle=True,
+            start_method=start_method)
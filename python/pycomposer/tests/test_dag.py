@@ -0,0 +1,54 @@
+import threading
+
+from composer_pandas.annotated import DataFrameSplit
+from pycomposer.dag import _run_concurrently, pipeline_dependencies
+from pycomposer.vm.instruction import Call, Split
+from pycomposer.vm.options import Options
+from pycomposer.vm.vm import VM
+
+def _vm(splits=(), computes=()):
+    """ Returns a VM that splits the given (value, mutable) pairs and
+    computes the given values. """
+    vm = VM()
+    for (value, mutable) in splits:
+        ty = DataFrameSplit()
+        ty.mutable = mutable
+        vm.program.insts.append(Split(vm.register_value(value), ty))
+    for value in computes:
+        vm.program.insts.append(Call(vm.register_value(value), None, [], {}, DataFrameSplit()))
+    return vm
+
+def test_pipeline_dependencies():
+    (a, b) = (object(), object())
+    vms = [
+        _vm(splits=[(a, False)], computes=[b]),
+        # Reading the same value does not order pipelines.
+        _vm(splits=[(a, False)]),
+        _vm(splits=[(b, False)]),
+        # Writing a value waits for the pipelines that read it.
+        _vm(splits=[(a, True)]),
+    ]
+    assert pipeline_dependencies(vms) == [set(), set(), {0}, {0, 1}]
+
+def test_independent_pipelines_run_at_the_same_time():
+    (a, b) = (object(), object())
+    vms = [_vm(splits=[(a, False)], computes=[b]), _vm(splits=[(a, False)]),
+            _vm(splits=[(b, False)])]
+    # Fails unless the first two pipelines run at the same time.
+    both = threading.Barrier(2)
+    finished = []
+    started = {}
+
+    def run(vm, options):
+        j = vms.index(vm)
+        started[j] = (list(finished), options.workers)
+        if j < 2:
+            both.wait(timeout=10)
+        finished.append(j)
+        return j
+
+    assert _run_concurrently(vms, None, Options(workers=4), run) == [0, 1, 2]
+    # The independent pipelines split the workers, and the pipeline that
+    # reads the first one's result starts after it, with all of them.
+    assert started[0] == ([], 2) and started[1] == ([], 2)
+    assert 0 in started[2][0] and started[2][1] == 4
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import composer_pandas as cp
+from composer_pandas.annotated import DataFrameSplit
+from pycomposer import Broadcast, sa
+from pycomposer.vm.driver import _reduce_tree
+from pycomposer.vm.sizing import choose_workers
+
+import pipelines
+
+# The (process, thread) that ran each piece passed to `_record_worker`.
+WORKERS = []
+
+@sa((DataFrameSplit(),), {}, DataFrameSplit())
+def _record_worker(frame):
+    WORKERS.append((os.getpid(), threading.get_ident()))
+    return frame * 2.0
+
+def test_threads_run_in_this_process():
+    del WORKERS[:]
+    s = pd.Series(np.arange(30000, dtype="float64"))
+    result = _record_worker(s)
+    stats = cp.evaluate(workers=3, batch_size=1000, backend="threads")
+    pd.testing.assert_series_equal(result.value, s * 2.0)
+    assert len(stats[0]["workers"]) == 3
+    # Every batch ran on a worker thread of this process, so the inputs were
+    # not copied to other processes.
+    assert len(WORKERS) == 30
+    assert set(pid for (pid, _) in WORKERS) == { os.getpid() }
+    assert threading.get_ident() not in set(thread for (_, thread) in WORKERS)
+    del WORKERS[:]
+
+@pytest.mark.parametrize("length", [0, 20000])
+def test_threaded_pipelines_match(length):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, backend="threads")
+    pipelines.run_pandas(length, workers=3, batch_size=1000, backend="threads")
+
+def test_choose_workers_weighs_overhead():
+    # 1ms of work is not worth starting workers that take 20ms each.
+    assert choose_workers(1000, 1e-6, 0.0, 2e-2, 8) == 1
+    # 10s of work is split between all of them.
+    assert choose_workers(1000000, 1e-5, 0.0, 2e-2, 8) == 8
+    # Merging the results of workers costs as much as the work they save.
+    assert choose_workers(1000000, 1e-6, 1e-6, 1e-3, 8) == 1
+
+@sa((DataFrameSplit(), Broadcast()), {}, DataFrameSplit())
+def _sleep_per_row(series, seconds):
+    time.sleep(seconds * len(series))
+    return series * 2.0
+
+@pytest.mark.parametrize("length, seconds, workers", [
+    (2000, 0.0, 1),
+    (40000, 1e-5, 4),
+])
+def test_auto_workers_follow_pipeline_cost(length, seconds, workers):
+    s = pd.Series(np.arange(length, dtype="float64"))
+    result = _sleep_per_row(s, seconds)
+    stats = cp.evaluate(workers=4, batch_size=1000, auto_workers=True)
+    pd.testing.assert_series_equal(result.value, s * 2.0)
+    assert stats[0]["workers_used"] == workers
+    # The first batch and one partition per worker.
+    assert len(stats[0]["workers"]) == 1 + workers
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_auto_worker_pipelines_match(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, auto_workers=True,
+            start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, auto_workers=True,
+            start_method=start_method)
+
+def test_tree_keeps_element_order():
+    levels = []
+    def reduce_groups(groups):
+        levels.append([len(group) for group in groups])
+        return [sum(group, []) for group in groups]
+    results, count = _reduce_tree([[i] for i in range(10)], 3, reduce_groups)
+    assert results == [[0, 1, 2, 3, 4, 5, 6, 7, 8], [9]]
+    assert count == 2 and levels == [[3, 3, 3, 1], [3, 1]]
+
+@pytest.mark.parametrize("options", [
+    dict(backend="threads"),
+    dict(start_method="fork"),
+    dict(start_method="spawn"),
+], ids=repr)
+def test_partial_results_are_reduced_in_levels(options):
+    s = pd.Series(np.arange(20000, dtype="float64"))
+    result = cp.add(cp.multiply(s, 2.0), 1.0)
+    stats = cp.evaluate(workers=3, batch_size=1000, chunk_batches=1, merge_fanin=2, **options)
+    pd.testing.assert_series_equal(result.value, s * 2.0 + 1.0)
+    # 20 chunks are reduced to 10, 5, 3, and then 2 results.
+    assert stats[0]["merge_levels"] == 4
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_reduced_pipelines_match(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, chunk_batches=1, merge_fanin=2,
+            start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, chunk_batches=1, merge_fanin=2,
+            start_method=start_method)
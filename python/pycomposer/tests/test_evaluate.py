@@ -0,0 +1,183 @@
+import asyncio
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import composer_pandas as cp
+from composer_pandas.annotated import DataFrameSplit
+import pycomposer.dag
+from pycomposer import Options, sa
+from pycomposer.vm import Driver, transport
+from pycomposer.vm.affinity import worker_cpus
+from pycomposer.vm.limits import threads_per_worker
+
+import pipelines
+
+@pytest.mark.parametrize("options", [
+    dict(workers=1),
+    dict(workers=3),
+    dict(workers=3, prefetch=True),
+    dict(workers=2, auto_workers=True, preallocate=True),
+])
+def test_empty_series(options):
+    s = pd.Series(np.arange(0, dtype="float64"))
+    result = cp.add(cp.multiply(s, 2.0), 1.0)
+    cp.evaluate(**options)
+    pd.testing.assert_series_equal(result.value, s * 2.0 + 1.0)
+
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_preallocated_results_are_written_in_place(start_method):
+    s = pd.Series(np.arange(20000, dtype="float64"))
+    result = cp.add(cp.multiply(s, 2.0), 1.0)
+    stats = cp.evaluate(workers=3, batch_size=1000, preallocate=True, start_method=start_method)
+    pd.testing.assert_series_equal(result.value, s * 2.0 + 1.0)
+    # The workers wrote their pieces into the shared array of the result,
+    # so the driver did not concatenate them.
+    assert len(stats[0]["preallocated"]) >= 1
+    (segment, _) = transport._segment_of(result.value.to_numpy())
+    assert segment is not None
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_preallocated_pipelines_match(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, preallocate=True,
+            start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, preallocate=True,
+            start_method=start_method)
+
+def test_preallocate_merge_changing_rows():
+    # The first batch keeps its rows, and later batches double them.
+    left = pd.DataFrame({"k": np.repeat([0, 1], 3000), "a": np.arange(6000, dtype="float64")})
+    right = pd.DataFrame({"k": [0, 1, 1], "b": [1.0, 2.0, 3.0]})
+    result = cp.merge(left, right)
+    cp.evaluate(workers=3, batch_size=1000, preallocate=True)
+    expected = pd.concat([pd.merge(left[i:i + 1000], right) for i in range(0, 6000, 1000)],
+            ignore_index=True)
+    pd.testing.assert_frame_equal(result.value.reset_index(drop=True), expected)
+
+@sa((DataFrameSplit(),), {}, DataFrameSplit())
+def _repeat_rows(frame):
+    # Changes the number of rows, but is not annotated as selective.
+    if frame["a"].iloc[0] == 0:
+        return frame.reset_index(drop=True)
+    return pd.concat([frame, frame], ignore_index=True)
+
+def test_preallocate_rejects_unaligned_pieces():
+    frame = pd.DataFrame({"a": np.arange(3000, dtype="float64")})
+    _repeat_rows(frame)
+    with pytest.raises(ValueError, match="selective=True"):
+        cp.evaluate(workers=1, batch_size=1000, preallocate=True)
+
+def test_priority_without_pool_warns():
+    s = pd.Series(np.arange(1000, dtype="float64"))
+    result = cp.add(s, 1.0)
+    with pytest.warns(RuntimeWarning, match="priority and weight"):
+        cp.evaluate(workers=2, priority=1)
+    pd.testing.assert_series_equal(result.value, s + 1.0)
+
+def test_memory_limit_recomputes_worker_settings(monkeypatch):
+    drivers = []
+
+    class RecordingDriver(Driver):
+        __slots__ = []
+
+        def run(self, program, values):
+            drivers.append(self)
+            return Driver.run(self, program, values)
+
+    monkeypatch.setattr(pycomposer.dag, "Driver", RecordingDriver)
+    s = pd.Series(np.arange(10000, dtype="float64"))
+    result = cp.add(s, 1.0)
+    # No run fits in one byte, so the run falls back to one worker.
+    cp.evaluate(workers=3, memory_limit=1, affinity="cores")
+    pd.testing.assert_series_equal(result.value, s + 1.0)
+    (driver,) = drivers
+    assert driver.workers == 1
+    assert driver.cpus == worker_cpus(1, "cores")
+    assert driver.library_threads == threads_per_worker(1, "auto")
+
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_memory_limit_bounds_the_estimate(start_method):
+    stats = pipelines.run_pandas(20000, workers=3, batch_size=1000, memory_limit="1G",
+            start_method=start_method)
+    assert len(stats[0]["workers"]) == 3
+    assert stats[0]["estimated_memory"] <= 1 << 30
+    assert stats[0]["peak_memory"] > 0
+    # Two workers need more than this on their own (see `WORKER_BYTES`).
+    stats = pipelines.run_pandas(20000, workers=3, batch_size=1000, memory_limit="100M",
+            start_method=start_method)
+    assert len(stats[0]["workers"]) == 1
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_budgeted_pipelines_match(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, memory_limit="1G",
+            start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, memory_limit="1G",
+            start_method=start_method)
+
+@pytest.mark.parametrize("args, kwargs, workers, batch_size", [
+    ((2,), {}, 2, None),
+    ((2, 500), {}, 2, 500),
+    ((Options(workers=2),), dict(batch_size=500), 2, 500),
+    ((), dict(options=Options(workers=2, batch_size=250)), 2, 250),
+])
+def test_evaluate_options(args, kwargs, workers, batch_size):
+    s = pd.Series(np.arange(2000, dtype="float64"))
+    result = cp.add(s, 1.0)
+    stats = cp.evaluate(*args, **kwargs)
+    pd.testing.assert_series_equal(result.value, s + 1.0)
+    assert len(stats[0]["workers"]) == workers
+    if batch_size is not None:
+        assert stats[0]["workers"][0]["batch_sizes"][0] == batch_size
+
+@pytest.mark.parametrize("options", [
+    dict(backend="gpu"), dict(merge_fanin=1), dict(weight=0),
+])
+def test_invalid_options(options):
+    with pytest.raises(ValueError):
+        Options(**options)
+
+@sa((DataFrameSplit(),), {}, DataFrameSplit())
+def _slow_double(series):
+    time.sleep(0.1)
+    return series * 2.0
+
+def test_async_evaluations_do_not_block_the_loop():
+    s = pd.Series(np.arange(3000, dtype="float64"))
+
+    async def main():
+        first = _slow_double(s)
+        evaluation = pycomposer.evaluate_async(workers=1, batch_size=1000)
+        # Registered after the first evaluation started, so evaluated by the
+        # second one.
+        second = cp.add(s, 1.0)
+        other = pycomposer.evaluate_async(workers=1)
+        ticks = 0
+        while not evaluation.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        pd.testing.assert_series_equal(await first, s * 2.0)
+        pd.testing.assert_series_equal(await second, s + 1.0)
+        (stats,) = await evaluation
+        assert len(stats["workers"][0]["batch_sizes"]) == 3
+        await other
+        return ticks
+
+    # The loop kept running while the three batches of 0.1s ran.
+    assert asyncio.run(main()) >= 5
+
+def test_async_errors_reach_operations():
+    s = pd.Series(np.arange(1000, dtype="float64"))
+
+    async def main():
+        result = cp.multiply(s, None)
+        evaluation = pycomposer.evaluate_async(workers=1)
+        with pytest.raises(TypeError):
+            await result
+        with pytest.raises(TypeError):
+            await evaluation
+
+    asyncio.run(main())
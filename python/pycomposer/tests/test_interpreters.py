@@ -0,0 +1,93 @@
+import itertools
+import traceback
+import types
+
+import pytest
+
+import pycomposer
+from pycomposer.vm import interpreters
+
+import lists
+
+OPTIONS = [
+    dict(workers=2),
+    dict(workers=3, chunk_batches=1, merge_fanin=2),
+]
+
+class _InProcessInterpreters:
+    """
+    Stands in for the `_interpreters` module by running the scripts of each
+    "subinterpreter" in a namespace of this interpreter, so that the
+    backend's scheduling, replies, and merges are tested on Pythons without
+    subinterpreters. The scripts share this interpreter's modules and GIL.
+    """
+
+    def __init__(self):
+        self.ids = itertools.count()
+        self.namespaces = {}
+
+    def create(self):
+        id = next(self.ids)
+        self.namespaces[id] = { "__name__": "__main__" }
+        return id
+
+    def set___main___attrs(self, id, attrs):
+        self.namespaces[id].update(attrs)
+
+    def exec(self, id, script):
+        try:
+            exec(script, self.namespaces[id])
+        except Exception:
+            return types.SimpleNamespace(formatted=traceback.format_exc())
+
+    def destroy(self, id):
+        del self.namespaces[id]
+
+@pytest.fixture
+def in_process(monkeypatch):
+    fake = _InProcessInterpreters()
+    monkeypatch.setattr(interpreters, "_interpreters", fake)
+    monkeypatch.setattr(interpreters, "_AVAILABLE", None)
+    yield fake
+    assert fake.namespaces == {}
+
+def _run_lists(options):
+    values = list(range(10000))
+    result = lists.increment(lists.scale(values, 3))
+    stats = pycomposer.evaluate(backend="interpreters", batch_size=1000, **options)
+    assert result.value == [value * 3 + 1 for value in values]
+    return stats
+
+@pytest.mark.skipif(not interpreters.available(),
+        reason="subinterpreters with their own GIL need Python 3.13 or later")
+@pytest.mark.parametrize("options", OPTIONS)
+def test_lists_on_interpreters(options):
+    stats = _run_lists(options)
+    assert len(stats[0]["workers"]) >= options["workers"]
+
+@pytest.mark.parametrize("options", OPTIONS)
+def test_lists_on_in_process_interpreters(in_process, options):
+    stats = _run_lists(options)
+    assert len(stats[0]["workers"]) >= options["workers"]
+    # One interpreter ran each worker, and none are left.
+    assert next(in_process.ids) == options["workers"] + 1
+    if options.get("merge_fanin") is not None:
+        assert stats[0]["merge_levels"] >= 1
+
+def test_interpreters_warn_about_ignored_options(in_process):
+    with pytest.warns(RuntimeWarning, match="cannot prefetch or preallocate"):
+        _run_lists(dict(workers=2, prefetch=True, preallocate=True))
+
+def test_interpreter_errors_are_reported(in_process):
+    values = list(range(1000))
+    lists.scale(values, None)
+    with pytest.raises(interpreters.WorkerError, match="TypeError"):
+        pycomposer.evaluate(workers=2, backend="interpreters", batch_size=100)
+
+def test_unavailable_interpreters_fall_back_to_processes(monkeypatch):
+    monkeypatch.setattr(interpreters, "_AVAILABLE", False)
+    values = list(range(1000))
+    result = lists.scale(values, 2)
+    with pytest.warns(RuntimeWarning, match="using the processes backend"):
+        pycomposer.evaluate(workers=2, backend="interpreters", batch_size=100)
+    assert result.value == [value * 2 for value in values]
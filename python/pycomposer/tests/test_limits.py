@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import composer_pandas as cp
+from composer_pandas.annotated import DataFrameSplit
+import pycomposer
+from pycomposer import sa
+from pycomposer.vm.limits import ThreadLimits, threads_per_worker
+
+import pipelines
+
+def test_threads_per_worker_splits_cpus(monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+    assert threads_per_worker(3, "auto") == 2
+    assert threads_per_worker(16, "auto") == 1
+    # A single worker may use every CPU.
+    assert threads_per_worker(1, "auto") is None
+    assert threads_per_worker(3, 4) == 4
+    assert threads_per_worker(3, None) is None
+
+def test_limits_are_restored_by_the_last_exit(monkeypatch):
+    monkeypatch.setenv("OMP_NUM_THREADS", "8")
+    monkeypatch.delenv("MKL_NUM_THREADS", raising=False)
+    with ThreadLimits(2):
+        with ThreadLimits(3):
+            # The first limit stays in place while it is active.
+            assert os.environ["OMP_NUM_THREADS"] == "2"
+        assert os.environ["MKL_NUM_THREADS"] == "2"
+    assert os.environ["OMP_NUM_THREADS"] == "8"
+    assert "MKL_NUM_THREADS" not in os.environ
+
+@sa((DataFrameSplit(),), {}, DataFrameSplit())
+def _library_threads(frame):
+    threads = int(os.environ.get("OMP_NUM_THREADS", "0"))
+    return pd.DataFrame({ "threads": threads }, index=frame.index)
+
+@pytest.mark.parametrize("options", [
+    dict(backend="threads"),
+    dict(start_method="fork"),
+    dict(start_method="spawn"),
+    dict(start_method="fork", persistent=True),
+], ids=repr)
+def test_workers_see_the_thread_limit(options):
+    before = os.environ.get("OMP_NUM_THREADS")
+    frame = pd.DataFrame({ "x": np.arange(9000, dtype="float64") })
+    result = _library_threads(frame)
+    try:
+        cp.evaluate(workers=3, batch_size=1000, library_threads=1, **options)
+    finally:
+        pycomposer.shutdown()
+    assert (result.value["threads"] == 1).all()
+    assert os.environ.get("OMP_NUM_THREADS") == before
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_limited_pipelines_match(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, library_threads=1,
+            start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, library_threads=1,
+            start_method=start_method)
@@ -0,0 +1,221 @@
+import asyncio
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import composer_pandas as cp
+from composer_pandas.annotated import DataFrameSplit
+import pycomposer
+from pycomposer import Broadcast, sa
+from pycomposer.vm import pool
+
+import pipelines
+
+def test_default_pool_per_start_method():
+    try:
+        forked = pool.default_pool(2, "fork")
+        spawned = pool.default_pool(2, "spawn")
+        # Asking for another start method leaves the first pool running.
+        assert spawned is not forked
+        assert not forked.stopping
+        assert pool.default_pool(2, "fork") is forked
+
+        s = pd.Series(np.arange(10000, dtype="float64"))
+        result = cp.add(s, 1.0)
+        cp.evaluate(workers=2, persistent=True, start_method="fork")
+        pd.testing.assert_series_equal(result.value, s + 1.0)
+        assert not spawned.stopping
+    finally:
+        pycomposer.shutdown()
+    assert forked.stopping and spawned.stopping
+
+def test_persistent_evaluate_without_pipelines():
+    try:
+        assert pycomposer.evaluate(workers=2, persistent=True) == []
+    finally:
+        pycomposer.shutdown()
+
+@sa((DataFrameSplit(),), {}, DataFrameSplit())
+def _worker_pids(frame):
+    return pd.Series(os.getpid(), index=frame.index)
+
+def test_evaluations_reuse_pool_workers(monkeypatch):
+    monkeypatch.setattr(pool, "MAX_WORKERS", 2)
+    df = pd.DataFrame({"x": np.arange(20000.0)})
+    pids = []
+    try:
+        for _ in range(3):
+            result = _worker_pids(df)
+            cp.evaluate(workers=2, batch_size=1000, persistent=True)
+            pids.append(set(result.value))
+    finally:
+        pycomposer.shutdown()
+    # The same two processes ran every evaluation.
+    assert len(pids[0]) == 2 and os.getpid() not in pids[0]
+    assert pids[1] == pids[0] and pids[2] == pids[0]
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_persistent_pipelines_match(length, start_method):
+    try:
+        pipelines.run_numpy(length, workers=3, batch_size=1000, persistent=True,
+                start_method=start_method)
+        pipelines.run_pandas(length, workers=3, batch_size=1000, persistent=True,
+                start_method=start_method)
+    finally:
+        pycomposer.shutdown()
+
+@sa((DataFrameSplit(),), {}, DataFrameSplit())
+def _finished_at(frame):
+    time.sleep(0.02)
+    return pd.Series(time.time(), index=frame.index)
+
+def _share_one_worker(monkeypatch, first, second, delay):
+    """ Runs two evaluations of 20 chunks on a pool of one worker, the second
+    one `delay` seconds after the first, and returns the times at which the
+    chunks of each finished. """
+    monkeypatch.setattr(pool, "MAX_WORKERS", 1)
+    df = pd.DataFrame({"x": np.arange(20000.0)})
+
+    async def main():
+        results = []
+        evaluations = []
+        for options in (first, second):
+            results.append(_finished_at(df))
+            evaluations.append(pycomposer.evaluate_async(workers=2, batch_size=1000,
+                    chunk_batches=1, persistent=True, **options))
+            await asyncio.sleep(delay)
+        await asyncio.gather(*evaluations)
+        return [sorted(set(await result)) for result in results]
+
+    try:
+        return asyncio.run(main())
+    finally:
+        pycomposer.shutdown()
+
+def test_higher_priority_evaluation_goes_first(monkeypatch):
+    (low, high) = _share_one_worker(monkeypatch, {}, dict(priority=1), 0.1)
+    assert len(low) == 20 and len(high) == 20
+    # Once the first chunk of the second evaluation ran, the worker ran no
+    # chunks of the first until the second finished.
+    assert not any(high[0] < end < high[-1] for end in low)
+
+def test_evaluations_share_workers_by_weight(monkeypatch):
+    (heavy, light) = _share_one_worker(monkeypatch, dict(weight=3.0), {}, 0.0)
+    # Until one of them finished, the evaluation with three times the weight
+    # ran about three times as many chunks.
+    end = min(heavy[-1], light[-1])
+    (ran_heavy, ran_light) = (sum(t <= end for t in heavy), sum(t <= end for t in light))
+    assert ran_light >= 3 and 2 * ran_light <= ran_heavy <= 5 * ran_light
+
+@sa((DataFrameSplit(), Broadcast()), {}, DataFrameSplit())
+def _crash_once(values, marker):
+    # Exits the first worker process that runs it, as if it were killed.
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        return values * 2.0
+    os._exit(1)
+
+@pytest.mark.parametrize("options", [
+    dict(start_method="fork"),
+    dict(start_method="spawn"),
+    dict(start_method="fork", persistent=True),
+    dict(start_method="fork", chunk_batches=2),
+], ids=repr)
+def test_crashed_worker_is_retried(tmp_path, options):
+    values = pd.Series(np.arange(20000, dtype="float64"))
+    result = _crash_once(values, str(tmp_path / "crashed"))
+    try:
+        stats = cp.evaluate(workers=2, batch_size=1000, **options)
+    finally:
+        pycomposer.shutdown()
+    pd.testing.assert_series_equal(result.value, values * 2.0)
+    assert stats[0]["retries"] >= 1
+
+def test_crashes_fail_without_retries(tmp_path):
+    values = pd.Series(np.arange(20000, dtype="float64"))
+    _crash_once(values, str(tmp_path / "crashed"))
+    try:
+        with pytest.raises(pool.WorkerCrashedError):
+            cp.evaluate(workers=2, batch_size=1000, persistent=True, retries=0)
+    finally:
+        pycomposer.shutdown()
+
+def _segments():
+    return set(os.listdir("/dev/shm"))
+
+@sa((DataFrameSplit(), Broadcast()), {}, DataFrameSplit())
+def _fail_at_end(frame, crash):
+    # Fails the last chunk, once the others have returned their results.
+    if frame["x"].iloc[-1] == 199999.0:
+        if crash:
+            os._exit(1)
+        raise RuntimeError("last chunk failed")
+    return frame + 1.0
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs /dev/shm")
+@pytest.mark.parametrize("crash", [False, True])
+def test_failed_run_frees_finished_results(crash):
+    df = pd.DataFrame({"x": np.arange(200000.0)})
+    try:
+        pool.default_pool(2)
+        before = _segments()
+        _fail_at_end(df, crash)
+        error = pool.WorkerCrashedError if crash else pool.WorkerError
+        with pytest.raises(error):
+            cp.evaluate(workers=2, batch_size=10000, chunk_batches=1, persistent=True,
+                    retries=1)
+        assert _segments() == before
+    finally:
+        pycomposer.shutdown()
+
+@sa((DataFrameSplit(), Broadcast()), {}, DataFrameSplit())
+def _straggle(frame, deadline):
+    # The first chunk and its copy both finish at the deadline, so the copy
+    # that loses is stopped around the time it returns its result.
+    if frame["x"].iloc[0] == 0.0:
+        time.sleep(max(0.0, deadline - time.time()))
+    return frame + 1.0
+
+def test_only_late_stragglers_are_copied():
+    job = pool._Job(0, None, 0, 1.0, 2, True, None)
+    job.slots = 4
+    job.durations = [1.0, 1.0, 2.0]
+    job.exhausted = {0, 1}
+    # Too many slots still have tasks left.
+    assert not job.straggling(3, 10.0)
+    job.exhausted.add(2)
+    assert job.straggling(3, 1.6) and not job.straggling(3, 1.4)
+    job.copied.add(3)
+    assert not job.straggling(3, 10.0)
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_speculative_pipelines_match(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, chunk_batches=1, speculate=True,
+            start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, chunk_batches=1, speculate=True,
+            start_method=start_method)
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs /dev/shm")
+def test_speculation_frees_results_of_stopped_copies(monkeypatch):
+    # Copies need idle workers, however many CPUs there are.
+    monkeypatch.setattr(pool, "MAX_WORKERS", 4)
+    df = pd.DataFrame({"x": np.arange(160000.0)})
+    try:
+        pool.default_pool(4)
+        before = _segments()
+        for _ in range(3):
+            result = _straggle(df, time.time() + 0.5)
+            stats = cp.evaluate(workers=4, batch_size=10000, chunk_batches=1, persistent=True,
+                    speculate=True)
+            pd.testing.assert_frame_equal(result.value, df + 1.0)
+            assert stats[0]["speculated"] >= 1
+            del result
+        assert _segments() == before
+    finally:
+        pycomposer.shutdown()
@@ -0,0 +1,60 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import composer_pandas as cp
+from composer_pandas.annotated import DataFrameSplit
+from pycomposer import sa
+
+import pipelines
+
+def fail_after_first_batch(series):
+    if series.index[0] > 0:
+        raise ValueError("failed")
+    return series
+
+def prefetching():
+    return [thread for thread in threading.enumerate() if thread.name == "pycomposer-prefetch"]
+
+def test_helper_stops_when_a_call_raises():
+    failing = sa((DataFrameSplit(),), {}, DataFrameSplit())(fail_after_first_batch)
+    failing(pd.Series(np.arange(1000.0)))
+    with pytest.raises(ValueError):
+        cp.evaluate(workers=1, batch_size=100, prefetch=True)
+    assert prefetching() == []
+
+def test_prefetched_results_match():
+    s = pd.Series(np.arange(1000.0))
+    result = cp.multiply(s, 2.0)
+    cp.evaluate(workers=1, batch_size=100, prefetch=True)
+    pd.testing.assert_series_equal(result.value, s * 2.0)
+    assert prefetching() == []
+
+class RecordingSplit(DataFrameSplit):
+    """ Records the name of the thread that splits each piece. """
+
+    threads = []
+
+    def split(self, start, end, value):
+        RecordingSplit.threads.append(threading.current_thread().name)
+        return DataFrameSplit.split(self, start, end, value)
+
+def test_splits_run_on_the_helper_thread():
+    RecordingSplit.threads = []
+    doubled = sa((RecordingSplit(),), {}, RecordingSplit())(lambda series: series * 2.0)
+    s = pd.Series(np.arange(1000.0))
+    result = doubled(s)
+    cp.evaluate(workers=1, batch_size=100, prefetch=True)
+    pd.testing.assert_series_equal(result.value, s * 2.0)
+    assert len(RecordingSplit.threads) >= 10
+    assert set(RecordingSplit.threads) == { "pycomposer-prefetch" }
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_prefetched_pipelines_match(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, prefetch=True,
+            start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, prefetch=True,
+            start_method=start_method)
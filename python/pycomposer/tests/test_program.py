@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import composer_pandas as cp
+from composer_pandas.annotated import DataFrameSplit
+from pycomposer import sa
+
+import pipelines
+
+# The number of rows of each piece passed to `_count_rows`.
+ROWS = []
+
+@sa((DataFrameSplit(),), {}, DataFrameSplit())
+def _count_rows(frame):
+    ROWS.append(len(frame))
+    return frame
+
+@pytest.mark.parametrize("coalesce_elements", [None, 2000])
+def test_pieces_after_filters_are_coalesced(coalesce_elements):
+    del ROWS[:]
+    frame = pd.DataFrame({"a": np.arange(20000) % 7, "b": np.arange(20000, dtype="float64")})
+    result = cp.multiply(_count_rows(cp.filter(frame, "a", 3)), 2.0)
+    cp.evaluate(workers=1, batch_size=1000, coalesce_elements=coalesce_elements)
+    expected = frame[frame["a"] > 3]
+    pd.testing.assert_frame_equal(result.value, expected * 2.0)
+    # The filter keeps 3 of every 7 rows of each batch, and the pieces are
+    # buffered until they reach the batch size or `coalesce_elements`.
+    assert sum(ROWS) == len(expected)
+    assert min(ROWS[:-1]) >= (coalesce_elements or 1000)
+    assert max(ROWS) < (coalesce_elements or 1000) + 1000
+    del ROWS[:]
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_coalesced_pipelines_match(length, start_method):
+    pipelines.run_pandas(length, workers=3, batch_size=1000, coalesce_elements=500,
+            start_method=start_method)
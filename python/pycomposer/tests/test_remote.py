@@ -0,0 +1,28 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import composer_pandas as cp
+import pycomposer
+from pycomposer.vm import transport
+
+def test_decorated_functions_pickle_by_reference():
+    for wrapper in (cp.multiply, cp.merge):
+        func = wrapper.__wrapped__
+        assert pickle.loads(transport.dumps_by_reference(func)) is func
+
+def test_pandas_pipeline_on_local_workers():
+    pycomposer.start_local_workers(2)
+    try:
+        df = pd.DataFrame({"k": np.arange(20000) % 3, "x": np.arange(20000.0)})
+        right = pd.DataFrame({"k": [0, 1, 2], "y": [1.0, 2.0, 3.0]})
+        result = cp.add(cp.multiply(df, 2.0), 1.0)
+        merged = cp.merge(df, right)
+        cp.evaluate(workers=2, backend="remote", batch_size=4096)
+        pd.testing.assert_frame_equal(result.value, df * 2.0 + 1.0)
+        expected = pd.merge(df, right)
+        pd.testing.assert_frame_equal(merged.value.sort_values("x").reset_index(drop=True),
+                expected.sort_values("x").reset_index(drop=True))
+    finally:
+        pycomposer.disconnect()
@@ -0,0 +1,58 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import composer_pandas as cp
+from composer_pandas.annotated import DataFrameSplit
+from pycomposer import Broadcast, sa
+from pycomposer.vm.scheduler import ChunkScheduler
+
+import pipelines
+
+def test_idle_workers_steal_from_the_longest_partition():
+    scheduler = ChunkScheduler([(0, 40), (40, 50)], 10)
+    assert scheduler.next(1) == (40, 50)
+    # Worker 1 is out of chunks, and takes the last chunk of worker 0.
+    assert scheduler.next(1) == (30, 40)
+    assert scheduler.next(0) == (0, 10)
+    assert scheduler.steals == [0, 1]
+
+def test_partitions_are_not_stolen_without_chunks():
+    scheduler = ChunkScheduler([(0, 40), (40, 50)])
+    assert scheduler.next(1) == (40, 50)
+    assert scheduler.next(1) is None
+    assert scheduler.next(0) == (0, 40)
+    assert scheduler.steals == [0, 0]
+
+@sa((DataFrameSplit(), Broadcast()), {}, DataFrameSplit())
+def _slow_below(series, end):
+    # The batches of the first partition are slow.
+    if series.index[0] < end:
+        time.sleep(0.05)
+    return series * 2.0
+
+@pytest.mark.parametrize("options", [
+    dict(backend="threads"),
+    dict(start_method="fork"),
+    dict(start_method="spawn"),
+], ids=repr)
+def test_slow_partition_is_stolen(options):
+    s = pd.Series(np.arange(12000, dtype="float64"))
+    result = _slow_below(s, 4000)
+    stats = cp.evaluate(workers=3, batch_size=500, chunk_batches=1, **options)
+    pd.testing.assert_series_equal(result.value, s * 2.0)
+    assert stats[0]["steals"] >= 1
+    # Other workers ran some chunks of the first worker's partition.
+    stolen = [chunk["range"] for chunk in stats[0]["workers"]\
+            if chunk["range"][0] < 4000 and chunk["worker"] != 0]
+    assert len(stolen) >= 1
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_chunked_pipelines_match(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, chunk_batches=2,
+            start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, chunk_batches=2,
+            start_method=start_method)
@@ -0,0 +1,103 @@
+import time
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import composer_pandas as cp
+from composer_pandas.annotated import DataFrameSplit
+from pycomposer import sa
+from pycomposer.vm import driver
+from pycomposer.vm.sizing import BatchController, MAX_BATCH_SIZE, MIN_BATCH_SIZE, auto_batch_size,\
+        fit_memory
+
+import pipelines
+
+@sa((DataFrameSplit(),), {}, DataFrameSplit())
+def _with_overhead(series):
+    # Each call has a fixed cost, so small batches are mostly overhead.
+    time.sleep(0.002)
+    return series * 2.0
+
+def _seconds(elements, spiking=True):
+    # Each batch takes 0.1ms, plus 0.1us per element, or 1us per element for
+    # batches over 4096 elements while they spike (e.g., out of cache).
+    return 1e-4 + elements * (1e-6 if elements > 4096 and spiking else 1e-7)
+
+def _sizes(controller, batches, spiking=lambda i: True):
+    sizes = []
+    for i in range(batches):
+        sizes.append(controller.size)
+        controller.record(controller.size, _seconds(controller.size, spiking(i)))
+    return sizes
+
+def test_batch_size_settles_below_sustained_spike():
+    sizes = _sizes(BatchController(1024), 300)
+    assert sizes[:4] == [1024, 2048, 4096, 8192]
+    # The size that spikes is probed less and less often, and the other
+    # batches keep the smaller size.
+    probes = [i for (i, size) in enumerate(sizes) if size == 8192]
+    gaps = [b - a for (a, b) in zip(probes, probes[1:])]
+    assert len(probes) <= 6 and gaps == sorted(gaps) and gaps[-1] > 2 * gaps[0]
+    assert set(sizes[4:]) == {4096, 8192}
+
+def test_batch_size_grows_after_spike_ends():
+    controller = BatchController(1024)
+    sizes = _sizes(controller, 100, spiking=lambda i: i < 20)
+    assert 4096 in sizes[4:20] and max(sizes[4:20]) == 8192
+    assert controller.size > 8192
+
+def _footprint(bytes_per_element):
+    return types.SimpleNamespace(bytes_per_element=lambda values: bytes_per_element)
+
+def test_auto_batch_size_fits_cache():
+    assert auto_batch_size(_footprint(64), {}, 1 << 20, 100) == (1 << 20) // 64
+    assert auto_batch_size(_footprint(1 << 20), {}, 1 << 20, 100) == MIN_BATCH_SIZE
+    assert auto_batch_size(_footprint(1), {}, 1 << 30, 100) == MAX_BATCH_SIZE
+    # Programs whose values report no sizes keep the default.
+    assert auto_batch_size(_footprint(None), {}, 1 << 20, 100) == 100
+
+def test_batch_sizes_follow_element_sizes(monkeypatch):
+    monkeypatch.setattr(driver, "cache_size", lambda level, default=None: 1 << 20)
+    sizes = {}
+    for dtype in ["float64", "float32"]:
+        stats = pipelines.run_numpy(1 << 20, dtype, workers=1)
+        sizes[dtype] = stats[0]["batch_size"]
+        batch_sizes = stats[0]["workers"][0]["batch_sizes"]
+        assert batch_sizes[:-1] == [sizes[dtype]] * (len(batch_sizes) - 1)
+    # The inputs, temporaries, and output of a batch fit in the cache, and
+    # halving the element size doubles the batch size.
+    assert sizes["float64"] * 8 * 4 <= 1 << 20
+    assert sizes["float32"] == 2 * sizes["float64"]
+
+@pytest.mark.parametrize("adaptive", [False, True])
+def test_adaptive_batch_sizes_grow_with_overhead(adaptive):
+    s = pd.Series(np.arange(200000, dtype="float64"))
+    result = _with_overhead(s)
+    stats = cp.evaluate(workers=1, batch_size=1024, adaptive=adaptive)
+    pd.testing.assert_series_equal(result.value, s * 2.0)
+    batch_sizes = stats[0]["workers"][0]["batch_sizes"]
+    if adaptive:
+        assert batch_sizes[0] == 1024 and max(batch_sizes) >= 16 * 1024
+    else:
+        assert set(batch_sizes[:-1]) == { 1024 }
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_adaptive_pipelines_match(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, adaptive=True,
+            start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, adaptive=True,
+            start_method=start_method)
+
+def test_fit_memory_drops_workers_before_batch_size():
+    mb = 1 << 20
+    def fit(limit):
+        return fit_memory(limit, 1000000, 1000, 8, 100 * mb, 10000, 4)
+    (workers, batch_size, estimate) = fit(1 << 30)
+    assert (workers, batch_size) == (4, 10000) and estimate <= 1 << 30
+    (workers, batch_size, estimate) = fit(300 * mb)
+    assert (workers, batch_size) == (2, 10000) and estimate <= 300 * mb
+    # Nothing fits, so the run uses one worker with the smallest batches.
+    assert fit(1)[:2] == (1, MIN_BATCH_SIZE)
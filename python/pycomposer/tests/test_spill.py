@@ -0,0 +1,78 @@
+import gc
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import composer_pandas as cp
+from composer_pandas.annotated import DataFrameSplit
+from pycomposer import sa, spilled
+from pycomposer.vm import spill
+
+import pipelines
+
+def _files(path):
+    return [name for (_, _, names) in os.walk(path) for name in names]
+
+@sa((DataFrameSplit(),), {}, DataFrameSplit())
+def _fail_at_end(frame):
+    if frame["x"].iloc[-1] == 29999.0:
+        raise RuntimeError("last chunk failed")
+    return frame + 1.0
+
+def test_spilled_results_are_removed_when_collected(tmp_path):
+    df = pd.DataFrame({"x": np.arange(30000.0)})
+    result = cp.add(df, 1.0)
+    cp.evaluate(workers=3, batch_size=5000, spill_bytes=0, spill_directory=str(tmp_path))
+    value = result.value
+    assert spilled(value)
+    pd.testing.assert_frame_equal(value, df + 1.0)
+    assert len(_files(tmp_path)) > 0
+    del value, result
+    gc.collect()
+    assert _files(tmp_path) == []
+
+@pytest.mark.parametrize("spill_bytes, spills", [("1G", False), (1000, True)])
+def test_results_over_the_threshold_are_spilled(tmp_path, spill_bytes, spills):
+    df = pd.DataFrame({"x": np.arange(30000.0)})
+    result = cp.add(df, 1.0)
+    cp.evaluate(workers=3, batch_size=5000, spill_bytes=spill_bytes,
+            spill_directory=str(tmp_path))
+    value = result.value
+    pd.testing.assert_frame_equal(value, df + 1.0)
+    # Over the threshold, the result is combined into files in the spill
+    # directory instead of memory.
+    assert spilled(value) == spills
+    assert (len(_files(tmp_path)) > 0) == spills
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS)
+def test_spilled_pipelines_match(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, spill_bytes=1000,
+            start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, spill_bytes=1000,
+            start_method=start_method)
+
+def test_discarded_results_are_reclaimed(tmp_path):
+    df = pd.DataFrame({"x": np.arange(30000.0)})
+    _fail_at_end(df)
+    # The other chunks spill their results and send them back, but the driver
+    # never loads them.
+    with pytest.raises(Exception, match="last chunk failed"):
+        cp.evaluate(workers=3, batch_size=5000, chunk_batches=1, spill_bytes=0,
+                spill_directory=str(tmp_path))
+    assert _files(tmp_path) == []
+
+def test_new_owner_of_a_handed_over_file_keeps_it():
+    array = spill.spill_empty(10)
+    path = spill._transfer(array)
+    # The file was handed to another process, and now belongs to a new array.
+    reused = spill._load(path)
+    del array
+    gc.collect()
+    assert os.path.exists(path)
+    assert spilled(reused)
+    del reused
+    gc.collect()
+    assert not os.path.exists(path)
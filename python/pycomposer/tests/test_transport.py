@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+import gc
+import os
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+
+import composer_numpy as cnp
+from pycomposer.vm import transport
+
+import pipelines
+
+# Runs evaluations in a fresh process, since the resource tracker reports
+# leaked segments when the process exits.
+_EVALUATIONS = textwrap.dedent("""
+    import numpy as np
+    import pandas as pd
+    import composer_pandas as cp
+    import pycomposer
+    pycomposer.vm.pool.MAX_WORKERS = 3
+
+    for i in range(3):
+        df = pd.DataFrame({{"x": np.arange(100000.0), "y": np.ones(100000)}})
+        result = cp.add(cp.multiply(df, 2.0), 1.0)
+        cp.evaluate(workers=3, {options})
+        assert np.allclose(result.value["x"].to_numpy(), np.arange(100000.0) * 2.0 + 1.0)
+    pycomposer.shutdown()
+""")
+
+@pytest.mark.parametrize("options", [
+    "persistent=True",
+    "persistent=True, start_method='spawn'",
+    "start_method='fork'",
+    "start_method='forkserver'",
+    "merge_fanin=2, chunk_batches=1, batch_size=10000",
+])
+def test_segments_are_not_leaked(options):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    run = subprocess.run([sys.executable, "-c", _EVALUATIONS.format(options=options)],
+            env=env, capture_output=True, text=True, timeout=120)
+    assert run.returncode == 0, run.stderr
+    assert "leaked shared_memory" not in run.stderr
+    assert "No such file or directory" not in run.stderr
+
+@pytest.mark.parametrize("start_method", ["spawn", "forkserver"])
+def test_writes_to_private_arrays_are_copied_back(start_method):
+    # The workers do not inherit `out`, and write into a shared copy of it.
+    a = np.arange(20000, dtype="float64")
+    out = np.zeros(20000)
+    cnp.sqrt(a, out=out)
+    cnp.evaluate(workers=3, batch_size=1000, start_method=start_method)
+    np.testing.assert_allclose(out, np.sqrt(a))
+
+@pytest.mark.parametrize("length", [0, 20000])
+@pytest.mark.parametrize("start_method", pipelines.START_METHODS + ["forkserver"])
+def test_pipelines_match_under_start_methods(length, start_method):
+    pipelines.run_numpy(length, workers=3, batch_size=1000, start_method=start_method)
+    pipelines.run_pandas(length, workers=3, batch_size=1000, start_method=start_method)
+
+def test_shared_arrays_round_trip():
+    array = transport.shared_empty(1000)
+    array[:] = np.arange(1000.0)
+    export = transport.Export({0: array[10:20], 1: np.ones(5)}, set())
+    segments = {}
+    values = transport.attach(export.descriptors, segments)
+    assert np.array_equal(values[0], np.arange(10.0, 20.0))
+    assert np.array_equal(values[1], np.ones(5))
+    del values
+    transport.detach(segments)
+    export.close()
+    assert segments == {}
+
+def test_results_round_trip_through_shared_memory():
+    result = {0: np.arange(100000.0), 1: [np.ones(10)]}
+    handle = transport.share_result(result)
+    assert handle.name is not None
+    loaded = transport.load_result(handle)
+    assert np.array_equal(loaded[0], result[0])
+    assert np.array_equal(loaded[1][0], result[1][0])
+
+def test_segments_from_many_threads():
+    # Thread workers and concurrent pipelines share the segment table.
+    def allocate(_):
+        for _ in range(50):
+            array = transport.shared_empty(100)
+            loaded = transport.load_result(transport.share_result(np.arange(10000.0)))
+            assert transport._segment_of(array[1:])[0] is not None
+            assert np.array_equal(loaded, np.arange(10000.0))
+
+    before = len(transport._SEGMENTS)
+    with ThreadPoolExecutor(8) as threads:
+        list(threads.map(allocate, range(8)))
+    gc.collect()
+    assert len(transport._SEGMENTS) == before
@@ -0,0 +1,67 @@
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+
+import composer_pandas as cp
+from composer_pandas.annotated import DataFrameSplit
+import pycomposer
+from pycomposer import Broadcast, sa
+from pycomposer.vm import pool
+
+def _build(path, factor):
+    # Records the process that built the object.
+    with open(path, "a") as f:
+        f.write("{}\n".format(os.getpid()))
+    return { "factor": factor }
+
+def _builders(path):
+    with open(path) as f:
+        return [int(line) for line in f]
+
+@sa((DataFrameSplit(), Broadcast()), {}, DataFrameSplit())
+def _scale_by(frame, scale):
+    return frame * scale["factor"]
+
+def test_objects_are_built_once_per_pool_worker(tmp_path, monkeypatch):
+    monkeypatch.setattr(pool, "MAX_WORKERS", 2)
+    path = str(tmp_path / "builders")
+    df = pd.DataFrame({ "x": np.arange(20000.0) })
+    pycomposer.worker_initializer("scale", functools.partial(_build, path, 2.0))
+    try:
+        for _ in range(3):
+            result = _scale_by(df, pycomposer.worker_object("scale"))
+            cp.evaluate(workers=2, batch_size=1000, chunk_batches=1, persistent=True)
+            pd.testing.assert_frame_equal(result.value, df * 2.0)
+        # Each of the two workers built it for its first chunk, and used it
+        # for the other chunks of all three evaluations.
+        builders = _builders(path)
+        assert len(builders) == 2 and len(set(builders)) == 2
+        assert os.getpid() not in builders
+
+        # Replacing the initializer rebuilds the object in the workers.
+        pycomposer.worker_initializer("scale", functools.partial(_build, path, 3.0))
+        result = _scale_by(df, pycomposer.worker_object("scale"))
+        cp.evaluate(workers=2, batch_size=1000, chunk_batches=1, persistent=True)
+        pd.testing.assert_frame_equal(result.value, df * 3.0)
+        assert sorted(_builders(path)[2:]) == sorted(builders)
+    finally:
+        pycomposer.shutdown()
+
+def test_objects_are_built_once_per_process(tmp_path):
+    path = str(tmp_path / "builders")
+    df = pd.DataFrame({ "x": np.arange(20000.0) })
+    pycomposer.worker_initializer("scale", functools.partial(_build, path, 2.0))
+    # The workers of the first run build the object, and exit with it.
+    result = _scale_by(df, pycomposer.worker_object("scale"))
+    cp.evaluate(workers=2, batch_size=1000, chunk_batches=1, start_method="spawn")
+    pd.testing.assert_frame_equal(result.value, df * 2.0)
+    spawned = _builders(path)
+    assert len(spawned) == len(set(spawned)) and os.getpid() not in spawned
+    # A run in this process builds it here once for all of its batches.
+    result = _scale_by(df, pycomposer.worker_object("scale"))
+    cp.evaluate(workers=1, batch_size=1000)
+    pd.testing.assert_frame_equal(result.value, df * 2.0)
+    assert _builders(path)[len(spawned):] == [os.getpid()]
+    pycomposer.clear_worker_objects()